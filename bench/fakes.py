@@ -0,0 +1,302 @@
+"""
+压测用的本地替身服务：GitLab REST（diffs、changes、commits、notes、compare）、钉钉机器人，以及兼容 OpenAI 的流式接口。
+全部运行在压测进程内的线程中，worker 进程通过 HTTP 访问，和真实部署走同一条调用链路。
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+REVIEW_TEXT = """### 问题描述和优化建议
+1. **最佳实践**
+   - 问题：部分函数缺少类型注解
+   - 建议：补充参数和返回值的类型注解
+
+### 评分明细
+| 维度 | 分数 |
+|------|------|
+| 功能实现的正确性与健壮性 | 35/40 |
+| 安全性与潜在风险 | 25/30 |
+| 是否符合最佳实践 | 16/20 |
+| 性能与资源利用效率 | 4/5 |
+| Commits信息的清晰性与准确性 | 4/5 |
+
+### 总分
+总分:84分
+"""
+
+
+def make_diff(index: int, lines: int) -> str:
+    body = "".join(f"+    value_{n} = compute_{index}(value_{n - 1}, {n})  # step {n}\n" for n in range(1, lines + 1))
+    return f"@@ -0,0 +1,{lines} @@\n+def compute_{index}(value, step):\n{body}"
+
+
+class _Server:
+    """在后台线程中运行的 HTTP 服务"""
+
+    handler_class = None
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        handler = type('Handler', (self.handler_class,), {'fake': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def send_json(self, status: int, payload, headers: dict = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _GitLabHandler(_JsonHandler):
+    routes = [
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests$'), 'list_merge_requests'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests/(\d+)$'), 'merge_request'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests/(\d+)/changes$'), 'changes'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests/(\d+)/diffs$'), 'diffs'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests/(\d+)/commits$'), 'commits'),
+        ('POST', re.compile(r'^/api/v4/projects/([^/]+)/merge_requests/(\d+)/notes$'), 'notes'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/repository/compare$'), 'compare'),
+        ('GET', re.compile(r'^/api/v4/projects/([^/]+)/repository/commits$'), 'repository_commits'),
+        ('POST', re.compile(r'^/api/v4/projects/([^/]+)/repository/commits/([^/]+)/comments$'), 'commit_comments'),
+        ('POST', re.compile(r'^/robot/send$'), 'dingtalk'),
+    ]
+
+    def _dispatch(self, method: str):
+        parsed = urlparse(self.path)
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(parsed.path) if route_method == method else None
+            if match:
+                if self.fake.latency:
+                    time.sleep(self.fake.latency)
+                args = [unquote(group) for group in match.groups()]
+                query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                result = getattr(self.fake, f"handle_{name}")(*args, query=query,
+                                                              body=self.read_json() if method == 'POST' else None)
+                return self.send_json(*result)
+        self.send_json(404, {'message': '404 Not Found'})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class FakeGitLab(_Server):
+    """
+    按项目配置 MR 的文件数和每个文件的行数，changes 按配置生成一次后复用。
+    收到 MR note 或 commit comment 时记录完成时间，压测据此计算端到端延迟。
+    """
+
+    handler_class = _GitLabHandler
+
+    def __init__(self, latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.projects = {}
+        self.completed = {}
+        self.dingtalk_messages = 0
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def add_project(self, project_id, files: int, lines: int, commits: int = 1, open_merge_requests: int = 0):
+        changes = [{
+            'old_path': f"src/module_{index}.py",
+            'new_path': f"src/module_{index}.py",
+            'new_file': True,
+            'renamed_file': False,
+            'deleted_file': False,
+            'diff': make_diff(index, lines),
+        } for index in range(files)]
+        commit_list = [{
+            'id': f"c{index:039x}",
+            'short_id': f"c{index:07x}",
+            'title': f"feat: change {index}",
+            'message': f"feat: change {index}",
+            'parent_ids': [f"c{index - 1:039x}"],
+        } for index in range(1, commits + 1)]
+        self.projects[str(project_id)] = {'changes': changes, 'commits': commit_list,
+                                          'open_merge_requests': open_merge_requests}
+
+    def _project(self, project_id: str) -> dict:
+        return self.projects[project_id]
+
+    def _complete(self, key):
+        with self._done:
+            self.completed[key] = time.time()
+            self._done.notify_all()
+
+    def wait_for(self, keys, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._done:
+            while not all(key in self.completed for key in keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+    def handle_merge_request(self, project_id, iid, **kwargs):
+        head = self._project(project_id)['commits'][-1]['id']
+        return 200, {
+            'id': int(iid), 'iid': int(iid), 'project_id': project_id,
+            'title': f"bench-{project_id}", 'state': 'opened',
+            'source_branch': 'feature/bench', 'target_branch': 'develop', 'merged_at': None,
+            'author': {'username': 'bench'}, 'sha': head,
+            'diff_refs': {'base_sha': 'a' * 40, 'start_sha': 'a' * 40, 'head_sha': head},
+            'web_url': f"{self.url}/bench/{project_id}/-/merge_requests/{iid}",
+        }
+
+    def handle_list_merge_requests(self, project_id, query=None, **kwargs):
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 20))
+        total = self._project(project_id)['open_merge_requests']
+        iids = range((page - 1) * per_page + 1, min(page * per_page, total) + 1)
+        next_page = str(page + 1) if page * per_page < total else ''
+        return 200, [self.handle_merge_request(project_id, iid)[1] for iid in iids], {'X-Next-Page': next_page}
+
+    def handle_changes(self, project_id, iid, **kwargs):
+        return 200, {'changes': self._project(project_id)['changes']}
+
+    def handle_diffs(self, project_id, iid, query=None, **kwargs):
+        changes = self._project(project_id)['changes']
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 20))
+        next_page = str(page + 1) if page * per_page < len(changes) else ''
+        return 200, changes[(page - 1) * per_page:page * per_page], {'X-Next-Page': next_page}
+
+    def handle_commits(self, project_id, iid, **kwargs):
+        return 200, self._project(project_id)['commits']
+
+    def handle_notes(self, project_id, iid, **kwargs):
+        self._complete(('merge_request', project_id, int(iid)))
+        return 201, {'id': 1}
+
+    def handle_compare(self, project_id, **kwargs):
+        project = self._project(project_id)
+        return 200, {'commits': project['commits'], 'diffs': project['changes']}
+
+    def handle_repository_commits(self, project_id, query=None, **kwargs):
+        ref_name = (query or {}).get('ref_name', '')
+        return 200, [{'id': ref_name, 'parent_ids': ['a' * 40]}]
+
+    def handle_commit_comments(self, project_id, sha, **kwargs):
+        self._complete(('push', project_id, sha))
+        return 201, {'note': 'ok'}
+
+    def handle_dingtalk(self, **kwargs):
+        with self._lock:
+            self.dingtalk_messages += 1
+        return 200, {'errcode': 0, 'errmsg': 'ok'}
+
+
+class _OpenAIHandler(_JsonHandler):
+
+    def do_POST(self):
+        if not urlparse(self.path).path.endswith('/chat/completions'):
+            return self.send_json(404, {'error': {'message': 'not found'}})
+        request = self.read_json()
+        fake = self.fake
+        messages = request.get('messages', [])
+        prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4
+        pieces = [REVIEW_TEXT[i:i + 4] for i in range(0, len(REVIEW_TEXT), 4)]
+        # 模拟 DeepSeek 的上下文缓存：之前请求过的第一条消息（system prompt）作为前缀命中
+        prefix = messages[0].get('content', '') if messages else ''
+        with fake.lock:
+            fake.requests += 1
+            cache_hit = min(len(prefix) // 4, prompt_tokens) if prefix in fake.seen_prefixes else 0
+            fake.seen_prefixes.add(prefix)
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(pieces),
+                 'total_tokens': prompt_tokens + len(pieces),
+                 'prompt_cache_hit_tokens': cache_hit, 'prompt_cache_miss_tokens': prompt_tokens - cache_hit}
+        if random.random() < fake.error_rate:
+            return self.send_json(500, {'error': {'message': 'bench injected error', 'type': 'server_error'}})
+        time.sleep(fake.first_token_latency + (fake.tail_latency if random.random() < fake.tail_rate else 0))
+
+        if not request.get('stream'):
+            time.sleep(len(pieces) / fake.tokens_per_second)
+            return self.send_json(200, {
+                'id': 'bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': request.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': REVIEW_TEXT},
+                             'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for piece in pieces:
+                self._write_event({'id': 'bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                   'model': request.get('model'),
+                                   'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]})
+                time.sleep(1 / fake.tokens_per_second)
+            if (request.get('stream_options') or {}).get('include_usage'):
+                self._write_event({'id': 'bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                   'model': request.get('model'), 'choices': [], 'usage': usage})
+            self._write_chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端读到总分后提前断开
+            self.close_connection = True
+
+    def _write_event(self, payload: dict):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeOpenAI(_Server):
+    """
+    兼容 OpenAI 的 /chat/completions，可配置首 token 延迟和每秒输出 token 数（一个 token 按 4 个字符计），
+    usage 中按 DeepSeek 的格式返回上下文缓存命中的 token 数
+    """
+
+    handler_class = _OpenAIHandler
+
+    def __init__(self, first_token_latency: float = 0.5, tokens_per_second: float = 50, error_rate: float = 0.0,
+                 tail_rate: float = 0.0, tail_latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        # 按比例注入 500 错误和长尾延迟（首 token 前额外等待 tail_latency 秒），用于验证 LLM 路由的切换和对冲
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.requests = 0
+        self.seen_prefixes = set()
+        self.lock = threading.Lock()
@@ -0,0 +1,98 @@
+"""
+启动耗时预算：用 python -X importtime 在子进程中导入服务和 worker 的入口模块，检查
+1. 导入总耗时（多次运行取最小值）不超过预算；
+2. 没有在导入时加载只在使用时才需要的重量级依赖（openai、rq、redis、flask、tiktoken、yaml、prometheus_client）；
+3. 导入时没有在工作目录中写入任何文件（日志文件、指标目录等）：子进程在一个只有 conf/.env 副本的临时目录中执行，
+   不额外设置 LOG_FILE、PROMETHEUS_MULTIPROC_DIR 等变量，按默认配置导入后检查目录没有变化。
+超出预算时以非 0 状态码退出，可以放在 CI 中执行。
+
+用法（在仓库根目录执行）：
+    python -m bench.import_time
+    python -m bench.import_time --module server --budget-ms 2000 --top 20
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# 模块 -> 默认的导入耗时预算（毫秒），server 中 mcp 本身约占一半
+BUDGETS = {
+    'server': 1500,
+    'biz.queue.worker': 800,
+}
+
+# 只在使用时才导入的依赖
+LAZY_MODULES = ('openai', 'rq', 'redis', 'flask', 'tiktoken', 'yaml', 'prometheus_client')
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str, work_dir: str) -> tuple:
+    """在 work_dir 中导入 module，返回 ({模块名: (自身耗时, 累计耗时)}（微秒）, 导入的顶层包集合)"""
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('LOG_FILE', 'PROMETHEUS_MULTIPROC_DIR', 'RATE_LIMIT_DIR')}
+    env.update({
+        'QUEUE_DRIVER': 'async',
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT_DIR, env.get('PYTHONPATH')])),
+    })
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], env=env, cwd=work_dir,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings, {name.split('.')[0] for name in timings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查服务和 worker 的导入耗时预算')
+    parser.add_argument('--module', action='append', help='只检查指定模块（可重复），默认检查全部')
+    parser.add_argument('--budget-ms', type=float, help='覆盖默认预算（毫秒）')
+    parser.add_argument('--runs', type=int, default=3, help='每个模块运行次数，取最小值')
+    parser.add_argument('--top', type=int, default=10, help='列出累计耗时最长的模块数')
+    args = parser.parse_args(argv)
+
+    failures = []
+    for module in args.module or list(BUDGETS):
+        budget = args.budget_ms or BUDGETS.get(module, 1000)
+        best = None
+        for _ in range(max(1, args.runs)):
+            with tempfile.TemporaryDirectory(prefix='code-review-import-') as work_dir:
+                env_file = os.path.join(ROOT_DIR, 'conf', '.env')
+                if os.path.exists(env_file):
+                    os.makedirs(os.path.join(work_dir, 'conf'))
+                    shutil.copy(env_file, os.path.join(work_dir, 'conf', '.env'))
+                before = set(os.listdir(work_dir))
+                timings, packages = measure(module, work_dir)
+                created = sorted(set(os.listdir(work_dir)) - before)
+            if best is None or timings[module][1] < best[0][module][1]:
+                best = (timings, packages, created)
+        timings, packages, created = best
+
+        total_ms = timings[module][1] / 1000
+        print(f"{module}: {total_ms:.0f}ms (budget {budget:.0f}ms)")
+        for name, (_, cumulative) in sorted(timings.items(), key=lambda item: -item[1][1])[1:args.top + 1]:
+            print(f"    {cumulative / 1000:>8.1f}ms  {name}")
+
+        if total_ms > budget:
+            failures.append(f"{module} 导入耗时 {total_ms:.0f}ms 超过预算 {budget:.0f}ms")
+        eager = sorted(package for package in LAZY_MODULES if package in packages)
+        if eager:
+            failures.append(f"{module} 在导入时加载了 {', '.join(eager)}")
+        if created:
+            failures.append(f"{module} 在导入时写入了工作目录: {', '.join(created)}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+端到端压测：在进程内启动 GitLab、钉钉和 OpenAI 兼容接口的替身服务，
+按 service.handle_gitlab → 队列 → worker.handle_merge_request_event 的真实链路执行各个场景，
+输出每个场景的 p50/p99 延迟、吞吐（jobs/sec）和峰值内存。
+
+用法（在仓库根目录执行）：
+    python -m bench.run_bench
+    python -m bench.run_bench --scenario burst_100 --workers 8 --llm-latency 2 --llm-tps 30
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+from bench.fakes import FakeGitLab, FakeOpenAI
+
+
+@dataclass
+class Scenario:
+    name: str
+    kind: str  # merge_request / push / sweep
+    jobs: int
+    files: int
+    lines: int
+    commits: int = 1
+    concurrent: bool = False
+
+
+SCENARIOS = [
+    Scenario('small_mr', 'merge_request', jobs=20, files=5, lines=20),
+    Scenario('large_mr_500_files', 'merge_request', jobs=3, files=500, lines=20),
+    Scenario('burst_100', 'merge_request', jobs=100, files=5, lines=20, concurrent=True),
+    Scenario('push_50_commits', 'push', jobs=10, files=20, lines=20, commits=50),
+    # 批量审查项目中所有打开的 MR，并发数与 worker 数相同，延迟从开始批量审查算起
+    Scenario('sweep_40_open_mrs', 'sweep', jobs=40, files=5, lines=20),
+]
+
+
+def configure_environment(args, gitlab: FakeGitLab, llms: list, work_dir: str):
+    """在导入 biz 模块之前设置环境变量，worker 进程 fork 时继承"""
+    llm = llms[0]
+    if len(llms) > 1:
+        os.environ['LLM_BACKENDS'] = ','.join(f"bench{index}" for index in range(len(llms)))
+        for index, backend in enumerate(llms):
+            os.environ[f"LLM_BACKEND_BENCH{index}_BASE_URL"] = backend.url
+    if getattr(args, 'llm_hedge_delay', None) is not None:
+        os.environ['LLM_ROUTER_HEDGE_DELAY'] = str(args.llm_hedge_delay)
+    os.environ.update({
+        'GITLAB_URL': gitlab.url,
+        'GITLAB_ACCESS_TOKEN': 'bench-token',
+        'DEEPSEEK_API_KEY': 'bench-key',
+        'DEEPSEEK_API_BASE_URL': llm.url,
+        'DEEPSEEK_API_MODEL': 'bench-model',
+        'DINGTALK_WEBHOOK_URL': f"{gitlab.url}/robot/send",
+        'QUEUE_DRIVER': 'async',
+        'QUEUE_WORKERS': str(args.workers),
+        'QUEUE_MAX_SIZE': str(max(args.workers, 200)),
+        'REVIEW_DEBOUNCE_SECONDS': '0',
+        'REVIEW_CACHE_ENABLED': '1' if args.cache else '0',
+        'PUSH_REVIEW_ENABLED': '1',
+        'LLM_RPM': '0',
+        'LLM_TPM': '0',
+        'DINGTALK_RATE_PER_MINUTE': '0',
+        'REVIEW_STATE_PATH': os.path.join(work_dir, 'review_state.db'),
+        'REVIEW_CACHE_PATH': os.path.join(work_dir, 'review_cache.db'),
+        'REVIEW_HISTORY_PATH': os.path.join(work_dir, 'review_history.db'),
+        'REVIEW_JOB_PATH': os.path.join(work_dir, 'review_job.db'),
+        'REVIEW_JOB_POLL_INTERVAL': '0.05',
+        'RATE_LIMIT_DIR': os.path.join(work_dir, 'rate_limit'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(work_dir, 'metrics'),
+        'LOG_FILE': os.path.join(work_dir, 'app.log'),
+        'LOG_LEVEL': args.log_level,
+    })
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb(pids: list) -> tuple:
+    """返回 (主进程峰值 RSS, worker 进程中最大的峰值 RSS)，单位 MB（Linux 下读取 /proc/<pid>/status 的 VmHWM）"""
+    main_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    worker_peak = 0.0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        worker_peak = max(worker_peak, int(line.split()[1]) / 1024)
+        except OSError:
+            continue
+    return main_peak, worker_peak
+
+
+def run_scenario(scenario: Scenario, gitlab: FakeGitLab, timeout: float) -> dict:
+    from biz.gitlab.gitlabHandler import slugify_url
+    from biz.queue.worker import handle_push_event, trim_push_payload
+    from biz.service import service
+    from biz.utils.queue import get_worker_pool, handle_queue
+
+    project_id = f"bench-{scenario.name}"
+    gitlab.add_project(project_id, files=scenario.files, lines=scenario.lines, commits=scenario.commits,
+                       open_merge_requests=scenario.jobs if scenario.kind == 'sweep' else 0)
+    gitlab_url = os.environ['GITLAB_URL']
+    token = os.environ['GITLAB_ACCESS_TOKEN']
+
+    def submit(job: int):
+        if scenario.kind == 'merge_request':
+            service.handle_gitlab({'project_id': project_id, 'iid': job + 1})
+            return 'merge_request', project_id, job + 1
+        commits = [{
+            # 以 0000000 开头的 sha 会被当作新建/删除分支
+            'id': f"b{job:07x}{index:032x}",
+            'message': f"feat: change {index}",
+            'author': {'name': 'bench'},
+            'timestamp': '2024-01-01T00:00:00+08:00',
+        } for index in range(1, scenario.commits + 1)]
+        data = {
+            'event_name': 'push',
+            'ref': 'refs/heads/develop',
+            'before': 'a' * 40,
+            'after': commits[-1]['id'],
+            'user_username': 'bench',
+            'project': {'id': project_id, 'name': project_id, 'default_branch': 'develop'},
+            'commits': commits,
+        }
+        handle_queue(handle_push_event, trim_push_payload(data), token, gitlab_url, slugify_url(gitlab_url))
+        return 'push', project_id, commits[-1]['id']
+
+    submitted = {}
+    started_at = time.time()
+    if scenario.kind == 'sweep':
+        from biz.service.sweep import sweep_open_merge_requests
+        sweep_open_merge_requests(project_id=project_id, concurrency=int(os.environ['QUEUE_WORKERS']),
+                                  timeout=timeout)
+        submitted = {('merge_request', project_id, iid): started_at for iid in range(1, scenario.jobs + 1)}
+    for job in range(scenario.jobs if scenario.kind != 'sweep' else 0):
+        submitted_at = time.time()
+        key = submit(job)
+        submitted[key] = submitted_at
+        if not scenario.concurrent and not gitlab.wait_for([key], timeout):
+            break
+    completed_all = gitlab.wait_for(list(submitted), timeout)
+    finished_at = max([gitlab.completed.get(key, started_at) for key in submitted] or [started_at])
+
+    latencies = [gitlab.completed[key] - at for key, at in submitted.items() if key in gitlab.completed]
+    main_rss, worker_rss = peak_rss_mb([p.pid for p in get_worker_pool()._processes])
+    elapsed = max(finished_at - started_at, 1e-9)
+    return {
+        'scenario': scenario.name,
+        'jobs': f"{len(latencies)}/{scenario.jobs}" + ('' if completed_all else ' (timeout)'),
+        'p50_s': percentile(latencies, 0.50),
+        'p99_s': percentile(latencies, 0.99),
+        'jobs_per_s': len(latencies) / elapsed,
+        'main_rss_mb': main_rss,
+        'worker_rss_mb': worker_rss,
+    }
+
+
+def format_results(results: list, args) -> str:
+    header = f"{'scenario':<22}{'jobs':>16}{'p50(s)':>10}{'p99(s)':>10}{'jobs/s':>10}{'main RSS(MB)':>14}{'worker RSS(MB)':>16}"
+    lines = [
+        f"# {time.strftime('%Y-%m-%d %H:%M:%S')} workers={args.workers} gitlab_latency={args.gitlab_latency}s "
+        f"llm_latency={args.llm_latency}s llm_tps={args.llm_tps} cache={'on' if args.cache else 'off'}",
+        header,
+        '-' * len(header),
+    ]
+    for r in results:
+        lines.append(f"{r['scenario']:<22}{r['jobs']:>16}{r['p50_s']:>10.3f}{r['p99_s']:>10.3f}"
+                     f"{r['jobs_per_s']:>10.2f}{r['main_rss_mb']:>14.1f}{r['worker_rss_mb']:>16.1f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='代码审查流水线端到端压测')
+    parser.add_argument('--scenario', action='append', choices=[s.name for s in SCENARIOS],
+                        help='只运行指定场景（可重复），默认运行全部')
+    parser.add_argument('--workers', type=int, default=4, help='async 模式下的 worker 进程数')
+    parser.add_argument('--gitlab-latency', type=float, default=0.02, help='GitLab 替身每个请求的延迟（秒）')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='LLM 替身的首 token 延迟（秒）')
+    parser.add_argument('--llm-tps', type=float, default=200, help='LLM 替身每秒输出的 token 数')
+    parser.add_argument('--llm-backends', type=int, default=1, help='LLM 替身数量，多于 1 个时通过 LLM 路由访问')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='第一个 LLM 替身返回 500 的比例')
+    parser.add_argument('--llm-tail-rate', type=float, default=0.0, help='第一个 LLM 替身出现长尾延迟的比例')
+    parser.add_argument('--llm-tail-latency', type=float, default=0.0, help='长尾请求额外的首 token 延迟（秒）')
+    parser.add_argument('--llm-hedge-delay', type=float, help='样本不足时的对冲延迟（秒），默认使用 LLM_ROUTER_HEDGE_DELAY')
+    parser.add_argument('--cache', action='store_true', help='开启 Review 缓存')
+    parser.add_argument('--timeout', type=float, default=600, help='单个场景的最长等待时间（秒）')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', default='bench_output.txt', help='结果追加写入的文件')
+    args = parser.parse_args(argv)
+
+    gitlab = FakeGitLab(latency=args.gitlab_latency).start()
+    llms = [FakeOpenAI(first_token_latency=args.llm_latency, tokens_per_second=args.llm_tps,
+                       error_rate=args.llm_error_rate if index == 0 else 0.0,
+                       tail_rate=args.llm_tail_rate if index == 0 else 0.0,
+                       tail_latency=args.llm_tail_latency).start()
+            for index in range(max(1, args.llm_backends))]
+    work_dir = tempfile.mkdtemp(prefix='code-review-bench-')
+    configure_environment(args, gitlab, llms, work_dir)
+
+    from biz.utils.queue import get_worker_pool, start_worker_pool
+    start_worker_pool()
+
+    results = []
+    try:
+        for scenario in SCENARIOS:
+            if args.scenario and scenario.name not in args.scenario:
+                continue
+            print(f"running {scenario.name} ...", file=sys.stderr)
+            results.append(run_scenario(scenario, gitlab, args.timeout))
+    finally:
+        get_worker_pool().shutdown()
+        gitlab.stop()
+        for llm in llms:
+            llm.stop()
+
+    report = format_results(results, args)
+    print(report)
+    print(f"LLM requests: {[llm.requests for llm in llms]}, DingTalk messages: {gitlab.dingtalk_messages}, work dir: {work_dir}",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(report + "\n\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 class MergeEntity:
     def __init__(self, project_name: str, author: str, source_branch: str, target_branch: str, updated_at: int,
-                 commits: list, score: float, url: str, review_result: str, url_slug: str):
+                 commits: list, score: float, url: str, review_result: str, url_slug: str,
+                 prompt_tokens: int = 0, completion_tokens: int = 0, duration: float = None, tier: str = None,
+                 model: str = None, diff_tokens: int = None, file_count: int = None, project_id=None,
+                 project_path: str = None):
         self.project_name = project_name
+        # GitLab 的项目 ID 和路径（group/project），写入审查历史
+        self.project_id = project_id
+        self.project_path = project_path
         self.author = author
         self.source_branch = source_branch
         self.target_branch = target_branch
@@ -11,6 +17,15 @@ class MergeEntity:
         self.url = url
         self.review_result = review_result
         self.url_slug = url_slug
+        # 本次审查的 token 用量和耗时（秒），写入审查历史
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.duration = duration
+        # 选择的模型档位和选档依据（diff 的 token 数、文件数），用于按审查结果调整分档阈值
+        self.tier = tier
+        self.model = model
+        self.diff_tokens = diff_tokens
+        self.file_count = file_count
 
     @property
     def commit_messages(self):
@@ -19,17 +34,47 @@ class MergeEntity:
 
 class PushEntity:
     def __init__(self, project_name: str, author: str, branch: str, updated_at: int, commits: list, score: float,
-                 review_result: str, url_slug: str):
+                 review_result: str, url_slug: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 duration: float = None, tier: str = None, model: str = None, diff_tokens: int = None,
+                 file_count: int = None, project_id=None, project_path: str = None):
         self.project_name = project_name
+        # GitLab 的项目 ID 和路径（group/project），写入审查历史
+        self.project_id = project_id
+        self.project_path = project_path
         self.author = author
+        # 本次 push 的分支
         self.branch = branch
         self.updated_at = updated_at
         self.commits = commits
         self.score = score
         self.review_result = review_result
         self.url_slug = url_slug
+        # 本次审查的 token 用量和耗时（秒），写入审查历史
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.duration = duration
+        # 选择的模型档位和选档依据（diff 的 token 数、文件数），用于按审查结果调整分档阈值
+        self.tier = tier
+        self.model = model
+        self.diff_tokens = diff_tokens
+        self.file_count = file_count
 
     @property
     def commit_messages(self):
         return "; ".join(commit["message"].strip() for commit in self.commits)
 
+
+
+class MergeRequestSnapshot:
+    def __init__(self, info: dict, changes: list, commits: list, base_sha: str = None, truncated: bool = False):
+        self.info = info
+        self.changes = changes
+        self.commits = commits
+        # 不为空时 changes 只包含 base_sha 之后的增量
+        self.base_sha = base_sha
+        # diff 超过 REVIEW_MAX_DIFF_BYTES，changes 中只有前面的部分文件
+        self.truncated = truncated
+
+    @property
+    def head_sha(self):
+        return self.info.get('sha')
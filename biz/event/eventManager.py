@@ -2,6 +2,7 @@ from blinker import Signal
 
 from biz.entity.codeReviewEntity import MergeEntity, PushEntity
 from biz.report import notifier
+from biz.utils.reviewHistory import get_review_history_store
 
 # 定义全局事件管理器（事件信号）
 eventManager = {
@@ -28,7 +29,8 @@ def on_merge_request_reviewed(merge_review_entity: MergeEntity):
     """
     notifier.sendReport(content=im_msg, msg_type='markdown', title='Merge Request Review',
                                project_name=merge_review_entity.project_name,
-                               url_slug=merge_review_entity.url_slug)
+                               url_slug=merge_review_entity.url_slug, score=merge_review_entity.score,
+                               url=merge_review_entity.url)
 
 
 
@@ -53,10 +55,39 @@ def on_push_reviewed(entity: PushEntity):
         im_msg += f"#### AI Review 结果: \n {entity.review_result}\n\n"
     notifier.sendReport(content=im_msg, msg_type='markdown',
                                title=f"{entity.project_name} Push Event", project_name=entity.project_name,
-                               url_slug=entity.url_slug)
+                               url_slug=entity.url_slug, score=entity.score,
+                               url=entity.commits[-1].get('url') if entity.commits else None)
 
 
 
+def record_merge_request_history(entity: MergeEntity):
+    # 写入审查历史（后台线程批量写入）
+    get_review_history_store().add(
+        kind='merge_request', url_slug=entity.url_slug, project_name=entity.project_path or entity.project_name,
+        project_id=entity.project_id, author=entity.author,
+        source_branch=entity.source_branch, target_branch=entity.target_branch, url=entity.url,
+        score=entity.score, commit_count=len(entity.commits), prompt_tokens=entity.prompt_tokens,
+        completion_tokens=entity.completion_tokens, duration_seconds=entity.duration, tier=entity.tier,
+        model=entity.model, diff_tokens=entity.diff_tokens, file_count=entity.file_count,
+        review_result=entity.review_result)
+
+
+def record_push_history(entity: PushEntity):
+    # 未开启 PUSH_REVIEW_ENABLED 时没有审查结果，不记录
+    if not entity.review_result:
+        return
+    get_review_history_store().add(
+        kind='push', url_slug=entity.url_slug, project_name=entity.project_path or entity.project_name,
+        project_id=entity.project_id, author=entity.author,
+        source_branch=entity.branch, target_branch=entity.branch, score=entity.score,
+        commit_count=len(entity.commits), prompt_tokens=entity.prompt_tokens,
+        completion_tokens=entity.completion_tokens, duration_seconds=entity.duration, tier=entity.tier,
+        model=entity.model, diff_tokens=entity.diff_tokens, file_count=entity.file_count,
+        review_result=entity.review_result)
+
+
 # 连接事件处理函数到事件信号
 eventManager["merge_request_reviewed"].connect(on_merge_request_reviewed)
+eventManager["merge_request_reviewed"].connect(record_merge_request_history)
 eventManager["push_reviewed"].connect(on_push_reviewed)
+eventManager["push_reviewed"].connect(record_push_history)
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from biz.utils.log import logger
+from biz.utils.metrics import GITLAB_REQUESTS
+
+
+class GitLabClient:
+    """
+    GitLab REST 客户端，同一个 GitLab 实例共享一个带连接池的 Session（keep-alive），
+    避免每次调用都重新进行 TCP+TLS 握手，并对可重试的错误做指数退避重试。
+    """
+
+    def __init__(self, gitlab_url: str, gitlab_token: str, api_version: str = "v4"):
+        self.gitlab_url = gitlab_url
+        self.gitlab_token = gitlab_token
+        self.api_version = api_version
+        self.timeout = (float(os.getenv('GITLAB_CONNECT_TIMEOUT', 5)), float(os.getenv('GITLAB_READ_TIMEOUT', 30)))
+
+        retry = Retry(
+            total=int(os.getenv('GITLAB_MAX_RETRIES', 3)),
+            backoff_factor=float(os.getenv('GITLAB_BACKOFF_FACTOR', 0.5)),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=int(os.getenv('GITLAB_POOL_CONNECTIONS', 4)),
+            pool_maxsize=int(os.getenv('GITLAB_POOL_MAXSIZE', 16)),
+            max_retries=retry,
+        )
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'User-Agent': 'GitLabMCPCodeReview/1.0',
+            'Private-Token': gitlab_token,
+        })
+
+    def api_url(self, endpoint: str) -> str:
+        return urljoin(f"{self.gitlab_url.rstrip('/')}/", f"api/{self.api_version}/{endpoint.lstrip('/')}")
+
+    def request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method.upper(), self.api_url(endpoint), **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            GITLAB_REQUESTS.labels(method=method.upper(), status=status).observe(time.perf_counter() - started_at)
+
+    def get(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('POST', endpoint, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def get_gitlab_client(gitlab_url: str, gitlab_token: str) -> GitLabClient:
+    """按 GitLab 实例（url_slug）和 token 复用客户端；fork 出的子进程不复用父进程的连接"""
+    global _clients_pid
+    from biz.gitlab.gitlabHandler import slugify_url
+
+    key = (slugify_url(gitlab_url), gitlab_token)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # 子进程继承的 socket 与父进程共享，不能继续使用
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            logger.debug(f"Create pooled GitLab client for {key[0]}")
+            client = GitLabClient(gitlab_url, gitlab_token)
+            _clients[key] = client
+        return client
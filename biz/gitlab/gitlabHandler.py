@@ -1,27 +1,51 @@
+import difflib
 import os
 import re
 import time
-from urllib.parse import urljoin
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
+from biz.entity.codeReviewEntity import MergeRequestSnapshot
+from biz.gitlab.gitlabClient import get_gitlab_client
 from biz.utils.log import logger
+from biz.utils.metrics import track_stage
+
+
+class DiffsApiUnavailableError(Exception):
+    """GitLab 版本低于 15.7，没有分页的 /merge_requests/:iid/diffs 接口"""
+
+
+class GitLabRequestError(Exception):
+    """GitLab 接口返回了非预期的状态码"""
 
 
-def filter_changes(changes: list):
+def get_supported_extensions() -> List[str]:
     # 从环境变量中获取支持的文件扩展名
-    supported_extensions = os.getenv('SUPPORTED_EXTENSIONS', '.java,.py,.php').split(',')
+    return os.getenv('SUPPORTED_EXTENSIONS', '.java,.py,.php').split(',')
 
-    filter_deleted_files_changes = [change for change in changes if change.get("deleted_file") == False]
 
-    # 过滤 `new_path` 以支持的扩展名结尾的元素, 仅保留diff和new_path字段
+def is_reviewable_change(change: dict, supported_extensions: List[str] = None) -> bool:
+    """未被删除，且 `new_path` 以支持的扩展名结尾"""
+    supported_extensions = supported_extensions or get_supported_extensions()
+    return not change.get("deleted_file") and any(
+        change.get('new_path', '').endswith(ext) for ext in supported_extensions)
+
+
+def filter_changes(changes: Iterable[dict]) -> list:
+    supported_extensions = get_supported_extensions()
+
+    # 过滤 `new_path` 以支持的扩展名结尾的元素, 仅保留 diff、路径和新建/重命名标记
     filtered_changes = [
         {
             'diff': item.get('diff', ''),
-            'new_path': item['new_path']
+            'new_path': item['new_path'],
+            'old_path': item.get('old_path'),
+            'new_file': item.get('new_file', False),
+            'renamed_file': item.get('renamed_file', False),
         }
-        for item in filter_deleted_files_changes
-        if any(item.get('new_path', '').endswith(ext) for ext in supported_extensions)
+        for item in changes
+        if is_reviewable_change(item, supported_extensions)
     ]
     return filtered_changes
 
@@ -39,6 +63,31 @@ def slugify_url(original_url: str) -> str:
     return target
 
 
+def iter_open_merge_requests(gitlab_url: str, gitlab_token: str, project_id=None, group_id=None,
+                             per_page: int = 100) -> Iterator[dict]:
+    """分页列出项目或群组（包含子群组）中所有打开状态的 MR，每次只请求一页"""
+    if project_id:
+        endpoint = f"projects/{quote(str(project_id), safe='')}/merge_requests"
+    elif group_id:
+        endpoint = f"groups/{quote(str(group_id), safe='')}/merge_requests"
+    else:
+        raise ValueError("project_id 和 group_id 至少需要指定一个")
+    client = get_gitlab_client(gitlab_url, gitlab_token)
+    page = 1
+    while page:
+        response = client.get(endpoint, params={'state': 'opened', 'scope': 'all', 'order_by': 'updated_at',
+                                                'page': page, 'per_page': per_page}, verify=False)
+        logger.debug("List merge requests page %s from GitLab: %s", page, response.status_code)
+        if response.status_code != 200:
+            raise GitLabRequestError(f"{endpoint} page {page}: {response.status_code}, {response.content[:500]}")
+        merge_requests = response.json()
+        next_page = response.headers.get('X-Next-Page')
+        yield from merge_requests
+        if next_page is not None:
+            page = int(next_page) if next_page else 0
+        else:
+            page = page + 1 if len(merge_requests) >= per_page else 0
+
 
 class MergeRequestHandler:
     def __init__(self, webhook_data: dict, gitlab_token: str, gitlab_url: str):
@@ -49,13 +98,17 @@ class MergeRequestHandler:
         self.event_type = None
         self.project_id = None
         self.action = None
+        self._cached_diff_refs = None
+        # 最近一次获取的 diff 是否因超过 REVIEW_MAX_DIFF_BYTES 被截断
+        self.diffs_truncated = False
+        self.client = get_gitlab_client(gitlab_url, gitlab_token)
         self.parse_event_type()
 
     def parse_event_type(self):
         # 提取 event_type
         self.event_type = self.webhook_data.get('object_kind', None)
-        if self.event_type == 'merge_request':
-            self.parse_merge_request_event()
+        # MCP 调用传入的只有 project_id 和 iid（没有 object_kind），同样需要解析，否则增量审查的状态 key 为空
+        self.parse_merge_request_event()
 
     def parse_merge_request_event(self):
         # 提取 Merge Request 的相关参数
@@ -64,7 +117,74 @@ class MergeRequestHandler:
         self.project_id = self.webhook_data.get('project_id')
         self.action = self.webhook_data.get('action')
 
+    @property
+    def project_path(self) -> str:
+        # MCP 调用时 project_id 可能是 "group/project" 形式的路径，需要 URL 编码
+        return quote(str(self.project_id), safe='')
+
+    def get_merge_request_info(self) -> dict:
+        self.merge_request_iid = self.webhook_data.get('iid')
+        self.project_id = self.webhook_data.get('project_id')
+        response = self.client.get(f"projects/{self.project_path}/merge_requests/{self.merge_request_iid}",
+                                   verify=False)
+        logger.debug("Get merge request response from gitlab: %s, %s", response.status_code, response.content)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            logger.warn("Failed to get merge request: %s, %s", response.status_code, response.content)
+            return {}
+
+    def get_merge_request_compare(self, from_sha: str):
+        """获取从 from_sha 到 MR 当前 head 的增量 diff，失败时返回 None"""
+        self.merge_request_iid = self.webhook_data.get('iid')
+        self.project_id = self.webhook_data.get('project_id')
+        params = {'from': from_sha, 'to': f"refs/merge-requests/{self.merge_request_iid}/head"}
+        response = self.client.get(f"projects/{self.project_path}/repository/compare", params=params, verify=False)
+        logger.debug("Get merge request compare response from gitlab: %s, %s", response.status_code, response.content)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            logger.warn("Failed to get compare from %s: %s, %s", from_sha, response.status_code, response.content)
+            return None
+
+    def fetch_merge_request_snapshot(self, since_sha: str = None) -> MergeRequestSnapshot:
+        """
+        并发获取 Merge Request 的元数据、changes 和 commits，组装成一个快照。
+        指定 since_sha 时只获取从该提交到当前 head 的增量 diff；
+        如果增量无法获取或分支被 rebase 过（增量中包含不属于该 MR 的提交），退回到完整的 changes。
+        """
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix='mr-fetch') as executor:
+            info_future = executor.submit(self.get_merge_request_info)
+            commits_future = executor.submit(self.get_merge_request_commits)
+            if since_sha:
+                changes_future = executor.submit(self.get_merge_request_compare, since_sha)
+            else:
+                changes_future = executor.submit(self.get_merge_request_changes)
+            info = info_future.result()
+            commits = commits_future.result()
+            changes = changes_future.result()
+
+        # 以接口返回的最新元数据为准，缺失时保留原始数据
+        merged_info = {**self.webhook_data, **info}
+
+        if since_sha:
+            compare = changes
+            mr_commit_ids = {commit.get('id') for commit in commits}
+            if compare is not None and all(commit.get('id') in mr_commit_ids for commit in compare.get('commits', [])):
+                # 增量 diff 同样受 REVIEW_MAX_DIFF_BYTES 限制，被省略 diff 的文件从 since_sha 开始在本地生成
+                changes, _ = self._collect_changes(iter(compare.pop('diffs', None) or []), base_sha=since_sha)
+                return MergeRequestSnapshot(info=merged_info, changes=changes, commits=commits, base_sha=since_sha,
+                                            truncated=self.diffs_truncated)
+            logger.info(f"无法获取从 {since_sha} 开始的增量 diff，改为完整审查")
+            changes = self.get_merge_request_changes()
+
+        return MergeRequestSnapshot(info=merged_info, changes=changes, commits=commits, truncated=self.diffs_truncated)
+
     def get_merge_request_changes(self) -> list:
+        """
+        获取 Merge Request 中需要审查的文件变更（只保留 filter_changes 会保留的文件）。
+        优先使用分页的 /diffs 接口逐页处理，不支持时退回 /changes 接口。
+        """
         # 检查是否为 Merge Request Hook 事件
         # if self.event_type != 'merge_request':
         #     logger.warn(f"Invalid event type: {self.event_type}. Only 'merge_request' event is supported now.")
@@ -76,32 +196,125 @@ class MergeRequestHandler:
         max_retries = 3  # 最大重试次数
         retry_delay = 10  # 重试间隔时间（秒）
         for attempt in range(max_retries):
-            # 调用 GitLab API 获取 Merge Request 的 changes
-            url = urljoin(f"{self.gitlab_url}/",
-                          f"api/v4/projects/{self.project_id}/merge_requests/{self.merge_request_iid}/changes")
-            headers = {
-                'Private-Token': self.gitlab_token
-            }
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(
-                f"Get changes response from GitLab (attempt {attempt + 1}): {response.status_code}, {response.text}, URL: {url}")
-
-            # 检查请求是否成功
-            if response.status_code == 200:
-                changes = response.json().get('changes', [])
-                if changes:
-                    return changes
-                else:
-                    logger.info(
-                        f"Changes is empty, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries}), URL: {url}")
-                    time.sleep(retry_delay)
-            else:
-                logger.warn(f"Failed to get changes from GitLab (URL: {url}): {response.status_code}, {response.text}")
+            try:
+                changes, total = self._collect_changes(self.iter_merge_request_diffs())
+            except DiffsApiUnavailableError:
+                changes, total = self._collect_changes(self.iter_merge_request_changes())
+            except GitLabRequestError as e:
+                logger.warn(f"Failed to get changes from GitLab: {e}")
                 return []
 
+            # GitLab 生成 diff 有延迟时接口返回空列表；有文件但都被过滤掉时不需要重试
+            if total:
+                return changes
+            logger.info(f"Changes is empty, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries}), "
+                        f"project: {self.project_id}, iid: {self.merge_request_iid}")
+            with track_stage('empty_changes_retry'):
+                time.sleep(retry_delay)
+
         logger.warning(f"Max retries ({max_retries}) reached. Changes is still empty.")
         return []  # 达到最大重试次数后返回空列表
 
+    def iter_merge_request_diffs(self) -> Iterator[dict]:
+        """分页获取文件 diff（GitLab 15.7+ 的 /merge_requests/:iid/diffs），每次只持有一页"""
+        endpoint = f"projects/{self.project_path}/merge_requests/{self.merge_request_iid}/diffs"
+        per_page = int(os.getenv('GITLAB_DIFFS_PER_PAGE', 100))
+        page = 1
+        while page:
+            response = self.client.get(endpoint, params={'page': page, 'per_page': per_page}, verify=False)
+            logger.debug("Get diffs page %s from GitLab: %s, %s", page, response.status_code, response.content)
+            if response.status_code == 404 and page == 1:
+                raise DiffsApiUnavailableError(endpoint)
+            if response.status_code != 200:
+                raise GitLabRequestError(f"{endpoint} page {page}: {response.status_code}, {response.content[:500]}")
+            diffs = response.json()
+            next_page = response.headers.get('X-Next-Page')
+            del response
+            yield from diffs
+            if next_page is not None:
+                page = int(next_page) if next_page else 0
+            else:
+                page = page + 1 if len(diffs) >= per_page else 0
+
+    def iter_merge_request_changes(self) -> Iterator[dict]:
+        """旧版本 GitLab 没有 /diffs 接口，只能一次性获取 /changes（大 MR 会被截断，标记为 overflow）"""
+        endpoint = f"projects/{self.project_path}/merge_requests/{self.merge_request_iid}/changes"
+        response = self.client.get(endpoint, verify=False)
+        logger.debug("Get changes response from GitLab: %s, %s", response.status_code, response.content)
+        if response.status_code != 200:
+            raise GitLabRequestError(f"{endpoint}: {response.status_code}, {response.content[:500]}")
+        data = response.json()
+        if data.get('overflow'):
+            logger.warn(f"Merge request {self.merge_request_iid} 的 changes 超过 GitLab 限制，部分文件的 diff 不完整")
+        yield from data.get('changes', [])
+
+    def _collect_changes(self, diffs: Iterable[dict], base_sha: str = None) -> Tuple[list, int]:
+        """
+        逐个处理文件 diff：不需要审查的文件直接丢弃，diff 因过大被 GitLab 省略的文件单独拉取原文件在本地生成 diff
+        （base_sha 为空时从 MR 的 base 开始）。
+        累计的 diff 超过 REVIEW_MAX_DIFF_BYTES（单个任务的内存上限）时停止获取，并把 diffs_truncated 置为 True。
+        返回 (需要审查的变更, 接口返回的文件总数)。
+        """
+        max_bytes = int(os.getenv('REVIEW_MAX_DIFF_BYTES', 10 * 1024 * 1024))
+        supported_extensions = get_supported_extensions()
+        changes = []
+        total = 0
+        used_bytes = 0
+        self.diffs_truncated = False
+        for change in diffs:
+            total += 1
+            if not is_reviewable_change(change, supported_extensions):
+                continue
+            if change.get('too_large') or change.get('collapsed') or (
+                    not change.get('diff') and not change.get('renamed_file')):
+                change = {**change, 'diff': self._build_raw_diff(change, max_bytes - used_bytes, base_sha)}
+            used_bytes += len(change.get('diff') or '')
+            if used_bytes > max_bytes:
+                logger.warn(f"Merge request {self.merge_request_iid} 的 diff 超过 REVIEW_MAX_DIFF_BYTES={max_bytes}，"
+                            f"从 {change.get('new_path')} 开始的文件不再审查")
+                self.diffs_truncated = True
+                break
+            changes.append(change)
+        return changes, total
+
+    def _diff_refs(self) -> dict:
+        if self._cached_diff_refs is None:
+            self._cached_diff_refs = self.get_merge_request_info().get('diff_refs') or {}
+        return self._cached_diff_refs
+
+    def _get_raw_file(self, path: str, ref: str, limit: int) -> Optional[str]:
+        """读取指定版本的原文件，超过 limit 字节时放弃，返回 None"""
+        endpoint = f"projects/{self.project_path}/repository/files/{quote(path, safe='')}/raw"
+        response = self.client.get(endpoint, params={'ref': ref}, stream=True, verify=False)
+        try:
+            if response.status_code != 200:
+                logger.warn(f"Failed to get raw file {path}@{ref}: {response.status_code}")
+                return None
+            content = bytearray()
+            for block in response.iter_content(chunk_size=64 * 1024):
+                content.extend(block)
+                if len(content) > limit:
+                    logger.warn(f"原文件 {path}@{ref} 超过剩余的 diff 配额 {limit} 字节，跳过")
+                    return None
+            return content.decode('utf-8', errors='replace')
+        finally:
+            response.close()
+
+    def _build_raw_diff(self, change: dict, limit: int, base_sha: str = None) -> str:
+        """GitLab 省略了 diff 的文件：拉取 base（默认为 MR 的 base）和 head 两个版本的原文件，在本地生成 unified diff"""
+        refs = self._diff_refs()
+        base_sha, head_sha = base_sha or refs.get('base_sha'), refs.get('head_sha')
+        if not head_sha or limit <= 0:
+            return ''
+        old_text = '' if change.get('new_file') else self._get_raw_file(change.get('old_path') or change['new_path'],
+                                                                        base_sha, limit)
+        new_text = self._get_raw_file(change['new_path'], head_sha, limit)
+        if old_text is None or new_text is None:
+            return ''
+        diff_lines = difflib.unified_diff(old_text.splitlines(), new_text.splitlines(), lineterm='')
+        # 去掉 ---/+++ 文件头，和 GitLab 返回的 diff 格式保持一致
+        return '\n'.join(line for line in diff_lines if not line.startswith(('---', '+++')))
+
     def get_merge_request_commits(self) -> list:
         # 检查是否为 Merge Request Hook 事件
         # if self.event_type != 'merge_request':
@@ -111,37 +324,29 @@ class MergeRequestHandler:
         logger.warn(
             f"commits----------------------------------------(URL: {self.gitlab_url}): {self.project_id}, {self.merge_request_iid}")
         # 调用 GitLab API 获取 Merge Request 的 commits
-        url = urljoin(f"{self.gitlab_url}/",
-                      f"api/v4/projects/{self.project_id}/merge_requests/{self.merge_request_iid}/commits")
-        headers = {
-            'Private-Token': self.gitlab_token
-        }
-        response = requests.get(url, headers=headers, verify=False)
-        logger.debug(f"Get commits response from gitlab: {response.status_code}, {response.text}")
+        response = self.client.get(f"projects/{self.project_path}/merge_requests/{self.merge_request_iid}/commits",
+                                   verify=False)
+        logger.debug("Get commits response from gitlab: %s, %s", response.status_code, response.content)
         # 检查请求是否成功
         if response.status_code == 200:
             return response.json()
         else:
-            logger.warn(f"Failed to get commits: {response.status_code}, {response.text}")
+            logger.warn("Failed to get commits: %s, %s", response.status_code, response.content)
             return []
 
     def add_merge_request_notes(self, review_result):
-        url = urljoin(f"{self.gitlab_url}/",
-                      f"api/v4/projects/{self.project_id}/merge_requests/{self.merge_request_iid}/notes")
-        headers = {
-            'Private-Token': self.gitlab_token,
-            'Content-Type': 'application/json'
-        }
+        endpoint = f"projects/{self.project_path}/merge_requests/{self.merge_request_iid}/notes"
+        url = self.client.api_url(endpoint)
         data = {
             'body': review_result
         }
-        response = requests.post(url, headers=headers, json=data, verify=False)
-        logger.debug(f"Add notes to gitlab {url}: {response.status_code}, {response.text}")
+        response = self.client.post(endpoint, json=data, verify=False)
+        logger.debug("Add notes to gitlab %s: %s, %s", url, response.status_code, response.content)
         if response.status_code == 201:
             logger.info("Note successfully added to merge request.")
         else:
             logger.error(f"Failed to add note: {response.status_code}")
-            logger.error(response.text)
+            logger.error('%s', response.content)
 
 
 class PushHandler:
@@ -153,6 +358,7 @@ class PushHandler:
         self.project_id = None
         self.branch_name = None
         self.commit_list = []
+        self.client = get_gitlab_client(gitlab_url, gitlab_token)
         self.parse_event_type()
 
     def parse_event_type(self):
@@ -199,39 +405,33 @@ class PushHandler:
             logger.error("Last commit ID not found.")
             return
 
-        url = urljoin(f"{self.gitlab_url}/",
-                      f"api/v4/projects/{self.project_id}/repository/commits/{last_commit_id}/comments")
-        headers = {
-            'Private-Token': self.gitlab_token,
-            'Content-Type': 'application/json'
-        }
         data = {
             'note': message
         }
-        response = requests.post(url, headers=headers, json=data, verify=False)
-        logger.debug(f"Add comment to commit {last_commit_id}: {response.status_code}, {response.text}")
+        response = self.client.post(f"projects/{self.project_id}/repository/commits/{last_commit_id}/comments",
+                                    json=data, verify=False)
+        logger.debug("Add comment to commit %s: %s, %s", last_commit_id, response.status_code, response.content)
         if response.status_code == 201:
             logger.info("Comment successfully added to push commit.")
         else:
             logger.error(f"Failed to add comment: {response.status_code}")
-            logger.error(response.text)
+            logger.error('%s', response.content)
 
     def __repository_commits(self, ref_name: str = "", since: str = "", until: str = "", pre_page: int = 100,
                              page: int = 1):
         # 获取仓库提交信息
-        url = f"{urljoin(f'{self.gitlab_url}/', f'api/v4/projects/{self.project_id}/repository/commits')}?ref_name={ref_name}&since={since}&until={until}&per_page={pre_page}&page={page}"
-        headers = {
-            'Private-Token': self.gitlab_token
-        }
-        response = requests.get(url, headers=headers, verify=False)
-        logger.debug(
-            f"Get commits response from GitLab for repository_commits: {response.status_code}, {response.text}, URL: {url}")
+        endpoint = f"projects/{self.project_id}/repository/commits"
+        params = {'ref_name': ref_name, 'since': since, 'until': until, 'per_page': pre_page, 'page': page}
+        url = self.client.api_url(endpoint)
+        response = self.client.get(endpoint, params=params, verify=False)
+        logger.debug("Get commits response from GitLab for repository_commits: %s, %s, URL: %s",
+                     response.status_code, response.content, url)
 
         if response.status_code == 200:
             return response.json()
         else:
             logger.warn(
-                f"Failed to get commits for ref {ref_name}: {response.status_code}, {response.text}")
+                "Failed to get commits for ref %s: %s, %s", ref_name, response.status_code, response.content)
             return []
 
     def get_parent_commit_id(self, commit_id: str) -> str:
@@ -242,19 +442,17 @@ class PushHandler:
 
     def repository_compare(self, before: str, after: str):
         # 比较两个提交之间的差异
-        url = f"{urljoin(f'{self.gitlab_url}/', f'api/v4/projects/{self.project_id}/repository/compare')}?from={before}&to={after}"
-        headers = {
-            'Private-Token': self.gitlab_token
-        }
-        response = requests.get(url, headers=headers, verify=False)
-        logger.debug(
-            f"Get changes response from GitLab for repository_compare: {response.status_code}, {response.text}, URL: {url}")
+        endpoint = f"projects/{self.project_id}/repository/compare"
+        url = self.client.api_url(endpoint)
+        response = self.client.get(endpoint, params={'from': before, 'to': after}, verify=False)
+        logger.debug("Get changes response from GitLab for repository_compare: %s, %s, URL: %s",
+                     response.status_code, response.content, url)
 
         if response.status_code == 200:
             return response.json().get('diffs', [])
         else:
             logger.warn(
-                f"Failed to get changes for repository_compare: {response.status_code}, {response.text}")
+                "Failed to get changes for repository_compare: %s, %s", response.status_code, response.content)
             return []
 
     def get_push_changes(self) -> list:
@@ -267,9 +465,6 @@ class PushHandler:
         if not self.commit_list:
             logger.info("No commits found in push event.")
             return []
-        headers = {
-            'Private-Token': self.gitlab_token
-        }
 
         # 优先尝试compare API获取变更
         before = self.webhook_data.get('before', '')
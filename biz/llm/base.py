@@ -1,9 +1,50 @@
+import asyncio
+import threading
 from abc import abstractmethod
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, AsyncIterator
 from biz.llm.types import NotGiven, NOT_GIVEN
 from biz.utils.log import logger
 
 
+class LLMError(Exception):
+    """调用 LLM 失败"""
+
+
+class LLMTimeoutError(LLMError):
+    """LLM 首 token 或整体响应超时"""
+
+
+class TokenUsage:
+    """
+    一个审查任务累计的 token 用量，分块并发审查时多个线程同时累加。
+    cache_hit / cache_miss 为 prompt 中命中 / 未命中服务端上下文缓存的 token 数，服务端没有返回时不累加。
+    """
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hit_tokens = 0
+        self.cache_miss_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cache_hit_tokens: int = None,
+            cache_miss_tokens: int = None):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+            self.cache_hit_tokens += cache_hit_tokens or 0
+            self.cache_miss_tokens += cache_miss_tokens or 0
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'cache_hit_tokens': self.cache_hit_tokens,
+                'cache_miss_tokens': self.cache_miss_tokens,
+            }
+
+
 class BaseClient:
 
     def ping(self) -> bool:
@@ -18,6 +59,64 @@ class BaseClient:
     def completions(self,
                     messages: List[Dict[str, str]],
                     model: Optional[str] | NotGiven = NOT_GIVEN,
+                    usage: Optional[TokenUsage] = None,
+                    max_tokens: Optional[int] = None,
                     ) -> str:
         """Chat with the model.
+        usage 不为空时把本次调用的 token 用量累加到其中；max_tokens 为空时不限制输出长度。
         """
+
+    def stream_completions(self,
+                           messages: List[Dict[str, str]],
+                           model: Optional[str] | NotGiven = NOT_GIVEN,
+                           usage: Optional[TokenUsage] = None,
+                           max_tokens: Optional[int] = None,
+                           ) -> Iterator[str]:
+        """Chat with the model, yield the response text as it arrives.
+        默认实现不支持流式，一次性返回完整结果。
+        """
+        yield self.completions(messages=messages, model=model, usage=usage, max_tokens=max_tokens)
+
+    async def acompletions(self,
+                           messages: List[Dict[str, str]],
+                           model: Optional[str] | NotGiven = NOT_GIVEN,
+                           ) -> str:
+        """Async version of completions, runs the blocking call in a thread.
+        """
+        return await asyncio.to_thread(self.completions, messages, model)
+
+    async def astream_completions(self,
+                                  messages: List[Dict[str, str]],
+                                  model: Optional[str] | NotGiven = NOT_GIVEN,
+                                  ) -> AsyncIterator[str]:
+        """Async version of stream_completions, the blocking stream is consumed in a thread.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for delta in self.stream_completions(messages=messages, model=model):
+                    if stop.is_set():
+                        # 调用方提前退出，停止读取剩余的流
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, delta)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            await producer
@@ -1,48 +1,203 @@
 import os
-from typing import Dict, List, Optional
+import re
+import time
+from typing import Dict, Iterator, List, Optional
 
-from openai import OpenAI
 from biz.llm.types import NotGiven, NOT_GIVEN
-from biz.llm.base import BaseClient
+from biz.llm.base import BaseClient, LLMError, LLMTimeoutError, TokenUsage
 from biz.utils.log import logger
+from biz.utils.metrics import LLM_FIRST_TOKEN, LLM_REQUESTS, observe_llm_usage
+from biz.utils.tokenUtil import count_tokens_batch
+
+# 流式输出中出现完整的“总分:XX分”后即可提前结束
+SCORE_LINE_PATTERN = re.compile(r"总分[:：]\s*\d+\s*分")
+
+
+def describe_error(e: Exception) -> str:
+    """把接口异常转换成可读的错误信息"""
+    # 检查是否是认证错误
+    if "401" in str(e):
+        return "DeepSeek API认证失败，请检查API密钥是否正确"
+    elif "404" in str(e):
+        return "DeepSeek API接口未找到，请检查API地址是否正确"
+    return f"调用DeepSeek API时出错: {str(e)}"
 
 
 class DeepSeekClient(BaseClient):
-    def __init__(self, api_key: str = None):
+    """DeepSeek 及其他兼容 OpenAI 接口的服务；不指定参数时从 DEEPSEEK_* 环境变量读取"""
+
+    def __init__(self, api_key: str = None, base_url: str = None, model: str = None):
         self.api_key = api_key or os.getenv("DEEPSEEK_API_KEY")
-        self.base_url = os.getenv("DEEPSEEK_API_BASE_URL", "https://api.deepseek.com")
+        self.base_url = base_url or os.getenv("DEEPSEEK_API_BASE_URL", "https://api.deepseek.com")
         if not self.api_key:
             raise ValueError("API key is required. Please provide it or set it in the environment variables.")
 
+        # openai（连同 httpx）导入耗时较长，创建客户端时才导入，不拖慢服务和 worker 进程的启动
+        from openai import OpenAI
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url) # DeepSeek supports OpenAI API SDK
-        self.default_model = os.getenv("DEEPSEEK_API_MODEL", "deepseek-chat")
+        self.default_model = model or os.getenv("DEEPSEEK_API_MODEL", "deepseek-chat")
+        self.stream = os.getenv("DEEPSEEK_STREAM", "1") == "1"
+        self.stop_after_score = os.getenv("DEEPSEEK_STOP_AFTER_SCORE", "1") == "1"
+        self.first_token_timeout = float(os.getenv("DEEPSEEK_FIRST_TOKEN_TIMEOUT", 60))
+        self.total_timeout = float(os.getenv("DEEPSEEK_TOTAL_TIMEOUT", 300))
+        # 读到总分后继续读取的最长时间（秒），用于拿到最后一个 chunk 中的 usage（包含缓存命中的 token 数）
+        self.usage_grace = float(os.getenv("DEEPSEEK_USAGE_GRACE_SECONDS", 1))
         logger.debug(f"=========DeepSeek API. url: {self.base_url}, key: {self.api_key}, model: {self.default_model}")
 
     def completions(self,
                     messages: List[Dict[str, str]],
                     model: Optional[str] | NotGiven = NOT_GIVEN,
+                    usage: Optional[TokenUsage] = None,
+                    max_tokens: Optional[int] = None,
                     ) -> str:
+        """
+        usage 不为空时把本次调用的 token 用量累加到其中（同一个客户端在进程内的多个任务间共享）。
+        调用失败或返回为空时抛出 LLMError（超时为 LLMTimeoutError），不再把错误信息当作审查结果返回。
+        """
+        model = model or self.default_model
+        logger.debug("Sending request to DeepSeek API. Model: %s, Messages: %s", model, messages)
+        if self.stream:
+            content = "".join(self.stream_completions(messages=messages, model=model, usage=usage,
+                                                      max_tokens=max_tokens))
+        else:
+            content = self._create(messages, model, usage, max_tokens)
+        if not content:
+            logger.error("Empty response from DeepSeek API")
+            raise LLMError("AI服务返回为空，请稍后重试")
+        return content
+
+    def _create(self, messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage],
+                max_tokens: Optional[int]) -> str:
+        import httpx
+        from openai import APITimeoutError
+
+        started_at = time.monotonic()
+        outcome = 'error'
         try:
-            model = model or self.default_model
-            logger.debug(f"Sending request to DeepSeek API. Model: {model}, Messages: {messages}")
-            
             completion = self.client.chat.completions.create(
                 model=model,
-                messages=messages
+                messages=messages,
+                timeout=self.total_timeout,
+                **({'max_tokens': max_tokens} if max_tokens else {}),
             )
-            
-            if not completion or not completion.choices:
-                logger.error("Empty response from DeepSeek API")
-                return "AI服务返回为空，请稍后重试"
-                
-            return completion.choices[0].message.content
-            
+            outcome = 'ok'
+        except (APITimeoutError, httpx.TimeoutException) as e:
+            outcome = 'timeout'
+            raise LLMTimeoutError(f"响应时间超过 {self.total_timeout}s") from e
+        except Exception as e:
+            logger.error(f"DeepSeek API error: {str(e)}")
+            raise LLMError(describe_error(e)) from e
+        finally:
+            LLM_REQUESTS.labels(model=model, outcome=outcome).observe(time.monotonic() - started_at)
+        if completion and completion.usage:
+            self._observe_usage(model, messages, completion.usage, "", usage)
+        if not completion or not completion.choices:
+            return ""
+        return completion.choices[0].message.content
+
+    def stream_completions(self,
+                           messages: List[Dict[str, str]],
+                           model: Optional[str] | NotGiven = NOT_GIVEN,
+                           usage: Optional[TokenUsage] = None,
+                           max_tokens: Optional[int] = None,
+                           ) -> Iterator[str]:
+        """
+        流式读取模型输出。read 超时限制首 token（以及两次输出之间）的等待时间，
+        整体耗时超过 total_timeout 时中断；开启 stop_after_score 时读到总分行后不再输出，
+        最多再读取 usage_grace 秒等待最后的 usage chunk，然后提前结束。
+        """
+        import httpx
+        from openai import APITimeoutError
+
+        model = model or self.default_model
+        started_at = time.monotonic()
+        outcome = 'error'
+        stream_usage = None
+        received = ""
+        stop_at = None
+        try:
+            try:
+                stream = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=httpx.Timeout(self.total_timeout, connect=10, read=self.first_token_timeout),
+                    **({'max_tokens': max_tokens} if max_tokens else {}),
+                )
+            except (APITimeoutError, httpx.TimeoutException) as e:
+                raise LLMTimeoutError(f"等待首个 token 超过 {self.first_token_timeout}s") from e
+
+            try:
+                for chunk in stream:
+                    if time.monotonic() - started_at > self.total_timeout:
+                        raise LLMTimeoutError(f"生成时间超过 {self.total_timeout}s")
+                    if getattr(chunk, 'usage', None):
+                        stream_usage = chunk.usage
+                    if stop_at is not None:
+                        if stream_usage or time.monotonic() > stop_at:
+                            break
+                        continue
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    if not received:
+                        LLM_FIRST_TOKEN.labels(model=model).observe(time.monotonic() - started_at)
+                    received += delta
+                    yield delta
+                    if self.stop_after_score and SCORE_LINE_PATTERN.search(received[-len(delta) - 32:]):
+                        logger.debug("已收到总分，提前结束流式输出")
+                        if self.usage_grace <= 0:
+                            break
+                        stop_at = time.monotonic() + self.usage_grace
+                outcome = 'ok'
+            except (APITimeoutError, httpx.TimeoutException) as e:
+                raise LLMTimeoutError(f"等待模型输出超过 {self.first_token_timeout}s") from e
+            except GeneratorExit:
+                # 调用方主动结束读取
+                outcome = 'ok'
+                raise
+            finally:
+                stream.close()
+        except LLMTimeoutError:
+            outcome = 'timeout'
+            raise
+        except LLMError:
+            raise
         except Exception as e:
             logger.error(f"DeepSeek API error: {str(e)}")
-            # 检查是否是认证错误
-            if "401" in str(e):
-                return "DeepSeek API认证失败，请检查API密钥是否正确"
-            elif "404" in str(e):
-                return "DeepSeek API接口未找到，请检查API地址是否正确"
-            else:
-                return f"调用DeepSeek API时出错: {str(e)}"
+            raise LLMError(describe_error(e)) from e
+        finally:
+            LLM_REQUESTS.labels(model=model, outcome=outcome).observe(time.monotonic() - started_at)
+            self._observe_usage(model, messages, stream_usage, received, usage)
+
+    @staticmethod
+    def _observe_usage(model: str, messages: List[Dict[str, str]], completion_usage, received: str,
+                       usage: Optional[TokenUsage]):
+        """
+        记录 token 用量和上下文缓存命中情况（DeepSeek 返回 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+        OpenAI 兼容接口返回 prompt_tokens_details.cached_tokens）；
+        提前结束流式输出时收不到服务端的 usage，按本地编码估算，不记录缓存命中情况。
+        """
+        cache_hit = cache_miss = None
+        if completion_usage:
+            prompt_tokens, completion_tokens = completion_usage.prompt_tokens, completion_usage.completion_tokens
+            cache_hit = getattr(completion_usage, 'prompt_cache_hit_tokens', None)
+            if cache_hit is None:
+                details = getattr(completion_usage, 'prompt_tokens_details', None)
+                cache_hit = getattr(details, 'cached_tokens', None)
+            if cache_hit is not None:
+                cache_miss = getattr(completion_usage, 'prompt_cache_miss_tokens', None)
+                if cache_miss is None:
+                    cache_miss = prompt_tokens - cache_hit
+        elif received:
+            counts = count_tokens_batch([message["content"] for message in messages] + [received])
+            prompt_tokens, completion_tokens = sum(counts[:-1]), counts[-1]
+        else:
+            return
+        observe_llm_usage(model, prompt_tokens, completion_tokens, cache_hit, cache_miss)
+        if usage is not None:
+            usage.add(prompt_tokens, completion_tokens, cache_hit, cache_miss)
+
@@ -0,0 +1,188 @@
+import fcntl
+import fnmatch
+import json
+import os
+import random
+import time
+
+from biz.llm.base import LLMError
+from biz.utils.log import logger
+
+# 优先级：数值越小越优先
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class LLMRateLimitError(LLMError):
+    """等待 LLM 限流配额超时"""
+
+
+def priority_for_branch(branch: str) -> int:
+    """目标分支命中 LLM_PRIORITY_BRANCHES（支持通配符）时为高优先级"""
+    patterns = [p.strip() for p in os.getenv('LLM_PRIORITY_BRANCHES', 'master,main,release*').split(',') if p.strip()]
+    if branch and any(fnmatch.fnmatch(branch, pattern) for pattern in patterns):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
+def _refill_and_consume(state: dict, now: float, rpm: float, tpm: float, requests: int, tokens: int,
+                        reserve: float) -> tuple:
+    """
+    令牌桶：请求数和 token 数两个桶按每分钟速率连续补充。
+    reserve 为普通优先级任务必须给高优先级任务预留的桶容量比例（预留量不超过桶容量减去本次需求）。
+    返回 (新状态, 需要等待的秒数)，等待秒数为 0 表示已扣减成功。
+    """
+    elapsed = max(0.0, now - state.get('ts', now))
+    level_r = min(rpm, state.get('r', rpm) + elapsed * rpm / 60)
+    level_t = min(tpm, state.get('t', tpm) + elapsed * tpm / 60)
+
+    wait = 0.0
+    if rpm > 0:
+        deficit = requests + min(reserve * rpm, max(0, rpm - requests)) - level_r
+        if deficit > 0:
+            wait = max(wait, deficit * 60 / rpm)
+    if tpm > 0:
+        deficit = tokens + min(reserve * tpm, max(0, tpm - tokens)) - level_t
+        if deficit > 0:
+            wait = max(wait, deficit * 60 / tpm)
+    if wait == 0:
+        level_r -= requests
+        level_t -= tokens
+    return {'r': level_r, 't': level_t, 'ts': now}, wait
+
+
+class FileRateLimiter:
+    """async 模式：同一台机器上的 worker 进程通过文件锁共享令牌桶状态"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def try_acquire(self, rpm: float, tpm: float, requests: int, tokens: int, reserve: float) -> float:
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as f:
+                        state = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    state = {}
+                state, wait = _refill_and_consume(state, time.time(), rpm, tpm, requests, tokens, reserve)
+                with open(self.path, 'w') as f:
+                    json.dump(state, f)
+                return wait
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class RedisRateLimiter:
+    """rq 模式：worker 可能分布在多台机器上，通过 Redis Lua 脚本原子地共享令牌桶状态"""
+
+    SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local rpm = tonumber(ARGV[2])
+    local tpm = tonumber(ARGV[3])
+    local need_r = tonumber(ARGV[4])
+    local need_t = tonumber(ARGV[5])
+    local reserve = tonumber(ARGV[6])
+    local s = redis.call('HMGET', KEYS[1], 'r', 't', 'ts')
+    local ts = tonumber(s[3]) or now
+    local elapsed = math.max(0, now - ts)
+    local r = math.min(rpm, (tonumber(s[1]) or rpm) + elapsed * rpm / 60)
+    local t = math.min(tpm, (tonumber(s[2]) or tpm) + elapsed * tpm / 60)
+    local wait = 0
+    if rpm > 0 then
+        local deficit = need_r + math.min(reserve * rpm, math.max(0, rpm - need_r)) - r
+        if deficit > 0 then wait = math.max(wait, deficit * 60 / rpm) end
+    end
+    if tpm > 0 then
+        local deficit = need_t + math.min(reserve * tpm, math.max(0, tpm - need_t)) - t
+        if deficit > 0 then wait = math.max(wait, deficit * 60 / tpm) end
+    end
+    if wait == 0 then
+        r = r - need_r
+        t = t - need_t
+    end
+    redis.call('HSET', KEYS[1], 'r', tostring(r), 't', tostring(t), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], 3600)
+    return tostring(wait)
+    """
+
+    def __init__(self, connection, key: str):
+        self.key = key
+        self.script = connection.register_script(self.SCRIPT)
+
+    def try_acquire(self, rpm: float, tpm: float, requests: int, tokens: int, reserve: float) -> float:
+        return float(self.script(keys=[self.key], args=[time.time(), rpm, tpm, requests, tokens, reserve]))
+
+
+class RateLimiter:
+    """
+    跨进程的 LLM 限流器，同时限制每分钟请求数（LLM_RPM）和 token 数（LLM_TPM），0 表示不限制。
+    普通优先级的请求不能用掉为高优先级预留的容量（LLM_PRIORITY_RESERVE），且轮询间隔更长。
+    """
+
+    def __init__(self, backend, rpm: float, tpm: float, reserve: float, timeout: float):
+        self.backend = backend
+        self.rpm = rpm
+        self.tpm = tpm
+        self.reserve = reserve
+        self.timeout = timeout
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def _request(self, tokens: int, priority: int) -> tuple:
+        # 单次请求超过桶容量时按桶容量计，避免永远等不到
+        tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+        reserve = self.reserve if priority > PRIORITY_HIGH else 0
+        return tokens, reserve
+
+    def try_acquire(self, tokens: int, priority: int = PRIORITY_NORMAL) -> bool:
+        """不等待：有配额时扣减并返回 True，没有时返回 False"""
+        if not self.enabled:
+            return True
+        tokens, reserve = self._request(tokens, priority)
+        return self.backend.try_acquire(self.rpm, self.tpm, 1, tokens, reserve) <= 0
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL):
+        if not self.enabled:
+            return
+        tokens, reserve = self._request(tokens, priority)
+        poll_interval = 0.5 if priority == PRIORITY_HIGH else 2.0
+        deadline = time.monotonic() + self.timeout
+        while True:
+            wait = self.backend.try_acquire(self.rpm, self.tpm, 1, tokens, reserve)
+            if wait <= 0:
+                return
+            if time.monotonic() + min(wait, poll_interval) > deadline:
+                raise LLMRateLimitError(f"等待 LLM 限流配额超过 {self.timeout}s")
+            logger.debug(f"LLM 限流中，priority={priority}, tokens={tokens}, 预计等待 {wait:.1f}s")
+            time.sleep(min(wait, poll_interval) + random.uniform(0, 0.1))
+
+
+def create_backend(name: str):
+    """按队列驱动创建共享的令牌桶存储，name 区分不同用途的桶（如 llm、某个钉钉 webhook）"""
+    if os.getenv('QUEUE_DRIVER', 'async') == 'rq':
+        from biz.utils.redisUtil import get_redis
+        return RedisRateLimiter(get_redis(), key=f"rate_limit:{name}")
+    return FileRateLimiter(os.path.join(os.getenv('RATE_LIMIT_DIR', 'data/rate_limit'), f"{name}.json"))
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(
+            create_backend('llm'),
+            rpm=float(os.getenv('LLM_RPM', 0)),
+            tpm=float(os.getenv('LLM_TPM', 0)),
+            reserve=float(os.getenv('LLM_PRIORITY_RESERVE', 0.2)),
+            timeout=float(os.getenv('LLM_RATE_LIMIT_TIMEOUT', 600)),
+        )
+    return _rate_limiter
@@ -0,0 +1,301 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from biz.llm.base import BaseClient, LLMError, TokenUsage
+from biz.llm.deepseek import DeepSeekClient
+from biz.llm.rateLimiter import PRIORITY_NORMAL, RateLimiter, get_rate_limiter
+from biz.llm.types import NotGiven, NOT_GIVEN
+from biz.utils.log import logger
+from biz.utils.metrics import LLM_ROUTER_EVENTS, track_stage
+
+
+class Backend:
+    """
+    一个兼容 OpenAI 接口的后端，以及本进程内统计的首 token 延迟（EWMA 和最近样本，用于计算对冲延迟）和错误率（EWMA）。
+    """
+
+    def __init__(self, name: str, client: DeepSeekClient, alpha: float, window: int):
+        self.name = name
+        self.client = client
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.unhealthy_until = 0.0
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_success(self, first_token_latency: float):
+        with self._lock:
+            self.samples.append(first_token_latency)
+            self.latency = first_token_latency if self.latency is None else \
+                self.alpha * first_token_latency + (1 - self.alpha) * self.latency
+            self.error_rate = (1 - self.alpha) * self.error_rate
+
+    def record_failure(self, max_error_rate: float, cooldown: float):
+        with self._lock:
+            self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+            if self.error_rate > max_error_rate:
+                # 熔断：冷却期内不再作为首选，冷却结束后重新探测
+                self.unhealthy_until = time.monotonic() + cooldown
+                self.error_rate = max_error_rate / 2
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self) -> dict:
+        return {'backend': self.name, 'latency': self.latency, 'error_rate': round(self.error_rate, 3),
+                'healthy': self.healthy(), 'samples': len(self.samples)}
+
+
+class _Attempt:
+    """一次发往某个后端的请求；cancel 后在下一个 chunk 处停止读取并关闭连接"""
+
+    def __init__(self, backend: Backend, model: str):
+        self.backend = backend
+        # 本次请求实际使用的模型
+        self.model = model
+        # 在线程池中开始执行的时间：首 token 延迟和对冲延迟都从这里算起，不含排队等待线程的时间
+        self.started_at = None
+        self.started = threading.Event()
+        # 输出了首 token 或请求已结束（成功或失败）
+        self.progressed = threading.Event()
+        self.cancelled = threading.Event()
+        self.future: Optional[Future] = None
+
+
+class RouterClient(BaseClient):
+    """
+    在多个兼容 OpenAI 接口的后端之间路由：按首 token 延迟的 EWMA 选择最快的健康后端，
+    首选后端在 p95 首 token 延迟内还没有输出时，向次优后端发出对冲请求，采用先完成的结果并取消另一个；
+    请求失败时依次切换到其余后端，全部失败时抛出 LLMError。
+    每次向后端发出请求（首选、对冲、切换）前都从 rate_limiter 扣减配额；对冲请求拿不到配额，
+    或线程池已满（对冲请求只能排队，反而更慢）时不发出。
+    """
+
+    def __init__(self, backends: List[Backend], hedge_enabled: bool, hedge_percentile: float,
+                 hedge_min_samples: int, hedge_default_delay: float, max_error_rate: float, cooldown: float,
+                 max_workers: int, rate_limiter: RateLimiter = None):
+        if not backends:
+            raise ValueError("至少需要配置一个 LLM 后端")
+        self.backends = backends
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay = hedge_default_delay
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.rate_limiter = rate_limiter
+        # 第一个配置的后端的模型，只用于展示；实际使用的模型以 route 的返回值为准
+        self.default_model = backends[0].client.default_model
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-router')
+        # 已提交到线程池、尚未结束的请求数
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def ranked_backends(self) -> List[Backend]:
+        """健康的后端按延迟升序（还没有样本的优先，以便尽快测得延迟），熔断中的后端排在最后"""
+        healthy = [b for b in self.backends if b.healthy()]
+        unhealthy = sorted((b for b in self.backends if not b.healthy()), key=lambda b: b.unhealthy_until)
+        return sorted(healthy, key=lambda b: (b.latency is not None, b.latency or 0, b.error_rate)) + unhealthy
+
+    def hedge_delay(self, backend: Backend) -> float:
+        if len(backend.samples) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return backend.percentile(self.hedge_percentile)
+
+    def candidate_models(self, model: Optional[str] = None) -> List[str]:
+        """可能完成请求的模型（按后端排序去重）：指定 model 时只有它，否则为各后端配置的模型"""
+        if model:
+            return [model]
+        return list(dict.fromkeys(backend.client.default_model for backend in self.ranked_backends()))
+
+    def completions(self,
+                    messages: List[Dict[str, str]],
+                    model: Optional[str] | NotGiven = NOT_GIVEN,
+                    usage: Optional[TokenUsage] = None,
+                    max_tokens: Optional[int] = None,
+                    ) -> str:
+        """model 为空时各后端使用自己配置的模型；指定 model 时（例如按改动大小选择的档位）所有后端都使用该模型"""
+        return self.route(messages, model, usage, max_tokens)[0]
+
+    def route(self,
+              messages: List[Dict[str, str]],
+              model: Optional[str] | NotGiven = NOT_GIVEN,
+              usage: Optional[TokenUsage] = None,
+              max_tokens: Optional[int] = None,
+              estimated_tokens: int = 0,
+              priority: int = PRIORITY_NORMAL,
+              ) -> Tuple[str, str]:
+        """
+        同 completions，返回 (结果, 实际完成请求的模型)。
+        estimated_tokens 为单次请求预估的 token 数（输入 + 输出），每个发出的请求都按它扣减限流配额。
+        """
+        limit = (estimated_tokens, priority)
+        candidates = self.ranked_backends()
+        LLM_ROUTER_EVENTS.labels(backend=candidates[0].name, event='selected').inc()
+        attempts = [self._start(candidates.pop(0), messages, model, usage, max_tokens, limit)]
+        last_error = None
+
+        if self.hedge_enabled and candidates:
+            primary = attempts[0]
+            delay = self.hedge_delay(primary.backend)
+            # 首选后端开始执行后，在对冲延迟内既没有输出首 token 也没有结束时，发出对冲请求
+            primary.started.wait()
+            started_at = primary.started_at or time.monotonic()
+            if not primary.progressed.wait(max(0.0, started_at + delay - time.monotonic())):
+                backend = candidates[0]
+                if not self._has_free_worker():
+                    logger.info(f"LLM 后端 {primary.backend.name} {delay:.1f}s 内没有输出，线程池已满，不发出对冲请求")
+                    LLM_ROUTER_EVENTS.labels(backend=backend.name, event='hedge_saturated').inc()
+                elif self.rate_limiter and not self.rate_limiter.try_acquire(estimated_tokens, priority):
+                    # 对冲只为降低延迟，限流配额不足时不发出，免得挤占其它任务的配额
+                    logger.info(f"LLM 后端 {primary.backend.name} {delay:.1f}s 内没有输出，限流配额不足，不发出对冲请求")
+                    LLM_ROUTER_EVENTS.labels(backend=backend.name, event='hedge_throttled').inc()
+                else:
+                    candidates.pop(0)
+                    logger.info(f"LLM 后端 {primary.backend.name} {delay:.1f}s 内没有输出，向 {backend.name} 发出对冲请求")
+                    LLM_ROUTER_EVENTS.labels(backend=backend.name, event='hedged').inc()
+                    attempts.append(self._start(backend, messages, model, usage, max_tokens))
+
+        while attempts:
+            done, _ = wait([attempt.future for attempt in attempts], return_when=FIRST_COMPLETED)
+            for attempt in [a for a in attempts if a.future in done]:
+                attempts.remove(attempt)
+                try:
+                    content = attempt.future.result()
+                except LLMError as e:
+                    last_error = e
+                    logger.warn(f"LLM 后端 {attempt.backend.name} 调用失败: {e}")
+                    LLM_ROUTER_EVENTS.labels(backend=attempt.backend.name, event='error').inc()
+                    if not attempts and candidates:
+                        backend = candidates.pop(0)
+                        LLM_ROUTER_EVENTS.labels(backend=backend.name, event='failover').inc()
+                        attempts.append(self._start(backend, messages, model, usage, max_tokens, limit))
+                    continue
+                LLM_ROUTER_EVENTS.labels(backend=attempt.backend.name, event='won').inc()
+                for other in attempts:
+                    other.cancelled.set()
+                return content, attempt.model
+        raise last_error or LLMError("没有可用的 LLM 后端")
+
+    def _start(self, backend: Backend, messages: List[Dict[str, str]], model, usage: Optional[TokenUsage],
+               max_tokens: Optional[int], limit: Tuple[int, int] = None) -> _Attempt:
+        """limit 为 (预估 token 数, 优先级) 时先等待限流配额再发出请求，为空时表示配额已经扣减"""
+        if limit and self.rate_limiter:
+            with track_stage('rate_limit_wait'):
+                self.rate_limiter.acquire(*limit)
+        attempt = _Attempt(backend, model or backend.client.default_model)
+        with self._in_flight_lock:
+            self._in_flight += 1
+        attempt.future = self._executor.submit(self._run, attempt, messages, usage, max_tokens)
+        attempt.future.add_done_callback(lambda _: self._finish(attempt))
+        return attempt
+
+    def _finish(self, attempt: _Attempt):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+        attempt.started.set()
+        attempt.progressed.set()
+
+    def _has_free_worker(self) -> bool:
+        with self._in_flight_lock:
+            return self._in_flight < self.max_workers
+
+    def _run(self, attempt: _Attempt, messages: List[Dict[str, str]], usage: Optional[TokenUsage],
+             max_tokens: Optional[int]) -> str:
+        backend = attempt.backend
+        client = backend.client
+        attempt.started_at = time.monotonic()
+        attempt.started.set()
+        try:
+            if not client.stream:
+                content = client.completions(messages=messages, model=attempt.model, usage=usage,
+                                             max_tokens=max_tokens)
+            else:
+                received = []
+                stream = client.stream_completions(messages=messages, model=attempt.model, usage=usage,
+                                                   max_tokens=max_tokens)
+                try:
+                    for delta in stream:
+                        if not received:
+                            attempt.progressed.set()
+                            backend.record_success(time.monotonic() - attempt.started_at)
+                        if attempt.cancelled.is_set():
+                            break
+                        received.append(delta)
+                finally:
+                    stream.close()
+                content = "".join(received)
+                if not content and not attempt.cancelled.is_set():
+                    raise LLMError(f"LLM 后端 {backend.name} 返回为空")
+        except LLMError:
+            backend.record_failure(self.max_error_rate, self.cooldown)
+            raise
+        except Exception as e:
+            backend.record_failure(self.max_error_rate, self.cooldown)
+            raise LLMError(f"LLM 后端 {backend.name} 调用失败: {e}") from e
+        if not client.stream:
+            backend.record_success(time.monotonic() - attempt.started_at)
+        return content
+
+    def stats(self) -> List[dict]:
+        return [backend.stats() for backend in self.backends]
+
+
+def load_backends() -> List[Backend]:
+    """
+    LLM_BACKENDS 为逗号分隔的后端名称，每个后端通过 LLM_BACKEND_<NAME>_BASE_URL / _API_KEY / _MODEL 配置，
+    未配置的项使用 DEEPSEEK_* 的值；不配置 LLM_BACKENDS 时只有一个使用 DEEPSEEK_* 配置的后端。
+    """
+    alpha = float(os.getenv('LLM_ROUTER_EWMA_ALPHA', 0.2))
+    window = int(os.getenv('LLM_ROUTER_LATENCY_WINDOW', 200))
+    names = [name.strip() for name in os.getenv('LLM_BACKENDS', '').split(',') if name.strip()]
+    if not names:
+        return [Backend('deepseek', DeepSeekClient(), alpha, window)]
+    backends = []
+    for name in names:
+        prefix = f"LLM_BACKEND_{name.upper()}_"
+        client = DeepSeekClient(api_key=os.getenv(prefix + 'API_KEY'), base_url=os.getenv(prefix + 'BASE_URL'),
+                                model=os.getenv(prefix + 'MODEL'))
+        backends.append(Backend(name, client, alpha, window))
+    return backends
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> RouterClient:
+    """
+    进程内共享一个路由客户端（各后端的连接池、延迟和错误率统计在各个任务间复用）；
+    fork 出的子进程不复用父进程的连接和线程池，重新创建。
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = RouterClient(
+                load_backends(),
+                hedge_enabled=os.getenv('LLM_ROUTER_HEDGE_ENABLED', '1') == '1',
+                hedge_percentile=float(os.getenv('LLM_ROUTER_HEDGE_PERCENTILE', 0.95)),
+                hedge_min_samples=int(os.getenv('LLM_ROUTER_HEDGE_MIN_SAMPLES', 20)),
+                hedge_default_delay=float(os.getenv('LLM_ROUTER_HEDGE_DELAY', 10)),
+                max_error_rate=float(os.getenv('LLM_ROUTER_MAX_ERROR_RATE', 0.5)),
+                cooldown=float(os.getenv('LLM_ROUTER_COOLDOWN', 30)),
+                max_workers=int(os.getenv('LLM_ROUTER_MAX_WORKERS', 16)),
+                rate_limiter=get_rate_limiter(),
+            )
+            _client_pid = os.getpid()
+        return _client
@@ -0,0 +1,71 @@
+"""
+rq 模式的 worker 入口：启动时预加载并预热 worker 用到的模块（openai、tiktoken 的 BPE 文件、prompt、分档策略），
+默认的 Worker 为每个任务 fork 的子进程直接继承预热后的内存，不必在第一个任务中付出导入和加载成本；
+队列、限流和 MR 事件代数共用一个 Redis 连接池。
+
+    python -m biz.queue.rqWorker --with-scheduler                  # 监听 WORKER_QUEUE（或 GITLAB_URL 对应）的队列
+    python -m biz.queue.rqWorker gitlab_example_com --simple       # 不 fork，在当前进程中执行任务
+"""
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+
+
+def warm_up():
+    """导入 worker 和使用时才导入的依赖，并触发各个模块的懒加载，fork 模式下子进程通过写时复制共享这些内存"""
+    import openai  # noqa: F401  创建 LLM 客户端时才导入，这里提前导入（连同 httpx）
+    import yaml  # noqa: F401  钉钉 webhook 路由文件
+
+    from biz.queue import worker  # noqa: F401
+    from biz.utils.codeReview import load_prompts
+    from biz.utils.reviewTier import get_tiering_policy
+    from biz.utils.tokenUtil import count_tokens
+
+    count_tokens("warm up")  # 加载 tiktoken 的 BPE 文件
+    load_prompts()
+    get_tiering_policy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='预热后的 rq worker，执行 QUEUE_DRIVER=rq 时提交的审查任务')
+    parser.add_argument('queues', nargs='*',
+                        help='监听的队列（GitLab 地址的 slug），默认为 WORKER_QUEUE（逗号分隔）或 GITLAB_URL 对应的队列')
+    parser.add_argument('--simple', action='store_true',
+                        help='不为每个任务 fork 子进程，连接池、日志和审查历史的后台线程在任务间复用')
+    parser.add_argument('--with-scheduler', action='store_true', help='同时执行延迟任务（REVIEW_DEBOUNCE_SECONDS 大于 0 时需要）')
+    parser.add_argument('--burst', action='store_true', help='队列为空时退出')
+    parser.add_argument('--max-jobs', type=int, help='执行指定数量的任务后退出，由进程管理器重新拉起')
+    parser.add_argument('--name', help='worker 名称')
+    args = parser.parse_args(argv)
+
+    # 需在导入 biz 模块之前设置：日志、审查历史和钉钉推送按 worker 是否 fork 决定是否同步写出
+    load_dotenv("conf/.env")
+    os.environ['QUEUE_DRIVER'] = 'rq'
+    os.environ['RQ_WORKER_MODE'] = 'simple' if args.simple else 'fork'
+
+    from rq import SimpleWorker, Worker
+
+    from biz.gitlab.gitlabHandler import slugify_url
+    from biz.utils.log import logger
+    from biz.utils.queue import get_rq_queue
+    from biz.utils.redisUtil import get_redis
+
+    names = args.queues or [name.strip() for name in os.getenv('WORKER_QUEUE', '').split(',') if name.strip()]
+    if not names and os.getenv('GITLAB_URL'):
+        names = [slugify_url(os.environ['GITLAB_URL'])]
+    if not names:
+        parser.error('需要指定队列名称，或在环境变量中配置 WORKER_QUEUE 或 GITLAB_URL')
+
+    started_at = time.monotonic()
+    warm_up()
+    logger.info(f"rq worker 预热完成，耗时 {time.monotonic() - started_at:.2f}s，监听队列: {', '.join(names)}")
+
+    worker_class = SimpleWorker if args.simple else Worker
+    worker = worker_class([get_rq_queue(name) for name in names], connection=get_redis(), name=args.name)
+    worker.work(with_scheduler=args.with_scheduler, burst=args.burst, max_jobs=args.max_jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,111 +1,292 @@
 import os
+import time
 import traceback
 from datetime import datetime
+from urllib.parse import urlparse
 
 from biz.entity.codeReviewEntity import MergeEntity, PushEntity
 from biz.event.eventManager import eventManager
 from biz.gitlab.gitlabHandler import filter_changes, MergeRequestHandler, PushHandler
+from biz.llm.base import LLMError, TokenUsage
+from biz.llm.rateLimiter import priority_for_branch
 from biz.utils.codeReview import CodeReviewer
 from biz.report import notifier
+from biz.utils.coalesce import coalesce_key, is_superseded
+from biz.utils.diffPreprocess import preprocess_changes
+from biz.utils.jobStatus import get_job_status_store, STATUS_DONE, STATUS_FAILED, STATUS_SKIPPED, STATUS_SUPERSEDED
 from biz.utils.log import logger
+from biz.utils.metrics import DIFF_CHARS, DIFF_TOKENS, track_job, track_stage
+from biz.utils.reviewState import get_review_state_store, summarize_review
 
 
+# 入队时只保留 worker 实际读取的字段（MR 的其余信息在 worker 中从 GitLab 接口获取），减小任务在 Redis 中的体积
+MERGE_REQUEST_FIELDS = ('object_kind', 'action', 'project_id', 'iid')
+PUSH_FIELDS = ('event_name', 'ref', 'before', 'after', 'user_username')
+PUSH_PROJECT_FIELDS = ('id', 'name', 'path_with_namespace', 'default_branch')
+PUSH_COMMIT_FIELDS = ('id', 'message', 'timestamp', 'url')
 
+
+def trim_merge_request_payload(data: dict) -> dict:
+    return {key: data[key] for key in MERGE_REQUEST_FIELDS if key in data}
+
+
+def trim_push_payload(data: dict) -> dict:
+    """去掉 push 事件中每个提交的 added / modified / removed 文件列表等 worker 用不到的字段"""
+    payload = {key: data[key] for key in PUSH_FIELDS if key in data}
+    project = data.get('project') or {}
+    payload['project'] = {key: project[key] for key in PUSH_PROJECT_FIELDS if key in project}
+    payload['commits'] = [{
+        **{key: commit[key] for key in PUSH_COMMIT_FIELDS if key in commit},
+        'author': {'name': (commit.get('author') or {}).get('name')},
+    } for commit in data.get('commits', [])]
+    return payload
+
+
+def _merge_request_project_path(merge_request: dict) -> str:
+    """MR 所在项目的路径（group/project）：优先取 references.full（group/project!iid），否则从 web_url 中截取"""
+    full = (merge_request.get('references') or {}).get('full') or ''
+    if '!' in full:
+        return full.rsplit('!', 1)[0]
+    return urlparse(merge_request.get('web_url') or '').path.strip('/').split('/-/')[0] or None
+
+
+def _preprocess_changes(changes: list) -> tuple:
+    """精简 diff 并记录本次任务精简前后的 diff 大小，返回 (精简后的变更, 每个文件的 token 数)"""
+    with track_stage('preprocess'):
+        changes, stats = preprocess_changes(changes)
+    DIFF_CHARS.labels(kind='raw').inc(stats['raw_chars'])
+    DIFF_CHARS.labels(kind='compact').inc(stats['compact_chars'])
+    DIFF_TOKENS.labels(kind='compact').inc(stats['compact_tokens'])
+    logger.info('diff 预处理: 审查 %s/%s 个文件, 跳过 %s, 丢弃纯空白 hunk %s 个, 字符数 %s -> %s, tokens %s',
+                stats['reviewed_files'], stats['files'], stats['skipped'], stats['dropped_hunks'],
+                stats['raw_chars'], stats['compact_chars'], stats['compact_tokens'])
+    return changes, stats['token_counts']
+
+
+def _log_usage(usage: TokenUsage):
+    """记录本次任务的 token 用量，以及 prompt 命中 DeepSeek 上下文缓存的比例"""
+    if not usage.prompt_tokens:
+        return
+    cached = usage.cache_hit_tokens + usage.cache_miss_tokens
+    hit_rate = f"{usage.cache_hit_tokens / cached:.0%}" if cached else 'unknown'
+    logger.info('token 用量: prompt %s (缓存命中 %s, 未命中 %s, 命中率 %s), completion %s',
+                usage.prompt_tokens, usage.cache_hit_tokens, usage.cache_miss_tokens, hit_rate,
+                usage.completion_tokens)
+
+
+def _tier_fields(reviewer: CodeReviewer) -> dict:
+    """本次审查的模型档位和选档依据，随审查结果写入历史"""
+    return {
+        'tier': reviewer.tier.name,
+        'model': reviewer.model,
+        'diff_tokens': reviewer.decision.diff_tokens,
+        'file_count': reviewer.decision.file_count,
+    }
+
+
+@track_job('push')
 def handle_push_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gitlab_url_slug: str):
     push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
+    started_at = time.monotonic()
     try:
         handler = PushHandler(webhook_data, gitlab_token, gitlab_url)
         logger.info('Push Hook event received')
-        commits = handler.get_push_commits()
+        with track_stage('gitlab_fetch'):
+            commits = handler.get_push_commits()
         if not commits:
             logger.error('Failed to get commits')
             return
 
         review_result = None
         score = 0
+        usage = TokenUsage()
+        reviewer = None
         if push_review_enabled:
             # 获取PUSH的changes
-            changes = handler.get_push_changes()
+            with track_stage('gitlab_fetch'):
+                changes = handler.get_push_changes()
             logger.info('changes: %s', changes)
-            changes = filter_changes(changes)
+            changes, token_counts = _preprocess_changes(filter_changes(changes))
             if not changes:
                 logger.info('未检测到PUSH代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
             review_result = "关注的文件没有修改"
 
             if len(changes) > 0:
                 commits_text = ';'.join(commit.get('message', '').strip() for commit in commits)
-                review_result = CodeReviewer().review_and_strip_code(str(changes), commits_text)
+                priority = priority_for_branch(handler.branch_name)
+                reviewer = CodeReviewer(priority=priority)
+                review_result = reviewer.review_changes(changes, commits_text, target_branch=handler.branch_name,
+                                                        token_counts=token_counts)
                 score = CodeReviewer.parse_review_score(review_text=review_result)
+                usage = reviewer.usage
+                _log_usage(usage)
             # 将review结果提交到Gitlab的 notes
-            handler.add_push_notes(f'Auto Review Result: \n{review_result}')
+            with track_stage('post_note'):
+                handler.add_push_notes(f'Auto Review Result: \n{review_result}')
 
         eventManager['push_reviewed'].send(PushEntity(
             project_name=webhook_data['project']['name'],
+            project_id=webhook_data['project'].get('id'),
+            project_path=webhook_data['project'].get('path_with_namespace'),
             author=webhook_data['user_username'],
-            branch=webhook_data['project']['default_branch'],
+            branch=handler.branch_name or webhook_data['project'].get('default_branch'),
             updated_at=int(datetime.now().timestamp()),  # 当前时间
             commits=commits,
             score=score,
             review_result=review_result,
             url_slug=gitlab_url_slug,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            duration=time.monotonic() - started_at,
+            **(_tier_fields(reviewer) if reviewer else {}),
         ))
 
+    except LLMError as e:
+        # 所有 LLM 后端都调用失败时不发布审查结果
+        notifier.sendReport(content=f'Push 代码审查调用 LLM 失败: {e}')
+        logger.error('调用 LLM 失败: %s', e)
     except Exception as e:
         error_message = f'服务出现未知错误: {str(e)}\n{traceback.format_exc()}'
         notifier.sendReport(content=error_message)
         logger.error('出现未知错误: %s', error_message)
+    finally:
+        notifier.flush_if_ephemeral()
 
 
-def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gitlab_url_slug: str):
+@track_job('merge_request')
+def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gitlab_url_slug: str,
+                               generation: int = None, review_job_id: str = None, force: bool = False):
+    """
+    review_job_id 不为空时（通过 MCP 提交的任务）记录各阶段的进度和最终结果（不叫 job_id：rq 入队时会把 job_id 当作
+    rq 自己的任务 ID 取走，传不到这里）；
+    force 为 True 时忽略上次审查的状态，对 MR 做完整审查（例如修改 prompt 后重新评分）。
+    """
+    started_at = time.monotonic()
+    jobs = get_job_status_store()
     try:
         # 解析Webhook数据
         handler = MergeRequestHandler(webhook_data, gitlab_token, gitlab_url)
         logger.info('Merge Request Hook event received')
 
+        # 同一个 MR 有更新的事件时，排队中/执行中的旧任务直接放弃
+        mr_key = coalesce_key(gitlab_url_slug, webhook_data.get('project_id'), webhook_data.get('iid'))
+        if is_superseded(mr_key, generation):
+            jobs.update(review_job_id, status=STATUS_SUPERSEDED, message='同一个 MR 有更新的事件')
+            return
+
         # if handler.action not in ['open', 'update']:
         #     logger.info(f"Merge Request Hook event, action={handler.action}, ignored.")
         #     return
 
+        # 增量审查：只审查上次审查过的 head 之后的变更
+        incremental_enabled = os.environ.get('INCREMENTAL_REVIEW_ENABLED', '1') == '1'
+        state_store = get_review_state_store()
+        state_key = (gitlab_url_slug, handler.project_id, handler.merge_request_iid)
+        last_state = state_store.get(*state_key) if incremental_enabled and not force else None
+
         # 仅仅在MR创建或更新时进行Code Review
-        # 获取Merge Request的changes
-        changes = handler.get_merge_request_changes()
+        # 并发获取Merge Request的元数据、changes和commits
+        jobs.update(review_job_id, stage='gitlab_fetch')
+        with track_stage('gitlab_fetch'):
+            snapshot = handler.fetch_merge_request_snapshot(since_sha=last_state['head_sha'] if last_state else None)
+        webhook_data = snapshot.info
+        if 'web_url' not in webhook_data:
+            logger.error(f"Merge request {handler.merge_request_iid} not found in project {handler.project_id}")
+            jobs.update(review_job_id, status=STATUS_FAILED, message='Merge request not found')
+            return
+        if last_state and snapshot.head_sha == last_state['head_sha']:
+            logger.info(f"Merge request 的 head {snapshot.head_sha} 已审查过，跳过")
+            jobs.update(review_job_id, status=STATUS_SKIPPED, message=f'head {snapshot.head_sha} 已审查过',
+                        score=last_state['score'], url=webhook_data['web_url'])
+            return
+
+        changes = snapshot.changes
         logger.info('changes: %s', changes)
-        changes = filter_changes(changes)
+        jobs.update(review_job_id, stage='preprocess')
+        changes, token_counts = _preprocess_changes(filter_changes(changes))
         if not changes:
             logger.info('未检测到有关代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
+            if snapshot.base_sha and snapshot.head_sha:
+                state_store.save(*state_key, head_sha=snapshot.head_sha, summary=last_state['summary'],
+                                 score=last_state['score'])
+            jobs.update(review_job_id, status=STATUS_SKIPPED, message='没有需要审查的文件', url=webhook_data['web_url'])
             return
 
-        # 获取Merge Request的commits
-        commits = handler.get_merge_request_commits()
+        commits = snapshot.commits
         if not commits:
             logger.error('Failed to get commits')
+            jobs.update(review_job_id, status=STATUS_FAILED, message='Failed to get commits')
+            return
+
+        if is_superseded(mr_key, generation):
+            jobs.update(review_job_id, status=STATUS_SUPERSEDED, message='同一个 MR 有更新的事件')
             return
 
         # review 代码
         commits_text = ';'.join(commit['title'] for commit in commits)
-        review_result = CodeReviewer().review_and_strip_code(str(changes), commits_text)
+        previous_summary = last_state['summary'] if snapshot.base_sha else ""
+        if previous_summary:
+            logger.info(f"增量审查: {snapshot.base_sha} -> {snapshot.head_sha}")
+        priority = priority_for_branch(webhook_data.get('target_branch'))
+        jobs.update(review_job_id, stage='llm')
+        reviewer = CodeReviewer(priority=priority)
+        review_result = reviewer.review_changes(changes, commits_text, previous_summary,
+                                                target_branch=webhook_data.get('target_branch'),
+                                                token_counts=token_counts)
+        score = CodeReviewer.parse_review_score(review_text=review_result)
+        _log_usage(reviewer.usage)
+        if is_superseded(mr_key, generation):
+            jobs.update(review_job_id, status=STATUS_SUPERSEDED, message='同一个 MR 有更新的事件')
+            return
 
         # 将review结果提交到Gitlab的 notes
-        handler.add_merge_request_notes(f'Auto Review Result: \n{review_result}')
+        jobs.update(review_job_id, stage='post_note')
+        note = f'Auto Review Result: \n{review_result}'
+        if snapshot.truncated:
+            note += "\n\n> 变更的 diff 超过 REVIEW_MAX_DIFF_BYTES，超出部分的文件没有审查"
+        with track_stage('post_note'):
+            handler.add_merge_request_notes(note)
+
+        # 记录本次审查到的 head，下次只审查增量（调用失败没有得分时不记录）
+        if snapshot.head_sha and score > 0:
+            max_chars = int(os.environ.get('INCREMENTAL_SUMMARY_MAX_CHARS', 1500))
+            state_store.save(*state_key, head_sha=snapshot.head_sha,
+                             summary=summarize_review(review_result, score, max_chars), score=score)
+        jobs.update(review_job_id, stage='done', status=STATUS_DONE, score=score, url=webhook_data['web_url'],
+                    review_result=review_result)
 
         # dispatch merge_request_reviewed event
         eventManager['merge_request_reviewed'].send(
             MergeEntity(
                 project_name=webhook_data['title'],
+                project_id=webhook_data.get('project_id', handler.project_id),
+                project_path=_merge_request_project_path(webhook_data),
                 author=webhook_data['author']['username'],
                 source_branch=webhook_data['source_branch'],
                 target_branch=webhook_data['target_branch'],
                 updated_at=webhook_data['merged_at'],
                 commits=commits,
-                score=CodeReviewer.parse_review_score(review_text=review_result),
+                score=score,
                 url=webhook_data['web_url'],
                 review_result=review_result,
                 url_slug=gitlab_url_slug,
+                prompt_tokens=reviewer.usage.prompt_tokens,
+                completion_tokens=reviewer.usage.completion_tokens,
+                duration=time.monotonic() - started_at,
+                **_tier_fields(reviewer),
             )
         )
 
+    except LLMError as e:
+        # 所有 LLM 后端都调用失败时不把错误信息当作审查结果发布到 MR
+        jobs.update(review_job_id, status=STATUS_FAILED, message=str(e))
+        notifier.sendReport(content=f'AI Code Review 调用 LLM 失败: {e}')
+        logger.error('调用 LLM 失败: %s', e)
     except Exception as e:
         error_message = f'AI Code Review 服务出现未知错误: {str(e)}\n{traceback.format_exc()}'
+        jobs.update(review_job_id, status=STATUS_FAILED, message=str(e))
         notifier.sendReport(content=error_message)
         logger.error('出现未知错误: %s', error_message)
+    finally:
+        notifier.flush_if_ephemeral()
 
@@ -0,0 +1,241 @@
+import atexit
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import deque, OrderedDict
+
+from biz.llm.rateLimiter import create_backend
+from biz.report.dingtalk import DingTalkNotifier
+from biz.utils.log import logger
+from biz.utils.metrics import track_stage
+
+# 被钉钉限流时等待一个完整的限流窗口（秒），其它错误的指数退避也不超过这个时间
+MAX_BACKOFF = 60
+# 退避结束后发送一次所需的最长时间（请求超时 10 秒）
+SEND_GRACE = 10
+
+
+class PendingMessage:
+    def __init__(self, webhook_url: str, message: dict, title: str, project_name: str, summary: str,
+                 score=None, url: str = None):
+        self.webhook_url = webhook_url
+        self.message = message
+        self.title = title
+        self.project_name = project_name
+        self.summary = summary
+        self.score = score
+        self.url = url
+        self.attempts = 0
+
+
+def _digest_line(item: PendingMessage) -> str:
+    line = f"- {item.summary}"
+    if item.score is not None:
+        line += f"，得分: {item.score}"
+    if item.url:
+        line += f"，[查看详情]({item.url})"
+    return line + "\n"
+
+
+def build_digest(messages: list) -> dict:
+    """把积压的多条消息合并成一条摘要，例如“项目 X: 12 条审查报告”，每条保留得分和详情链接"""
+    projects = OrderedDict()
+    for item in messages:
+        projects.setdefault(item.project_name or '未指定项目', []).append(item)
+
+    text = f"### 代码审查报告汇总（{len(messages)} 条）\n"
+    for project_name, items in projects.items():
+        text += f"\n#### {project_name}: {len(items)} 条审查报告\n"
+        text += "".join(_digest_line(item) for item in items)
+    return DingTalkNotifier.build_message(text, msg_type='markdown', title=f"{len(messages)} 条代码审查报告")
+
+
+class DingTalkDelivery:
+    """
+    异步钉钉发送：调用方只负责入队，由后台线程按 webhook 限流发送（跨进程共享令牌桶）。
+    触发限流（本地令牌桶或钉钉返回限流）后积压达到 digest_threshold 条时合并成一条摘要消息；
+    发送失败（包括连接异常）按次数退避重试，超过 max_retries 次后丢弃。
+    """
+
+    def __init__(self, rate_per_minute: float, digest_threshold: int, max_retries: int):
+        self.rate_per_minute = rate_per_minute
+        self.digest_threshold = digest_threshold
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._retry_at = {}
+        self._throttled = set()
+        self._backends = {}
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # fork 出的子进程中不存在父进程的后台线程，需要重新启动
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pending = {}
+                self._retry_at = {}
+                self._throttled = set()
+                self._outstanding = 0
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='dingtalk-delivery', daemon=True)
+                self._thread.start()
+
+    def submit(self, webhook_url: str, message: dict, title: str = None, project_name: str = None,
+               summary: str = None, score=None, url: str = None):
+        self._ensure_started()
+        with self._lock:
+            self._outstanding += 1
+        self._queue.put(PendingMessage(webhook_url, message, title, project_name, summary or title or '', score, url))
+
+    def flush(self, timeout: float = 30) -> bool:
+        """
+        等待已入队的消息发送完成，超时返回 False 并记录未发出的消息数。
+        到 timeout 时仍有消息在退避（被限流或发送失败后等待重试）时，继续等到这次重试结束，
+        最多再等 MAX_BACKOFF + SEND_GRACE 秒，避免被限流的消息和摘要在进程退出时丢失。
+        """
+        deadline = time.monotonic() + timeout
+        hard_deadline = deadline + MAX_BACKOFF + SEND_GRACE
+        while True:
+            with self._lock:
+                outstanding = self._outstanding
+            if outstanding <= 0:
+                return True
+            retry_at = max(list(self._retry_at.values()), default=0)
+            if time.monotonic() >= min(max(deadline, retry_at + SEND_GRACE), hard_deadline):
+                break
+            time.sleep(0.05)
+        logger.error(f"等待钉钉消息发送超时，{outstanding} 条消息未发出")
+        return False
+
+    def _done(self, count: int):
+        with self._lock:
+            self._outstanding -= count
+
+    def _backend(self, webhook_url: str):
+        backend = self._backends.get(webhook_url)
+        if backend is None:
+            name = 'dingtalk_' + hashlib.md5(webhook_url.encode('utf-8')).hexdigest()
+            backend = self._backends[webhook_url] = create_backend(name)
+        return backend
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.2 if self._pending else None)
+                self._pending.setdefault(item.webhook_url, deque()).append(item)
+                while True:
+                    item = self._queue.get_nowait()
+                    self._pending.setdefault(item.webhook_url, deque()).append(item)
+            except queue.Empty:
+                pass
+
+            for webhook_url in list(self._pending):
+                try:
+                    self._deliver(webhook_url)
+                except Exception as e:
+                    logger.error(f"钉钉消息发送异常: {e}")
+                    pending = self._pending[webhook_url]
+                    if pending:
+                        self._fail(webhook_url, [pending[0]], False)
+                if not self._pending.get(webhook_url):
+                    self._pending.pop(webhook_url, None)
+
+    def _deliver(self, webhook_url: str):
+        pending = self._pending[webhook_url]
+        now = time.monotonic()
+        if not pending or now < self._retry_at.get(webhook_url, 0):
+            return
+
+        if self.rate_per_minute > 0:
+            try:
+                wait = self._backend(webhook_url).try_acquire(self.rate_per_minute, 0, 1, 0, 0)
+            except Exception as e:
+                # 限流存储不可用时不限流，避免消息一直积压
+                logger.error(f"钉钉限流令牌获取失败，本次不限流: {e}")
+                wait = 0
+            if wait > 0:
+                self._throttled.add(webhook_url)
+                self._retry_at[webhook_url] = now + wait
+                return
+
+        # 只有被限流过、逐条发送跟不上时才合并成摘要
+        if webhook_url in self._throttled and len(pending) >= self.digest_threshold:
+            items = list(pending)
+            message = build_digest(items)
+            logger.info(f"钉钉消息积压 {len(items)} 条，合并为摘要发送")
+        else:
+            items = [pending[0]]
+            message = items[0].message
+
+        try:
+            with track_stage('notify'):
+                ok, throttled = DingTalkNotifier.post(webhook_url, message)
+        except Exception as e:
+            # 连接失败、响应不是 JSON 等按一次失败处理，计入重试次数
+            logger.error(f"钉钉消息发送异常! webhook_url:{webhook_url}, {e}")
+            ok, throttled = False, False
+        if ok:
+            for _ in items:
+                pending.popleft()
+            self._done(len(items))
+            if not pending:
+                self._throttled.discard(webhook_url)
+            return
+        self._fail(webhook_url, items, throttled)
+
+    def _fail(self, webhook_url: str, items: list, throttled: bool):
+        """发送失败计一次重试，超过 max_retries 次后丢弃 items（pending 队首的若干条）"""
+        pending = self._pending[webhook_url]
+        if throttled:
+            self._throttled.add(webhook_url)
+        head = items[0]
+        head.attempts += 1
+        if head.attempts > self.max_retries:
+            logger.error(f"钉钉消息重试 {self.max_retries} 次仍失败，丢弃 {len(items)} 条, webhook_url:{webhook_url}")
+            for _ in items:
+                pending.popleft()
+            self._done(len(items))
+            return
+        # 被限流时等待一个完整的限流窗口，其它错误指数退避
+        backoff = MAX_BACKOFF if throttled else min(MAX_BACKOFF, 2 ** head.attempts)
+        self._retry_at[webhook_url] = time.monotonic() + backoff
+
+
+_delivery = None
+
+
+def get_delivery() -> DingTalkDelivery:
+    global _delivery
+    if _delivery is None:
+        _delivery = DingTalkDelivery(
+            rate_per_minute=float(os.getenv('DINGTALK_RATE_PER_MINUTE', 20)),
+            digest_threshold=int(os.getenv('DINGTALK_DIGEST_THRESHOLD', 3)),
+            max_retries=int(os.getenv('DINGTALK_MAX_RETRIES', 3)),
+        )
+        atexit.register(_delivery.flush, flush_timeout())
+    return _delivery
+
+
+def flush_timeout() -> float:
+    return float(os.getenv('DINGTALK_FLUSH_TIMEOUT', 30))
+
+
+def max_flush_seconds() -> float:
+    """flush_delivery 最长的等待时间"""
+    return flush_timeout() + MAX_BACKOFF + SEND_GRACE
+
+
+def flush_delivery() -> bool:
+    """
+    进程退出前等待积压的钉钉消息发送完成（worker 进程和 fork 出的 rq 任务进程不执行 atexit）；
+    当前进程没有发送过消息时直接返回。
+    """
+    if _delivery is None or _delivery._pid != os.getpid():
+        return True
+    return _delivery.flush(flush_timeout())
@@ -1,14 +1,31 @@
 import json
 import os
+from typing import Tuple
 
 import requests
 
+from biz.report.webhookRouter import get_webhook_router
 from biz.utils.log import logger
 
+# 钉钉机器人发送过快（每个机器人每分钟最多 20 条）时返回的错误码
+DINGTALK_THROTTLED_ERRCODE = 130101
+
+_session = None
+_session_pid = None
+
+
+def _get_session() -> requests.Session:
+    """进程内复用 keep-alive 连接"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        _session_pid = os.getpid()
+    return _session
+
 
 class DingTalkNotifier:
     def __init__(self, webhook_url=None):
-        self.default_webhook_url = webhook_url or os.environ.get('DINGTALK_WEBHOOK_URL')
+        self.default_webhook_url = webhook_url or os.environ.get('DINGTALK_WEBHOOK_URL') or get_webhook_router().default
 
     def _get_webhook_url(self, project_name=None, url_slug=None):
         # 如果未提供 project_name，直接返回默认的 Webhook URL
@@ -18,17 +35,10 @@ class DingTalkNotifier:
             else:
                 raise ValueError("未提供项目名称，且未设置默认的钉钉 Webhook URL。")
 
-        # 构造目标键
-        target_key_project = f"DINGTALK_WEBHOOK_URL_{project_name.upper()}"
-        target_key_url_slug = f"DINGTALK_WEBHOOK_URL_{url_slug.upper()}"
-
-        # 遍历环境变量
-        for env_key, env_value in os.environ.items():
-            env_key_upper = env_key.upper()
-            if env_key_upper == target_key_project:
-                return env_value  # 找到项目名称对应的 Webhook URL，直接返回
-            if env_key_upper == target_key_url_slug:
-                return env_value  # 找到 GitLab URL 对应的 Webhook URL，直接返回
+        # 查询启动时预先建立的路由索引（项目名、url_slug、通配规则）
+        webhook_url = get_webhook_router().resolve(project_name=project_name, url_slug=url_slug)
+        if webhook_url:
+            return webhook_url
 
         # 如果未找到匹配的环境变量，降级使用全局的 Webhook URL
         if self.default_webhook_url:
@@ -37,39 +47,49 @@ class DingTalkNotifier:
         # 如果既未找到匹配项，也没有默认值，抛出异常
         raise ValueError(f"未找到项目 '{project_name}' 对应的钉钉Webhook URL，且未设置默认的 Webhook URL。")
 
+    @staticmethod
+    def build_message(content: str, msg_type='text', title='通知', is_at_all=False) -> dict:
+        if msg_type == 'markdown':
+            return {
+                "msgtype": "markdown",
+                "markdown": {
+                    "title": title,  # Customize as needed
+                    "text": "review" + content
+                },
+                "at": {
+                    "isAtAll": is_at_all
+                }
+            }
+        return {
+            "msgtype": "text",
+            "text": {
+                "content": "review" + content
+            },
+            "at": {
+                "isAtAll": is_at_all
+            }
+        }
+
+    @staticmethod
+    def post(post_url: str, message: dict) -> Tuple[bool, bool]:
+        """发送消息，返回 (是否成功, 是否被钉钉限流)"""
+        headers = {
+            "Content-Type": "application/json",
+            "Charset": "UTF-8"
+        }
+        response = _get_session().post(url=post_url, data=json.dumps(message), headers=headers, timeout=10)
+        if response.status_code == 429:
+            return False, True
+        response_data = response.json()
+        if response_data.get('errmsg') == 'ok':
+            logger.info(f"钉钉消息发送成功! webhook_url:{post_url}")
+            return True, False
+        logger.error(f"钉钉消息发送失败! webhook_url:{post_url},errmsg:{response_data.get('errmsg')}")
+        return False, response_data.get('errcode') == DINGTALK_THROTTLED_ERRCODE
+
     def send_message(self, content: str, msg_type='text', title='通知', is_at_all=False, project_name=None, url_slug = None):
         try:
             post_url = self._get_webhook_url(project_name=project_name, url_slug=url_slug)
-            headers = {
-                "Content-Type": "application/json",
-                "Charset": "UTF-8"
-            }
-            if msg_type == 'markdown':
-                message = {
-                    "msgtype": "markdown",
-                    "markdown": {
-                        "title": title,  # Customize as needed
-                        "text": "review" + content
-                    },
-                    "at": {
-                        "isAtAll": is_at_all
-                    }
-                }
-            else:
-                message = {
-                    "msgtype": "text",
-                    "text": {
-                        "content": "review" + content
-                    },
-                    "at": {
-                        "isAtAll": is_at_all
-                    }
-                }
-            response = requests.post(url=post_url, data=json.dumps(message), headers=headers)
-            response_data = response.json()
-            if response_data.get('errmsg') == 'ok':
-                logger.info(f"钉钉消息发送成功! webhook_url:{post_url}")
-            else:
-                logger.error(f"钉钉消息发送失败! webhook_url:{post_url},errmsg:{response_data.get('errmsg')}")
+            self.post(post_url, self.build_message(content, msg_type=msg_type, title=title, is_at_all=is_at_all))
         except Exception as e:
-            logger.error(f"钉钉消息发送失败! ", e)
+            logger.error(f"钉钉消息发送失败! {e}")
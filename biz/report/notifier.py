@@ -1,9 +1,30 @@
+import os
+
+from biz.report.delivery import flush_delivery, get_delivery
 from biz.report.dingtalk import DingTalkNotifier
+from biz.utils.log import logger
 
 
-def sendReport(content, msg_type='text', title="代码检查报告", is_at_all=False, project_name=None, url_slug=None):
-    # 钉钉推送
+def sendReport(content, msg_type='text', title="代码检查报告", is_at_all=False, project_name=None, url_slug=None,
+               score=None, url=None):
+    # 钉钉推送：只负责入队，由后台线程限流发送；score 和 url 用于积压时合并的摘要
     dingtalk_notifier = DingTalkNotifier()
-    dingtalk_notifier.send_message(content=content, msg_type=msg_type, title=title, is_at_all=is_at_all,
-                          project_name=project_name, url_slug=url_slug)
+    try:
+        post_url = dingtalk_notifier._get_webhook_url(project_name=project_name, url_slug=url_slug)
+    except Exception as e:
+        logger.error(f"钉钉消息发送失败! {e}")
+        return
+    message = dingtalk_notifier.build_message(content=content, msg_type=msg_type, title=title, is_at_all=is_at_all)
+    summary = next((line.strip('# ') for line in content.splitlines() if line.strip()), title)
+    get_delivery().submit(post_url, message, title=title, project_name=project_name, summary=summary,
+                         score=score, url=url)
+
 
+def flush_if_ephemeral():
+    """
+    rq 默认的 worker 为每个任务 fork 一个子进程，任务结束后子进程直接退出（不执行 atexit），
+    后台线程来不及发送，需要在任务返回前等待发送完成（包括被限流、等待重试的消息和摘要）。
+    async 模式的 worker 在退出时等待，不 fork 的 rq worker（RQ_WORKER_MODE=simple）是常驻进程，都无需在这里等待。
+    """
+    if os.getenv('QUEUE_DRIVER', 'async') == 'rq' and os.getenv('RQ_WORKER_MODE', 'fork') == 'fork':
+        flush_delivery()
@@ -0,0 +1,124 @@
+import fnmatch
+import os
+import threading
+import time
+from typing import Optional
+
+from biz.utils.log import logger
+
+ENV_PREFIX = "DINGTALK_WEBHOOK_URL_"
+
+
+class WebhookRouter:
+    """
+    钉钉 Webhook 路由表：启动时把环境变量 DINGTALK_WEBHOOK_URL_<PROJECT|SLUG> 和路由配置文件
+    解析成索引，项目名和 url_slug 共用同一个索引（键统一为大写）。
+    配置文件支持通配符规则（如 "frontend-*"），修改后无需重启，按 reload_interval 检查文件变化。
+    查询结果按 (project_name, url_slug) 缓存，每条消息的路由查找为 O(1)。
+
+    配置文件格式：
+        default: https://oapi.dingtalk.com/robot/send?access_token=xxx
+        routes:
+          my-project: https://...
+          "frontend-*": https://...
+          git_test_com: https://...
+    """
+
+    def __init__(self, conf_path: str, reload_interval: float):
+        self.conf_path = conf_path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._env_routes = {key[len(ENV_PREFIX):].upper(): value
+                            for key, value in os.environ.items() if key.upper().startswith(ENV_PREFIX)}
+        self._exact = dict(self._env_routes)
+        self._patterns = []
+        self._default = None
+        self._resolved = {}
+        self._conf_mtime = None
+        self._checked_at = 0.0
+        self._load_conf()
+
+    def _load_conf(self):
+        try:
+            mtime = os.path.getmtime(self.conf_path)
+        except OSError:
+            mtime = None
+        if mtime == self._conf_mtime:
+            return
+
+        exact = dict()
+        patterns = []
+        default = None
+        if mtime is not None:
+            try:
+                import yaml  # 只有配置了路由文件时才需要
+                with open(self.conf_path, 'r', encoding='utf-8') as f:
+                    conf = yaml.safe_load(f) or {}
+                default = conf.get('default')
+                for rule, url in (conf.get('routes') or {}).items():
+                    rule = str(rule).upper()
+                    if any(ch in rule for ch in '*?['):
+                        patterns.append((rule, url))
+                    else:
+                        exact[rule] = url
+            except Exception as e:
+                logger.error(f"加载钉钉路由配置 {self.conf_path} 失败，继续使用旧的路由: {e}")
+                return
+            logger.info(f"已加载钉钉路由配置 {self.conf_path}: {len(exact)} 条精确规则, {len(patterns)} 条通配规则")
+
+        # 环境变量优先于配置文件
+        exact.update(self._env_routes)
+        self._exact = exact
+        self._patterns = patterns
+        self._default = default
+        self._resolved = {}
+        self._conf_mtime = mtime
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked_at >= self.reload_interval:
+                self._checked_at = now
+                self._load_conf()
+
+    def _match(self, name: Optional[str]) -> Optional[str]:
+        if not name:
+            return None
+        key = name.upper()
+        url = self._exact.get(key)
+        if url:
+            return url
+        for pattern, pattern_url in self._patterns:
+            if fnmatch.fnmatchcase(key, pattern):
+                return pattern_url
+        return None
+
+    @property
+    def default(self) -> Optional[str]:
+        """配置文件中的默认 Webhook URL"""
+        self._maybe_reload()
+        return self._default
+
+    def resolve(self, project_name: str = None, url_slug: str = None) -> Optional[str]:
+        """按 项目名 > url_slug 的顺序匹配，未匹配时返回 None"""
+        self._maybe_reload()
+        cache_key = (project_name, url_slug)
+        resolved = self._resolved
+        if cache_key not in resolved:
+            resolved[cache_key] = self._match(project_name) or self._match(url_slug)
+        return resolved[cache_key]
+
+
+_router = None
+
+
+def get_webhook_router() -> WebhookRouter:
+    global _router
+    if _router is None:
+        _router = WebhookRouter(
+            conf_path=os.getenv('DINGTALK_ROUTES_FILE', 'conf/dingtalk_routes.yml'),
+            reload_interval=float(os.getenv('DINGTALK_ROUTES_RELOAD_INTERVAL', 5)),
+        )
+    return _router
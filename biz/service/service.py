@@ -1,52 +1,109 @@
-import json
 import os
 from urllib.parse import urlparse
 
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
 
 from biz.gitlab.gitlabHandler import slugify_url
-from biz.queue.worker import handle_merge_request_event
+from biz.queue.worker import handle_merge_request_event, trim_merge_request_payload
 from biz.llm.deepseek import DeepSeekClient
+from biz.utils.coalesce import coalesce_key, get_generation_store, rollback_generation
+from biz.utils.jobStatus import get_job_status_store
 from biz.utils.log import logger
-from biz.utils.queue import handle_queue
+from biz.utils.queue import enqueue_many, handle_queue, QueueFullError
 load_dotenv("conf/.env")
-api_app = Flask(__name__)
 
 
 push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
 
-def handle_gitlab(data):
-    logger.info(f"获取提交信息2.{data}")
-    gitlab_url = os.getenv('GITLAB_URL') or request.headers.get('X-Gitlab-Instance')
-    logger.info("获取提交信息3.")
-    logger.info(gitlab_url)
+def _resolve_gitlab(data: dict, headers: dict) -> tuple:
+    """返回 (gitlab_url, gitlab_token, 错误响应)，错误响应不为空时 url 和 token 无效"""
+    headers = headers or {}
+    gitlab_url = os.getenv('GITLAB_URL') or headers.get('X-Gitlab-Instance')
     if not gitlab_url:
         repository = data.get('repository')
         if not repository:
-            return jsonify({'message': 'Missing GitLab URL'}), 400
+            return None, None, ({'message': 'Missing GitLab URL'}, 400)
         homepage = repository.get("homepage")
         if not homepage:
-            return jsonify({'message': 'Missing GitLab URL'}), 400
+            return None, None, ({'message': 'Missing GitLab URL'}, 400)
         try:
             parsed_url = urlparse(homepage)
             gitlab_url = f"{parsed_url.scheme}://{parsed_url.netloc}/"
         except Exception as e:
-            return jsonify({"error": f"Failed to parse homepage URL: {str(e)}"}), 400
+            return None, None, ({"error": f"Failed to parse homepage URL: {str(e)}"}, 400)
 
-    gitlab_token = os.getenv('GITLAB_ACCESS_TOKEN') or request.headers.get('X-Gitlab-Token')
-    logger.info(gitlab_token)
+    gitlab_token = os.getenv('GITLAB_ACCESS_TOKEN') or headers.get('X-Gitlab-Token')
     if not gitlab_token:
-        return jsonify({'message': 'Missing GitLab access token'}), 400
+        return None, None, ({'message': 'Missing GitLab access token'}, 400)
+    return gitlab_url, gitlab_token, None
 
+
+def handle_gitlab(data: dict, headers: dict = None, debounce_seconds: float = None, force: bool = False) -> tuple:
+    """
+    把 MR 审查任务放入队列，立即返回 (响应内容, 状态码)，不依赖 Flask 的请求上下文。
+    headers 为调用方的请求头，环境变量中没有配置 GitLab 地址和 token 时从中读取。
+    debounce_seconds 为空时使用 REVIEW_DEBOUNCE_SECONDS；force 为 True 时忽略增量审查状态做完整审查。
+    受理成功时响应中包含 job_id，可据此查询任务状态和结果。
+    """
+    gitlab_url, gitlab_token, error = _resolve_gitlab(data, headers)
+    if error:
+        return error
     gitlab_url_slug = slugify_url(gitlab_url)
 
-    logger.info(f'Payload: {json.dumps(data)}')
+    logger.info('Payload: %s', data)
+
+    # 同一个 MR 的连续事件只审查最新的一次：静默期内的新事件替换旧任务，执行中的旧任务按事件代数放弃
+    mr_key = coalesce_key(gitlab_url_slug, data.get('project_id'), data.get('iid'))
+    generation = get_generation_store().bump(mr_key)
+    if debounce_seconds is None:
+        debounce_seconds = float(os.getenv('REVIEW_DEBOUNCE_SECONDS', 5))
+    job_id = get_job_status_store().create(mr_key)
 
-    handle_queue(handle_merge_request_event, data, gitlab_token, gitlab_url, gitlab_url_slug)
+    try:
+        handle_queue(handle_merge_request_event, trim_merge_request_payload(data), gitlab_token, gitlab_url,
+                     gitlab_url_slug, delay=debounce_seconds, coalesce_key=mr_key, generation=generation,
+                     review_job_id=job_id, force=force)
+    except QueueFullError as e:
+        logger.warn(f"任务队列已满，拒绝本次请求: {e}")
+        # 本次事件没有入队：撤销代数和任务登记，同一个 MR 排队中/执行中的旧任务照常完成
+        rollback_generation(mr_key, generation)
+        get_job_status_store().discard(job_id)
+        return {'message': 'Too many pending reviews, please retry later.'}, 429
     # 立马返回响应
-    return jsonify(
-        {'message': f'Request received(object_kind=merge), will process asynchronously.'}), 200
+    return {'message': 'Request received(object_kind=merge), will process asynchronously.', 'job_id': job_id}, 200
+
+
+def handle_gitlab_many(datas: list, headers: dict = None, force: bool = False) -> list:
+    """
+    批量提交 MR 审查任务（没有静默期），rq 模式下一次 Redis 往返入队；
+    返回与 datas 一一对应的 (响应内容, 状态码) 列表，含义与 handle_gitlab 相同。
+    """
+    results = [None] * len(datas)
+    jobs, submitted = [], []
+    for index, data in enumerate(datas):
+        gitlab_url, gitlab_token, error = _resolve_gitlab(data, headers)
+        if error:
+            results[index] = error
+            continue
+        gitlab_url_slug = slugify_url(gitlab_url)
+        mr_key = coalesce_key(gitlab_url_slug, data.get('project_id'), data.get('iid'))
+        generation = get_generation_store().bump(mr_key)
+        job_id = get_job_status_store().create(mr_key)
+        jobs.append((trim_merge_request_payload(data), gitlab_token, gitlab_url, gitlab_url_slug,
+                     {'generation': generation, 'review_job_id': job_id, 'force': force}))
+        submitted.append((index, mr_key, generation, job_id))
+
+    errors = enqueue_many(handle_merge_request_event, jobs) if jobs else []
+    for (index, mr_key, generation, job_id), error in zip(submitted, errors):
+        if error:
+            logger.warn(f"任务队列已满，拒绝本次请求: {error}")
+            rollback_generation(mr_key, generation)
+            get_job_status_store().discard(job_id)
+            results[index] = {'message': 'Too many pending reviews, please retry later.'}, 429
+        else:
+            results[index] = {'message': 'Request received(object_kind=merge), will process asynchronously.',
+                              'job_id': job_id}, 200
+    return results
 
 def check_deepseek():
 
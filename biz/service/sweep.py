@@ -0,0 +1,150 @@
+"""
+批量审查项目或群组中所有打开状态的 MR（例如修改 prompt 后重新评分）：
+分页列出 MR，跳过当前 head 已审查过的 MR，通过 worker 池提交审查任务，同时执行中的任务数不超过 concurrency
+（每次补充的任务批量入队，rq 模式下一次 Redis 往返）。
+
+    python -m biz.service.sweep --project 123 --concurrency 4
+    python -m biz.service.sweep --group my-group --force
+"""
+import argparse
+import os
+import time
+from typing import Callable, Optional
+
+from biz.gitlab.gitlabHandler import iter_open_merge_requests, slugify_url
+from biz.service import service
+from biz.utils.jobStatus import FINISHED_STATUSES, get_job_status_store
+from biz.utils.log import logger
+from biz.utils.queue import start_worker_pool
+from biz.utils.reviewState import get_review_state_store
+
+SUMMARY_COLUMNS = ('project_id', 'iid', 'status', 'score', 'title')
+
+
+def list_open_merge_requests(gitlab_url: str, gitlab_token: str, project_id=None, group_id=None) -> list:
+    """只保留调度需要的字段，避免持有完整的 MR 列表"""
+    per_page = int(os.getenv('GITLAB_LIST_PER_PAGE', 100))
+    return [{
+        'project_id': mr['project_id'],
+        'iid': mr['iid'],
+        'sha': mr.get('sha'),
+        'title': mr.get('title', ''),
+        'web_url': mr.get('web_url'),
+    } for mr in iter_open_merge_requests(gitlab_url, gitlab_token, project_id, group_id, per_page=per_page)]
+
+
+def sweep_open_merge_requests(project_id=None, group_id=None, concurrency: int = 4, force: bool = False,
+                              dry_run: bool = False, timeout: float = 3600,
+                              on_progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    返回 {'summary': {状态: 数量}, 'items': [每个 MR 的结果]}。
+    on_progress 在每个 MR 有结论（跳过、完成、失败）时调用，参数中带有 done / total。
+    force 为 True 时不跳过已审查的 MR，并对其做完整审查；dry_run 为 True 时只列出需要审查的 MR。
+    """
+    gitlab_url = os.getenv('GITLAB_URL')
+    gitlab_token = os.getenv('GITLAB_ACCESS_TOKEN')
+    if not gitlab_url or not gitlab_token:
+        raise ValueError("GITLAB_URL 和 GITLAB_ACCESS_TOKEN 需要在环境变量中配置")
+    url_slug = slugify_url(gitlab_url)
+    state_store = get_review_state_store()
+    jobs = get_job_status_store()
+    poll_interval = float(os.getenv('REVIEW_JOB_POLL_INTERVAL', 1))
+    concurrency = max(1, int(concurrency))
+
+    merge_requests = list_open_merge_requests(gitlab_url, gitlab_token, project_id, group_id)
+    items = []
+    done = 0
+
+    def finish(item: dict):
+        nonlocal done
+        done += 1
+        items.append(item)
+        if on_progress:
+            on_progress({**item, 'done': done, 'total': len(merge_requests)})
+
+    pending = []
+    for mr in merge_requests:
+        item = {key: mr[key] for key in ('project_id', 'iid', 'title', 'web_url')}
+        last_state = None if force else state_store.get(url_slug, mr['project_id'], mr['iid'])
+        if last_state and mr['sha'] and last_state['head_sha'] == mr['sha']:
+            finish({**item, 'status': 'skipped', 'score': last_state['score'], 'message': '当前 head 已审查过'})
+        elif dry_run:
+            finish({**item, 'status': 'pending', 'score': None, 'message': 'dry run'})
+        else:
+            pending.append(item)
+
+    logger.info(f"批量审查: 共 {len(merge_requests)} 个打开的 MR，需要审查 {len(pending)} 个，并发数 {concurrency}")
+    deadline = time.monotonic() + timeout
+    running = {}
+    while pending or running:
+        batch = [pending.pop(0) for _ in range(min(len(pending), concurrency - len(running)))]
+        if batch:
+            responses = service.handle_gitlab_many([{'project_id': item['project_id'], 'iid': item['iid']}
+                                                    for item in batch], force=force)
+            for item, (payload, status) in zip(batch, responses):
+                if status != 200:
+                    finish({**item, 'status': 'failed', 'score': None, 'message': payload.get('message')})
+                    continue
+                running[payload['job_id']] = item
+
+        for job_id, item in list(running.items()):
+            job = jobs.get(job_id)
+            if job and job['status'] in FINISHED_STATUSES:
+                del running[job_id]
+                finish({**item, 'status': job['status'], 'score': job['score'], 'message': job['message'],
+                        'job_id': job_id})
+
+        if time.monotonic() >= deadline:
+            for job_id, item in running.items():
+                finish({**item, 'status': 'timeout', 'score': None, 'message': '等待超时，任务仍在执行',
+                        'job_id': job_id})
+            for item in pending:
+                finish({**item, 'status': 'timeout', 'score': None, 'message': '等待超时，未提交'})
+            break
+        if running:
+            time.sleep(poll_interval)
+
+    summary = {}
+    for item in items:
+        summary[item['status']] = summary.get(item['status'], 0) + 1
+    return {'total': len(merge_requests), 'summary': summary, 'items': items}
+
+
+def format_summary_table(result: dict) -> str:
+    """Markdown 表格，CLI 和 MCP 工具共用"""
+    lines = ['| ' + ' | '.join(SUMMARY_COLUMNS) + ' |', '|' + '---|' * len(SUMMARY_COLUMNS)]
+    for item in sorted(result['items'], key=lambda item: (str(item['project_id']), item['iid'])):
+        values = [item.get(column) for column in SUMMARY_COLUMNS]
+        lines.append('| ' + ' | '.join('' if value is None else str(value).replace('|', '\\|') for value in values)
+                     + ' |')
+    counts = ', '.join(f"{status}: {count}" for status, count in sorted(result['summary'].items()))
+    lines.append(f"\n共 {result['total']} 个打开的 MR（{counts or '无'}）")
+    return '\n'.join(lines)
+
+
+def format_progress(event: dict) -> str:
+    score = f", score {event['score']}" if event.get('score') is not None else ''
+    return (f"[{event['done']}/{event['total']}] {event['project_id']}!{event['iid']} {event['status']}{score}"
+            f" - {event['title']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量审查项目或群组中所有打开状态的 MR')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--project', help='项目 ID 或路径（group/project）')
+    target.add_argument('--group', help='群组 ID 或路径，包含子群组')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时执行的审查任务数')
+    parser.add_argument('--force', action='store_true', help='不跳过当前 head 已审查过的 MR，并做完整审查')
+    parser.add_argument('--dry-run', action='store_true', help='只列出需要审查的 MR')
+    parser.add_argument('--timeout', type=float, default=3600, help='等待所有任务完成的最长时间（秒）')
+    args = parser.parse_args(argv)
+
+    start_worker_pool()
+    result = sweep_open_merge_requests(project_id=args.project, group_id=args.group, concurrency=args.concurrency,
+                                       force=args.force, dry_run=args.dry_run, timeout=args.timeout,
+                                       on_progress=lambda event: print(format_progress(event), flush=True))
+    print(format_summary_table(result))
+
+
+if __name__ == '__main__':
+    main()
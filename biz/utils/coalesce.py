@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+from biz.utils.log import logger
+from biz.utils.sqliteUtil import get_connection
+
+
+def coalesce_key(url_slug: str, project_id, iid) -> str:
+    return f"{url_slug}:{project_id}:{iid}"
+
+
+class SqliteGenerationStore:
+    """async 模式下各 worker 进程在同一台机器上，通过 SQLite 共享每个 MR 的最新事件代数"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = get_connection(self.path)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS mr_generation (
+                        key TEXT PRIMARY KEY,
+                        generation INTEGER NOT NULL,
+                        updated_at REAL NOT NULL
+                    )""")
+                self._initialized = True
+        return conn
+
+    def bump(self, key: str) -> int:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO mr_generation (key, generation, updated_at) VALUES (?, 1, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET generation = generation + 1, updated_at = excluded.updated_at",
+                         (key, time.time()))
+            generation = conn.execute("SELECT generation FROM mr_generation WHERE key = ?", (key,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return generation
+
+    def rollback(self, key: str, generation: int):
+        """撤销 bump：任务没能入队时调用，之后又有新事件（代数已变）时不做处理"""
+        self._conn().execute("UPDATE mr_generation SET generation = generation - 1 WHERE key = ? AND generation = ?",
+                             (key, generation))
+
+    def current(self, key: str) -> int:
+        row = self._conn().execute("SELECT generation FROM mr_generation WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+
+class RedisGenerationStore:
+    """rq 模式下 worker 可能分布在多台机器上，通过 Redis 共享每个 MR 的最新事件代数"""
+
+    def __init__(self, connection, ttl: int = 24 * 3600):
+        self.connection = connection
+        self.ttl = ttl
+
+    def bump(self, key: str) -> int:
+        redis_key = f"review:generation:{key}"
+        pipeline = self.connection.pipeline()
+        pipeline.incr(redis_key)
+        pipeline.expire(redis_key, self.ttl)
+        return pipeline.execute()[0]
+
+    def rollback(self, key: str, generation: int):
+        """撤销 bump：任务没能入队时调用，之后又有新事件（代数已变）时不做处理"""
+        redis_key = f"review:generation:{key}"
+
+        def decrement(pipeline):
+            value = pipeline.get(redis_key)
+            if value is not None and int(value) == generation:
+                pipeline.multi()
+                pipeline.decr(redis_key)
+
+        self.connection.transaction(decrement, redis_key)
+
+    def current(self, key: str) -> int:
+        value = self.connection.get(f"review:generation:{key}")
+        return int(value) if value else 0
+
+
+_generation_store = None
+
+
+def get_generation_store():
+    global _generation_store
+    if _generation_store is None:
+        if os.getenv('QUEUE_DRIVER', 'async') == 'rq':
+            from biz.utils.redisUtil import get_redis
+            _generation_store = RedisGenerationStore(get_redis())
+        else:
+            _generation_store = SqliteGenerationStore(os.getenv('REVIEW_STATE_PATH', 'data/review_state.db'))
+    return _generation_store
+
+
+def rollback_generation(key: str, generation: int):
+    """任务被拒绝（队列已满）时撤销对应的 bump，避免同一个 MR 排队中/执行中的旧任务误以为被替代而放弃"""
+    if not key or generation is None:
+        return
+    try:
+        get_generation_store().rollback(key, generation)
+    except Exception as e:
+        logger.error(f"撤销 MR 事件代数失败: {e}")
+
+
+def is_superseded(key: str, generation: int) -> bool:
+    """同一个 MR 之后又收到了新事件时返回 True，当前任务应放弃"""
+    if not key or generation is None:
+        return False
+    try:
+        latest = get_generation_store().current(key)
+    except Exception as e:
+        logger.error(f"读取 MR 事件代数失败: {e}")
+        return False
+    if latest > generation:
+        logger.info(f"MR {key} 已有更新的事件(generation {latest} > {generation})，放弃本次审查")
+        return True
+    return False
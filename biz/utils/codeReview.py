@@ -1,31 +1,47 @@
 import abc
+import functools
 import os
 import re
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
 
-import yaml
-
-from biz.llm.deepseek import DeepSeekClient
+from biz.llm.base import LLMError, TokenUsage
+from biz.llm.rateLimiter import PRIORITY_NORMAL
+from biz.llm.router import get_llm_client
+from biz.utils.diffChunker import split_changes
+from biz.utils.diffPreprocess import render_change, render_changes
 from biz.utils.log import logger
-from biz.utils.tokenUtil import count_tokens, truncate_text_by_tokens
+from biz.utils.metrics import REVIEW_CACHE, REVIEW_SCORE, REVIEW_TIER, track_stage
+from biz.utils.reviewCache import get_review_cache, make_cache_key
+from biz.utils.reviewTier import PROMPT_LIGHT, ReviewTier, TierDecision, get_tiering_policy
+from biz.utils.tokenUtil import count_and_truncate, count_tokens_batch
 
+# 修改 prompt 时需要同步修改版本号，使旧的 Review 缓存失效
+PROMPT_VERSION = "3"
 
-class BaseReviewer(abc.ABC):
+# 各档位评分标准相同，light 只要求列出关键问题，输出更短
+SCORING_RULES = """
+### 代码审查目标：
+1. 功能实现的正确性与健壮性（40分）： 确保代码逻辑正确，能够处理各种边界情况和异常输入。
+2. 安全性与潜在风险（30分）：检查代码是否存在安全漏洞（如SQL注入、XSS攻击等），并评估其潜在风险。
+3. 是否符合最佳实践（20分）：评估代码是否遵循行业最佳实践，包括代码结构、命名规范、注释清晰度等。
+4. 性能与资源利用效率（5分）：分析代码的性能表现，评估是否存在资源浪费或性能瓶颈。
+5. Commits信息的清晰性与准确性（5分）：检查提交信息是否清晰、准确，是否便于后续维护和协作。
+""".strip()
 
-    def __init__(self, prompt_key: str):
-        self.client = DeepSeekClient()
-        self.prompts = self._load_prompts()
 
-    def _load_prompts(self) -> Dict[str, Any]:
-        system_prompt = """
+@functools.lru_cache(maxsize=None)
+def load_prompts() -> Dict[str, Any]:
+    """
+    每个进程只构建一次 prompt。去掉源码缩进后的文本逐字节固定，system 消息和 user 消息的开头
+    作为不变的前缀放在最前面，diff 等变化的内容放在后面，使 DeepSeek 的上下文硬盘缓存能稳定命中前缀。
+    """
+    system_prompt = textwrap.dedent("""
         你是一位资深的软件开发工程师，专注于代码的规范性、功能性、安全性和稳定性。本次任务是对员工的代码进行审查，具体要求如下：
 
-        ### 代码审查目标：
-        1. 功能实现的正确性与健壮性（40分）： 确保代码逻辑正确，能够处理各种边界情况和异常输入。
-        2. 安全性与潜在风险（30分）：检查代码是否存在安全漏洞（如SQL注入、XSS攻击等），并评估其潜在风险。
-        3. 是否符合最佳实践（20分）：评估代码是否遵循行业最佳实践，包括代码结构、命名规范、注释清晰度等。
-        4. 性能与资源利用效率（5分）：分析代码的性能表现，评估是否存在资源浪费或性能瓶颈。
-        5. Commits信息的清晰性与准确性（5分）：检查提交信息是否清晰、准确，是否便于后续维护和协作。
+        {scoring_rules}
         
         ### 输出格式:
         请以Markdown格式输出代码审查报告，并包含以下内容：
@@ -36,8 +52,19 @@ class BaseReviewer(abc.ABC):
         ### 特别说明：
         整个评论要保持professional风格
         评论时请使用标准的工程术语，保持专业严谨。
-        """
-        user_prompt = """
+        """).strip().format(scoring_rules=SCORING_RULES)
+    light_system_prompt = textwrap.dedent("""
+        你是一位资深的软件开发工程师，本次任务是快速审查一个改动较小的提交，具体要求如下：
+
+        {scoring_rules}
+
+        ### 输出格式:
+        请以Markdown格式简要输出：
+        1. 关键问题（最多 3 条，没有则写“无”），每条一句话说明问题和建议。
+        2. 总分：格式为“总分:XX分”（例如：总分:80分），确保可通过正则表达式 r"总分[:：]\\s*(\\d+)分?"） 解析出总分。
+        不要输出评分明细和与问题无关的内容，使用标准的工程术语。
+        """).strip().format(scoring_rules=SCORING_RULES)
+    user_prompt = textwrap.dedent("""
         以下是某位员工向 GitLab 代码库提交的代码，请以professional风格审查以下代码。
 
         代码变更内容：
@@ -45,17 +72,75 @@ class BaseReviewer(abc.ABC):
         
         提交历史(commits)：
         {commits_text}
-        """
+        """).strip()
+    incremental_prompt = textwrap.dedent("""
+        注意：该合并请求此前已经审查过，上面的代码变更只包含上次审查之后新增的提交。
+        以下是上次审查结论的摘要，请结合摘要对合并请求整体给出评分，已修复的问题不要重复指出：
+        {previous_summary}
+        """).strip()
+
+    return {
+        "system_message": {"role": "system", "content": system_prompt},
+        "light_system_message": {"role": "system", "content": light_system_prompt},
+        "user_message": {"role": "user", "content": user_prompt + "\n"},
+        "incremental_message": {"role": "user", "content": "\n" + incremental_prompt},
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_template_tokens() -> Dict[str, int]:
+    """各 prompt 模板（不含 diff、commits 等变化的内容）的 token 数，每个进程只编码一次，用于估算请求的 token 数"""
+    prompts = load_prompts()
+    return dict(zip(prompts, count_tokens_batch([message["content"] for message in prompts.values()])))
+
+
+class BaseReviewer(abc.ABC):
+
+    def __init__(self, prompt_key: str, priority: int = PRIORITY_NORMAL):
+        self.client = get_llm_client()
+        self.prompts = load_prompts()
+        self.priority = priority
+        # 本次审查调用模型累计的 token 用量（命中 Review 缓存时为 0）
+        self.usage = TokenUsage()
+        # 按改动大小选择的模型档位，review_changes 之前为 standard 档位
+        self.decision = TierDecision(get_tiering_policy().standard, 'default', 0, 0)
+        # 实际给出审查结果的模型（LLM 路由选中的后端，或命中缓存的模型），分块审查时可能有多个
+        self.served_models = set()
+        # 当前线程最近一次给出结果的模型，分块并发审查时各线程互不影响
+        self._last_served = threading.local()
+
+    @property
+    def tier(self) -> ReviewTier:
+        return self.decision.tier
+
+    @property
+    def model(self) -> str:
+        """实际给出结果的模型（多个时用逗号连接）；还没有结果时为档位指定的模型或当前首选后端的模型"""
+        if self.served_models:
+            return ",".join(sorted(self.served_models))
+        return self.client.candidate_models(self.tier.model)[0]
+
+    def _served_by(self, model: str):
+        self.served_models.add(model)
+        self._last_served.model = model
 
-        return {
-            "system_message": {"role": "system", "content": system_prompt},
-            "user_message": {"role": "user", "content": user_prompt},
-        }
+    def call_llm(self, messages: List[Dict[str, Any]], input_tokens: int = None) -> str:
+        """input_tokens 为调用方由已知的 diff token 数估算的输入 token 数，为空时对 messages 编码计算"""
+        # 跨进程限流：LLM 路由在每次发出请求（含对冲和切换）前按请求数和预估 token 数（输入 + 预估输出）扣减配额，
+        # 高优先级优先
+        if input_tokens is None:
+            with track_stage('token_count'):
+                input_tokens = sum(count_tokens_batch([message["content"] for message in messages]))
+        estimated_tokens = input_tokens + (self.tier.max_output_tokens
+                                           or int(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", 1000)))
 
-    def call_llm(self, messages: List[Dict[str, Any]]) -> str:
-        logger.info(f"向 AI 发送代码 Review 请求, messages: {messages}")
-        review_result = self.client.completions(messages=messages)
-        logger.info(f"收到 AI 返回结果: {review_result}")
+        logger.info("向 AI 发送代码 Review 请求, messages: %s", messages)
+        with track_stage('llm'):
+            review_result, model = self.client.route(messages=messages, model=self.tier.model, usage=self.usage,
+                                                     max_tokens=self.tier.max_output_tokens,
+                                                     estimated_tokens=estimated_tokens, priority=self.priority)
+        self._served_by(model)
+        logger.info("收到 AI 返回结果 (模型 %s): %s", model, review_result)
         return review_result
 
     @abc.abstractmethod
@@ -67,39 +152,170 @@ class BaseReviewer(abc.ABC):
 class CodeReviewer(BaseReviewer):
     """代码 Diff 级别的审查"""
 
-    def __init__(self):
-        super().__init__("code_review_prompt")
+    def __init__(self, priority: int = PRIORITY_NORMAL):
+        super().__init__("code_review_prompt", priority)
+        # commits 和上次审查摘要的 token 数，各分块相同，只编码一次
+        self._context_tokens = {}
 
-    def review_and_strip_code(self, changes_text: str, commits_text: str = "") -> str:
-        # 如果超长，取前REVIEW_MAX_TOKENS个token
-        review_max_tokens = int(os.getenv("REVIEW_MAX_TOKENS", 10000))
+    def review_changes(self, changes: list, commits_text: str = "", previous_summary: str = "",
+                       target_branch: str = None, token_counts: List[int] = None) -> str:
+        """
+        Review 变更列表。先按 diff 的 token 数、文件数和目标分支选择模型档位，
+        超过档位的 token 上限时按文件/hunk 拆块并发审查（map），
+        再在本地合并各块结论并按 token 加权计算总分（reduce），不再截断丢弃后面的文件。
+        previous_summary 不为空时表示 changes 是增量 diff，摘要为上次审查的结论。
+        token_counts 为预处理时算好的每个文件的 token 数，选档、拆块、限流估算和合并加权都使用它，不再重复编码 diff。
+        """
+        if token_counts is None:
+            with track_stage('token_count'):
+                token_counts = count_tokens_batch([render_change(change) for change in changes])
+        self.decision = get_tiering_policy().choose(sum(token_counts), len(changes), target_branch)
+        REVIEW_TIER.labels(tier=self.tier.name, reason=self.decision.reason).inc()
+        logger.info(f"模型档位: {self.tier.name} ({self.decision.reason}), 模型: {self.model}, "
+                    f"diff {self.decision.diff_tokens} tokens, {self.decision.file_count} 个文件")
+
+        review_result = self._review_changes(changes, token_counts, commits_text, previous_summary)
+        score = self.parse_review_score(review_text=review_result)
+        if score > 0:
+            REVIEW_SCORE.labels(tier=self.tier.name).observe(score)
+        return review_result
+
+    def _review_changes(self, changes: list, token_counts: List[int], commits_text: str,
+                        previous_summary: str) -> str:
+        with track_stage('token_count'):
+            chunks, chunk_tokens = split_changes(changes, self.tier.max_input_tokens, token_counts)
+        if len(chunks) <= 1:
+            return self.review_and_strip_code(render_changes(changes), commits_text, previous_summary,
+                                              sum(token_counts))
+
+        # 默认审查所有分块（并发数由 REVIEW_CHUNK_CONCURRENCY 限制）；配置了上限时，超出的分块在审查结果中列出
+        max_chunks = int(os.getenv("REVIEW_MAX_CHUNKS", 0))
+        skipped_chunks = []
+        if 0 < max_chunks < len(chunks):
+            logger.warn(f"变更拆分为 {len(chunks)} 块，超过 REVIEW_MAX_CHUNKS={max_chunks}，仅审查前 {max_chunks} 块")
+            chunks, skipped_chunks = chunks[:max_chunks], chunks[max_chunks:]
+            chunk_tokens = chunk_tokens[:max_chunks]
+
+        concurrency = int(os.getenv("REVIEW_CHUNK_CONCURRENCY", 4))
+        logger.info(f"变更较大，拆分为 {len(chunks)} 块并发审查, 并发数: {concurrency}")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='review-chunk') as executor:
+            results = list(executor.map(
+                lambda chunk, tokens: self._review_chunk(render_changes(chunk), commits_text, previous_summary,
+                                                         tokens),
+                chunks, chunk_tokens))
+        if all(isinstance(result, LLMError) for result in results):
+            raise results[0]
+        return self.merge_chunk_reviews(chunks, [f"审查失败: {result}" if isinstance(result, LLMError) else result
+                                                 for result in results], skipped_chunks, chunk_tokens)
+
+    def _review_chunk(self, changes_text: str, commits_text: str, previous_summary: str, diff_tokens: int):
+        """单个分块失败时返回异常，其余分块的结论照常合并（失败的分块没有得分，不参与总分计算）"""
+        try:
+            return self.review_and_strip_code(changes_text, commits_text, previous_summary, diff_tokens)
+        except LLMError as e:
+            logger.error(f"分块审查失败: {e}")
+            return e
+
+    def merge_chunk_reviews(self, chunks: List[list], results: List[str], skipped_chunks: List[list] = None,
+                            chunk_tokens: List[int] = None) -> str:
+        """
+        合并各分块的 Review 结果，总分为各块得分按 token 数（拆块时算好的 chunk_tokens）加权的平均值；
+        skipped_chunks 为超过 REVIEW_MAX_CHUNKS 没有审查的分块，其中的文件列在总分之前。
+        """
+        sections = []
+        weighted_score = 0
+        total_weight = 0
+        weights = chunk_tokens or count_tokens_batch([render_changes(chunk) for chunk in chunks])
+        for index, (chunk, result, weight) in enumerate(zip(chunks, results, weights), start=1):
+            score = self.parse_review_score(review_text=result)
+            if score > 0:
+                weighted_score += score * weight
+                total_weight += weight
+            paths = ", ".join(dict.fromkeys(change.get('new_path', '') for change in chunk))
+            # 分块内的标题降一级，并把“总分”改名，保证只有最终总分能被 parse_review_score 解析到
+            body = re.sub(r"^(#+)", r"#\1", result, flags=re.MULTILINE)
+            body = body.replace("总分", "分块得分")
+            sections.append(f"## 分块 {index}/{len(chunks)}: {paths}\n\n{body}")
+
+        if skipped_chunks:
+            reviewed = {change.get('new_path', '') for chunk in chunks for change in chunk}
+            paths = dict.fromkeys(change.get('new_path', '') for chunk in skipped_chunks for change in chunk)
+            lines = "".join(f"- {path}{'（部分 hunk）' if path in reviewed else ''}\n" for path in paths)
+            sections.append(f"## 未审查的文件\n\n变更共拆分为 {len(chunks) + len(skipped_chunks)} 块，"
+                            f"超过 REVIEW_MAX_CHUNKS 只审查了前 {len(chunks)} 块，以下文件没有审查：\n{lines}")
+
+        total_score = round(weighted_score / total_weight) if total_weight else 0
+        return "\n\n".join(sections) + f"\n\n## 总分\n总分:{total_score}分"
+
+    def review_and_strip_code(self, changes_text: str, commits_text: str = "", previous_summary: str = "",
+                              diff_tokens: int = None) -> str:
+        """diff_tokens 为已知的 changes_text 的 token 数，不超过上限时不再编码"""
+        # 如果超长，取前 max_input_tokens（不分档时为 REVIEW_MAX_TOKENS）个token
+        review_max_tokens = self.tier.max_input_tokens
         # 如果changes为空,打印日志
         if not changes_text:
-            logger.info("代码为空, diffs_text = %", str(changes_text))
+            logger.info("代码为空, diffs_text = %s", changes_text)
             return "代码为空"
 
-        # 计算tokens数量，如果超过REVIEW_MAX_TOKENS，截断changes_text
-        tokens_count = count_tokens(changes_text)
-        if tokens_count > review_max_tokens:
-            changes_text = truncate_text_by_tokens(changes_text, review_max_tokens)
+        review_cache = get_review_cache()
+        prompt_version = PROMPT_VERSION if self.tier.prompt != PROMPT_LIGHT else f"{PROMPT_VERSION}-light"
+        cache_text, context = changes_text, f"{commits_text}\0{previous_summary}"
+        if review_cache:
+            # 缓存按实际给出结果的模型区分；未指定模型时任何一个后端的模型缓存过都可以复用
+            for model in self.client.candidate_models(self.tier.model):
+                cache_key = make_cache_key(cache_text, context, prompt_version, model)
+                cached = review_cache.get(cache_key)
+                if cached:
+                    REVIEW_CACHE.labels(result='hit').inc()
+                    logger.info(f"命中 Review 缓存, key: {cache_key}, model: {model}, score: {cached[1]}")
+                    self._served_by(model)
+                    return cached[0]
+            REVIEW_CACHE.labels(result='miss').inc()
+
+        # token 数未知或超过上限时编码一次，超过上限则截断 changes_text
+        if diff_tokens is None or diff_tokens > review_max_tokens:
+            with track_stage('token_count'):
+                diff_tokens, changes_text = count_and_truncate(changes_text, review_max_tokens)
+            if diff_tokens > review_max_tokens:
+                logger.info(f"代码变更 {diff_tokens} tokens 超过档位 {self.tier.name} 的上限 {review_max_tokens}，"
+                            f"已截断")
+                diff_tokens = review_max_tokens
 
-        review_result = self.review_code(changes_text, commits_text).strip()
+        review_result = self.review_code(changes_text, commits_text, previous_summary, diff_tokens).strip()
         if review_result.startswith("```markdown") and review_result.endswith("```"):
-            return review_result[11:-3].strip()
+            review_result = review_result[11:-3].strip()
+
+        # 只缓存解析出总分的结果
+        score = self.parse_review_score(review_text=review_result)
+        if review_cache and score > 0:
+            model = getattr(self._last_served, 'model', None) or self.model
+            review_cache.put(make_cache_key(cache_text, context, prompt_version, model), review_result, score)
         return review_result
 
-    def review_code(self, diffs_text: str, commits_text: str = "") -> str:
-        """Review 代码并返回结果"""
+    def review_code(self, diffs_text: str, commits_text: str = "", previous_summary: str = "",
+                    diff_tokens: int = None) -> str:
+        """Review 代码并返回结果；diff_tokens 不为空时由模板、commits 和 diff 的 token 数估算输入，不再编码整个请求"""
+        content = self.prompts["user_message"]["content"].format(diffs_text=diffs_text, commits_text=commits_text)
+        if previous_summary:
+            content += self.prompts["incremental_message"]["content"].format(previous_summary=previous_summary)
+        system_key = "light_system_message" if self.tier.prompt == PROMPT_LIGHT else "system_message"
         messages = [
-            self.prompts["system_message"],
+            self.prompts[system_key],
             {
                 "role": "user",
-                "content": self.prompts["user_message"]["content"].format(
-                    diffs_text=diffs_text, commits_text=commits_text
-                ),
+                "content": content,
             },
         ]
-        return self.call_llm(messages)
+
+        input_tokens = None
+        if diff_tokens is not None:
+            templates = prompt_template_tokens()
+            context_key = (commits_text, previous_summary)
+            if context_key not in self._context_tokens:
+                self._context_tokens[context_key] = sum(count_tokens_batch([commits_text, previous_summary]))
+            input_tokens = (templates[system_key] + templates["user_message"] + self._context_tokens[context_key]
+                            + diff_tokens + (templates["incremental_message"] if previous_summary else 0))
+        return self.call_llm(messages, input_tokens)
 
     @staticmethod
     def parse_review_score(review_text: str) -> int:
@@ -0,0 +1,72 @@
+import re
+from typing import List, Tuple
+
+from biz.utils.diffPreprocess import render_change
+from biz.utils.tokenUtil import count_and_truncate, count_tokens, count_tokens_batch
+
+HUNK_HEADER = re.compile(r'^@@ ', re.MULTILINE)
+
+
+def split_diff_hunks(diff: str) -> List[str]:
+    """按 hunk（@@ 行）切分单个文件的 diff"""
+    starts = [m.start() for m in HUNK_HEADER.finditer(diff)]
+    if not starts:
+        return [diff]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    return [diff[start:end] for start, end in zip(starts, starts[1:] + [len(diff)])]
+
+
+def _split_change(change: dict, max_tokens: int) -> List[Tuple[dict, int]]:
+    """
+    把单个超出预算的文件变更按 hunk 拆分成多个片段，返回 (片段, token 数) 列表；
+    各 hunk 一次性批量编码，片段的 token 数按 hunk 累加，单个 hunk 仍超出时截断。
+    """
+    hunks = split_diff_hunks(change.get('diff', ''))
+    header_tokens = count_tokens(render_change({**change, 'diff': ''}))
+    pieces = []
+    current, current_tokens = '', header_tokens
+    for hunk, tokens in zip(hunks, count_tokens_batch(hunks)):
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append((current, current_tokens))
+            current, current_tokens = '', header_tokens
+        current += hunk
+        current_tokens += tokens
+    if current:
+        pieces.append((current, current_tokens))
+
+    result = []
+    for piece, tokens in pieces:
+        if tokens > max_tokens:
+            _, piece = count_and_truncate(piece, max(1, max_tokens - header_tokens))
+            tokens = max_tokens
+        result.append(({**change, 'diff': piece}, tokens))
+    return result
+
+
+def split_changes(changes: List[dict], max_tokens: int,
+                  token_counts: List[int] = None) -> Tuple[List[List[dict]], List[int]]:
+    """
+    按文件和 hunk 边界把变更列表拆成若干块，每块的 token 数不超过 max_tokens，返回 (分块列表, 每块的 token 数)。
+    token_counts 为调用方已经算好的每个文件的 token 数（预处理时计算），为空时在这里计算。
+    """
+    chunks, chunk_tokens = [], []
+    current = []
+    current_tokens = 0
+    # 一次性批量计算所有文件的 token 数
+    if token_counts is None:
+        token_counts = count_tokens_batch([render_change(change) for change in changes])
+    for change, tokens in zip(changes, token_counts):
+        pieces = [(change, tokens)] if tokens <= max_tokens else _split_change(change, max_tokens)
+        for piece, piece_tokens in pieces:
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(current)
+                chunk_tokens.append(current_tokens)
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(current)
+        chunk_tokens.append(current_tokens)
+    return chunks, chunk_tokens
@@ -0,0 +1,181 @@
+import fnmatch
+import os
+import re
+from typing import List, Tuple
+
+from biz.utils.tokenUtil import count_tokens_batch
+
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$')
+
+# 锁文件、生成代码、第三方代码和压缩文件，审查它们只会浪费 token
+DEFAULT_SKIP_PATTERNS = ','.join([
+    '*package-lock.json', '*yarn.lock', '*pnpm-lock.yaml', '*poetry.lock', '*Pipfile.lock', '*composer.lock',
+    '*Gemfile.lock', '*Cargo.lock', '*go.sum',
+    '*.min.js', '*.min.css', '*.map', '*.pb.go', '*_pb2.py', '*_pb2_grpc.py', '*.generated.*', '*.g.dart',
+    'vendor/*', '*/vendor/*', 'node_modules/*', '*/node_modules/*', 'third_party/*', '*/third_party/*',
+    'dist/*', '*/dist/*',
+])
+
+
+def should_skip(path: str, diff: str, patterns: List[str], max_bytes: int, max_line_length: int) -> str:
+    """返回跳过的原因，不需要跳过时返回空字符串"""
+    if any(fnmatch.fnmatch(path, pattern) for pattern in patterns):
+        return 'pattern'
+    if max_bytes > 0 and len(diff) > max_bytes:
+        return 'size'
+    if max_line_length > 0:
+        added = [line for line in diff.splitlines() if line.startswith('+')]
+        if added and sum(len(line) for line in added) / len(added) > max_line_length:
+            return 'minified'
+    return ''
+
+
+def _is_whitespace_only(lines: List[str]) -> bool:
+    """hunk 中删除的行和新增的行去掉所有空白后完全一致（只改了缩进、空格或空行）"""
+    removed = [''.join(line[1:].split()) for line in lines if line.startswith('-')]
+    added = [''.join(line[1:].split()) for line in lines if line.startswith('+')]
+    return [line for line in removed if line] == [line for line in added if line]
+
+
+def _trim_hunk(header: str, lines: List[str], context_lines: int) -> List[str]:
+    """只保留变更行前后 context_lines 行上下文，相距较远的变更拆成多个 hunk 并重新计算行号"""
+    match = HUNK_HEADER_PATTERN.match(header)
+    if not match or context_lines < 0:
+        return [header] + lines
+    old_line, new_line = int(match.group(1)), int(match.group(3))
+    section = match.group(5)
+
+    # (行内容, 该行之前的旧文件行号, 新文件行号)
+    entries = []
+    for line in lines:
+        if line.startswith('\\'):
+            # "\ No newline at end of file"
+            continue
+        entries.append((line, old_line, new_line))
+        if not line.startswith('+'):
+            old_line += 1
+        if not line.startswith('-'):
+            new_line += 1
+
+    changed = [i for i, (line, _, _) in enumerate(entries) if line[:1] in ('+', '-')]
+    keep = set()
+    for i in changed:
+        keep.update(range(max(0, i - context_lines), min(len(entries), i + context_lines + 1)))
+
+    # 从 hunk 第一行开始的片段沿用原来的起始行号（新增文件的 -0,0、纯删除的 +N,0 等），其余片段重新计算
+    starts = (int(match.group(1)), int(match.group(3)))
+    result = []
+    group = []
+    for i, entry in enumerate(entries):
+        if i in keep:
+            group.append(entry)
+            continue
+        if group:
+            result.extend(_format_hunk(group, section if not result else '', starts if i == len(group) else None))
+            group = []
+    if group:
+        result.extend(_format_hunk(group, section if not result else '',
+                                   starts if len(group) == len(entries) else None))
+    return result
+
+
+def _format_hunk(entries: list, section: str, starts: Tuple[int, int] = None) -> List[str]:
+    """starts 为空时按第一行计算起始行号：行数为 0 的一侧按 unified diff 的约定取前一行"""
+    old_count = sum(1 for line, _, _ in entries if not line.startswith('+'))
+    new_count = sum(1 for line, _, _ in entries if not line.startswith('-'))
+    if starts:
+        old_start, new_start = starts
+    else:
+        old_start = entries[0][1] - (1 if old_count == 0 else 0)
+        new_start = entries[0][2] - (1 if new_count == 0 else 0)
+    header = f"@@ -{old_start},{old_count} +{new_start},{new_count} @@{section}"
+    return [header] + [line.rstrip() for line, _, _ in entries]
+
+
+def compact_diff(diff: str, context_lines: int) -> Tuple[str, int]:
+    """返回 (精简后的 diff, 丢弃的纯空白 hunk 数)"""
+    lines = diff.splitlines()
+    hunks = []
+    current = None
+    for line in lines:
+        if line.startswith('@@'):
+            current = [line, []]
+            hunks.append(current)
+        elif current is None:
+            # 没有 hunk 头的内容（如 Binary files differ）原样保留
+            hunks.append([None, [line]])
+        else:
+            current[1].append(line)
+
+    output = []
+    dropped = 0
+    for header, body in hunks:
+        if header is None:
+            output.extend(body)
+        elif _is_whitespace_only(body):
+            dropped += 1
+        else:
+            output.extend(_trim_hunk(header, body, context_lines))
+    return '\n'.join(output), dropped
+
+
+def render_change(change: dict) -> str:
+    """渲染成紧凑的文本 diff，代替 Python 列表/字典的 repr（换行会被转义成 \\n，引号会被转义）"""
+    path = change.get('new_path', '')
+    if change.get('renamed_file') and change.get('old_path'):
+        title = f"{change['old_path']} -> {path}"
+    elif change.get('new_file'):
+        title = f"{path} (new)"
+    else:
+        title = path
+    return f"### {title}\n{change.get('diff', '')}\n"
+
+
+def render_changes(changes: List[dict]) -> str:
+    return '\n'.join(render_change(change) for change in changes)
+
+
+def preprocess_changes(changes: List[dict]) -> Tuple[List[dict], dict]:
+    """
+    LLM 之前的预处理：跳过锁文件、生成代码、第三方代码和压缩文件，丢弃纯空白改动的 hunk，
+    把上下文裁剪到 REVIEW_DIFF_CONTEXT_LINES 行。返回 (处理后的变更, 统计信息)，统计中包含精简前后的字符数和
+    精简后每个文件的 token 数（token_counts，与处理后的变更一一对应）。
+    """
+    patterns = [p.strip() for p in os.getenv('REVIEW_SKIP_PATTERNS', DEFAULT_SKIP_PATTERNS).split(',') if p.strip()]
+    max_bytes = int(os.getenv('REVIEW_SKIP_MAX_DIFF_BYTES', 200 * 1024))
+    max_line_length = int(os.getenv('REVIEW_SKIP_MAX_LINE_LENGTH', 500))
+    context_lines = int(os.getenv('REVIEW_DIFF_CONTEXT_LINES', 2))
+
+    result = []
+    skipped = {}
+    dropped_hunks = 0
+    for change in changes:
+        path = change.get('new_path', '')
+        diff = change.get('diff', '')
+        reason = should_skip(path, diff, patterns, max_bytes, max_line_length)
+        if reason:
+            skipped[path] = reason
+            continue
+        diff, dropped = compact_diff(diff, context_lines)
+        dropped_hunks += dropped
+        if not diff.strip():
+            skipped[path] = 'whitespace'
+            continue
+        result.append({**change, 'diff': diff})
+
+    # 只对精简后的 diff 编码一次：每个文件的 token 数随结果返回，供选档、拆块、限流和合并时加权使用；
+    # 精简的效果按字符数统计，不为此再编码一次原始 diff
+    token_counts = count_tokens_batch([render_change(change) for change in result])
+    raw_chars = sum(len(change.get('diff', '')) for change in changes)
+    compact_chars = sum(len(change['diff']) for change in result)
+    stats = {
+        'files': len(changes),
+        'reviewed_files': len(result),
+        'skipped': skipped,
+        'dropped_hunks': dropped_hunks,
+        'raw_chars': raw_chars,
+        'compact_chars': compact_chars,
+        'compact_tokens': sum(token_counts),
+        'token_counts': token_counts,
+    }
+    return result, stats
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from biz.utils.log import logger
+from biz.utils.sqliteUtil import get_connection
+
+# 任务状态
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_SKIPPED = 'skipped'
+STATUS_SUPERSEDED = 'superseded'
+STATUS_FAILED = 'failed'
+FINISHED_STATUSES = (STATUS_DONE, STATUS_SKIPPED, STATUS_SUPERSEDED, STATUS_FAILED)
+
+# 审查任务依次经过的阶段，进度按阶段序号计算
+STAGES = ('queued', 'gitlab_fetch', 'preprocess', 'llm', 'post_note', 'done')
+
+
+def _superseded_message(job_id: str) -> str:
+    return f'被新任务 {job_id} 替代'
+
+
+class JobStatusStore:
+    """
+    记录 MCP 提交的审查任务的状态、当前阶段和结果。
+    MCP 服务和 worker 进程（async 的 worker 池或 rq worker）通过同一个 SQLite 文件共享状态。
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = get_connection(self.path)
+        if not self._initialized:
+            with self._init_lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS review_job (
+                        job_id TEXT PRIMARY KEY,
+                        mr_key TEXT,
+                        status TEXT NOT NULL,
+                        stage TEXT NOT NULL,
+                        message TEXT,
+                        score INTEGER,
+                        url TEXT,
+                        review_result TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_review_job_mr_key ON review_job (mr_key, status);
+                    CREATE INDEX IF NOT EXISTS idx_review_job_updated_at ON review_job (updated_at);
+                """)
+                self._initialized = True
+        return conn
+
+    def create(self, mr_key: str = None) -> str:
+        """登记一个排队中的任务并返回任务 ID；同一个 MR 排队中的旧任务会被静默期合并，标记为 superseded"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        try:
+            conn = self._conn()
+            if mr_key:
+                conn.execute("UPDATE review_job SET status = ?, message = ?, updated_at = ? "
+                             "WHERE mr_key = ? AND status = ?",
+                             (STATUS_SUPERSEDED, _superseded_message(job_id), now, mr_key, STATUS_QUEUED))
+            conn.execute("DELETE FROM review_job WHERE updated_at < ?", (now - self.ttl,))
+            conn.execute("INSERT INTO review_job (job_id, mr_key, status, stage, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (job_id, mr_key, STATUS_QUEUED, 'queued', now, now))
+        except Exception as e:
+            logger.error(f"登记审查任务失败: {e}")
+        return job_id
+
+    def discard(self, job_id: str):
+        """删除没能入队的任务，并恢复登记它时被标记为 superseded 的排队中任务"""
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM review_job WHERE job_id = ?", (job_id,))
+            conn.execute("UPDATE review_job SET status = ?, message = NULL, updated_at = ? "
+                         "WHERE status = ? AND message = ?",
+                         (STATUS_QUEUED, time.time(), STATUS_SUPERSEDED, _superseded_message(job_id)))
+        except Exception as e:
+            logger.error(f"删除审查任务 {job_id} 失败: {e}")
+
+    def update(self, job_id: Optional[str], stage: str = None, status: str = STATUS_RUNNING, message: str = None,
+               score: int = None, url: str = None, review_result: str = None):
+        """job_id 为空（webhook 触发的任务）时不记录"""
+        if not job_id:
+            return
+        try:
+            self._conn().execute(
+                "UPDATE review_job SET status = ?, stage = COALESCE(?, stage), message = COALESCE(?, message), "
+                "score = COALESCE(?, score), url = COALESCE(?, url), review_result = COALESCE(?, review_result), "
+                "updated_at = ? WHERE job_id = ?",
+                (status, stage, message, score, url, review_result, time.time(), job_id))
+        except Exception as e:
+            logger.error(f"更新审查任务 {job_id} 状态失败: {e}")
+
+    def get(self, job_id: str, include_result: bool = False) -> Optional[dict]:
+        columns = ['job_id', 'status', 'stage', 'message', 'score', 'url', 'created_at', 'updated_at']
+        if include_result:
+            columns.append('review_result')
+        row = self._conn().execute(f"SELECT {', '.join(columns)} FROM review_job WHERE job_id = ?",
+                                   (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(columns, row))
+        job['progress'] = len(STAGES) - 1 if job['status'] in FINISHED_STATUSES else STAGES.index(job['stage'])
+        job['total'] = len(STAGES) - 1
+        return job
+
+
+_job_status_store = None
+
+
+def get_job_status_store() -> JobStatusStore:
+    global _job_status_store
+    if _job_status_store is None:
+        _job_status_store = JobStatusStore(os.getenv('REVIEW_JOB_PATH', 'data/review_job.db'),
+                                           float(os.getenv('REVIEW_JOB_TTL', 7 * 24 * 3600)))
+    return _job_status_store
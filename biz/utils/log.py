@@ -1,6 +1,10 @@
+import atexit
 import logging
+import multiprocessing
 import os
-from logging.handlers import RotatingFileHandler
+import random
+import reprlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 class CustomLogger(logging.Logger):
     def warn(self, msg, *args, **kwargs):
@@ -12,19 +16,122 @@ class CustomLogger(logging.Logger):
         super().error(msg_with_emoji, *args, **kwargs)
 
 
+class LazyRotatingFileHandler(RotatingFileHandler):
+    """第一次写日志时才创建目录并打开文件，导入模块（包括只查看帮助或执行检查的命令）时不产生日志文件"""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        directory = os.path.dirname(self.baseFilename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return super()._open()
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    第一次写日志时才启动后台写日志的 listener 线程，导入模块时不启动线程。
+    只有创建 handler 的进程启动 listener；fork 出的 worker 进程只把日志记录放入继承的队列，由父进程的 listener 写出。
+    """
+
+    def __init__(self, log_queue, listener: QueueListener):
+        super().__init__(log_queue)
+        self.listener = listener
+        self.owner_pid = os.getpid()
+        self.started = False
+
+    def start_listener(self):
+        # 由 logging 的 handler 锁串行调用
+        if self.started or os.getpid() != self.owner_pid:
+            return
+        self.listener.start()
+        self.started = True
+        atexit.register(self.stop_listener)
+
+    def stop_listener(self):
+        # 只有启动 listener 的进程负责停止，worker 进程退出时不处理
+        if self.started and os.getpid() == self.owner_pid:
+            self.listener.stop()
+            self.started = False
+
+    def emit(self, record: logging.LogRecord):
+        self.start_listener()
+        super().emit(record)
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    在格式化之前截断过大的参数（webhook payload、完整 diff、LLM messages、响应体等），
+    容器类型用 reprlib 生成有限长度的表示，不会先把整个对象转成字符串。
+    超长的 DEBUG/INFO 日志按 sample_rate 采样，WARNING 及以上总是保留。
+    """
+
+    def __init__(self, max_chars: int, sample_rate: float):
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+        self._repr = reprlib.Repr()
+        self._repr.maxstring = max_chars
+        self._repr.maxother = max_chars
+        self._repr.maxlist = self._repr.maxtuple = self._repr.maxset = 20
+        self._repr.maxdict = 20
+        self._repr.maxlevel = 4
+
+    def _truncate(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            text = bytes(value[:self.max_chars]).decode('utf-8', errors='replace')
+            oversized = len(value) > self.max_chars
+        elif isinstance(value, str):
+            text = value[:self.max_chars]
+            oversized = len(value) > self.max_chars
+        elif isinstance(value, (list, tuple, dict, set)):
+            text = self._repr.repr(value)
+            oversized = len(text) > self.max_chars or '...' in text
+            text = text[:self.max_chars]
+        else:
+            return value, False
+        if oversized:
+            text += f"...(truncated, {len(value)} {'chars' if isinstance(value, (str, bytes, bytearray)) else 'items'})"
+        return text, oversized
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.max_chars <= 0:
+            return True
+        oversized = False
+        # 带参数的 msg 是格式字符串，不能截断
+        if not record.args and isinstance(record.msg, str) and len(record.msg) > self.max_chars:
+            record.msg, oversized = self._truncate(record.msg)
+        if isinstance(record.args, tuple) and record.args:
+            args = []
+            for arg in record.args:
+                arg, arg_oversized = self._truncate(arg)
+                oversized = oversized or arg_oversized
+                args.append(arg)
+            record.args = tuple(args)
+        if oversized and record.levelno < logging.WARNING and self.sample_rate < 1:
+            return random.random() < self.sample_rate
+        return True
+
+
 log_file = os.environ.get("LOG_FILE", "log/app.log")
 log_max_bytes = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))  # 默认10MB
 log_backup_count = int(os.environ.get("LOG_BACKUP_COUNT", 5))  # 默认保留5个备份文件
 log_level = os.environ.get("LOG_LEVEL", "INFO")
 LOG_LEVEL = getattr(logging, log_level.upper(), logging.INFO)
+log_max_field_chars = int(os.environ.get("LOG_MAX_FIELD_CHARS", 2000))  # 单个字段最多记录的字符数，0 表示不截断
+log_large_sample_rate = float(os.environ.get("LOG_LARGE_SAMPLE_RATE", 1))  # 超长日志的采样比例
+# rq 默认的 worker 为每个任务 fork 子进程并以 os._exit 退出，来不及写出队列中的日志，默认同步写；
+# 不 fork 的 rq worker（RQ_WORKER_MODE=simple）是常驻进程，与 async 模式相同
+ephemeral_worker = os.environ.get("QUEUE_DRIVER") == "rq" and os.environ.get("RQ_WORKER_MODE", "fork") == "fork"
+log_async = os.environ.get("LOG_ASYNC", "0" if ephemeral_worker else "1") == "1"
 
-file_handler = RotatingFileHandler(
+file_handler = LazyRotatingFileHandler(
     filename=log_file,
     mode='a',
     maxBytes=log_max_bytes,
     backupCount=log_backup_count,
     encoding='utf-8',
-    delay=False
 )
 file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(funcName)s:%(lineno)d - %(message)s'))
 file_handler.setLevel(LOG_LEVEL)
@@ -36,5 +143,24 @@ console_handler.setLevel(LOG_LEVEL)
 
 logger = CustomLogger(__name__)
 logger.setLevel(LOG_LEVEL)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger.addFilter(TruncatingFilter(log_max_field_chars, log_large_sample_rate))
+
+queue_handler = None
+if log_async:
+    # 业务线程只把日志记录放入队列，由后台线程统一写文件和控制台。
+    # 使用 multiprocessing.Queue：fork 出的 worker 进程继承同一个队列，日志都由当前进程的 listener 写入，
+    # 避免多个进程同时写（和轮转）同一个日志文件。
+    log_queue = multiprocessing.Queue(-1)
+    queue_handler = LazyQueueHandler(
+        log_queue, QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True))
+    logger.addHandler(queue_handler)
+else:
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+
+
+def start_log_listener():
+    """在 fork worker 进程之前调用，确保 worker 写入队列的日志有当前进程的 listener 写出"""
+    if queue_handler is not None:
+        with queue_handler.lock:
+            queue_handler.start_listener()
@@ -0,0 +1,160 @@
+import functools
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from biz.utils.log import logger
+
+_prometheus = None
+_prometheus_lock = threading.Lock()
+
+
+def _prometheus_client():
+    """
+    第一次记录指标（或启动 /metrics 端点）时才导入 prometheus_client，导入本模块没有副作用。
+    prometheus_client 的多进程模式：每个进程把指标写到 PROMETHEUS_MULTIPROC_DIR 下的 mmap 文件，/metrics 端点汇总所有
+    worker 进程；该变量必须在导入 prometheus_client 之前设置，未配置时使用 data/metrics，fork 出的 worker 进程继承。
+    """
+    global _prometheus
+    if _prometheus is None:
+        with _prometheus_lock:
+            if _prometheus is None:
+                os.makedirs(os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', 'data/metrics'), exist_ok=True)
+                import prometheus_client
+                _prometheus = prometheus_client
+    return _prometheus
+
+
+class _LazyMetric:
+    """指标的占位对象，第一次调用 labels 时才创建 prometheus_client 中的 Counter / Histogram"""
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: list, **kwargs):
+        self._kind = kind
+        self._args = (name, documentation, labelnames)
+        self._kwargs = kwargs
+        self._metric = None
+        self._lock = threading.Lock()
+
+    def labels(self, *args, **kwargs):
+        if self._metric is None:
+            with self._lock:
+                if self._metric is None:
+                    self._metric = getattr(_prometheus_client(), self._kind)(*self._args, **self._kwargs)
+        return self._metric.labels(*args, **kwargs)
+
+
+def Counter(name: str, documentation: str, labelnames: list) -> _LazyMetric:
+    return _LazyMetric('Counter', name, documentation, labelnames)
+
+
+def Histogram(name: str, documentation: str, labelnames: list, buckets: tuple) -> _LazyMetric:
+    return _LazyMetric('Histogram', name, documentation, labelnames, buckets=buckets)
+
+
+# 覆盖毫秒级的 GitLab 请求到分钟级的 LLM 调用
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+# 所有指标都带 label：多进程模式下不带 label 的指标在创建时就会生成 mmap 文件，清理目录后会丢失
+JOB_DURATION = Histogram('review_job_duration_seconds', '审查任务从开始执行到结束的耗时',
+                         ['event', 'outcome'], buckets=LATENCY_BUCKETS)
+QUEUE_WAIT = Histogram('review_queue_wait_seconds', '任务从入队到开始执行的等待时间',
+                       ['driver'], buckets=LATENCY_BUCKETS)
+STAGE_DURATION = Histogram('review_stage_duration_seconds', '审查流水线各阶段耗时',
+                           ['stage'], buckets=LATENCY_BUCKETS)
+GITLAB_REQUESTS = Histogram('gitlab_request_duration_seconds', 'GitLab API 请求耗时（按状态码）',
+                            ['method', 'status'], buckets=LATENCY_BUCKETS)
+LLM_REQUESTS = Histogram('llm_request_duration_seconds', 'LLM 请求总耗时',
+                         ['model', 'outcome'], buckets=LATENCY_BUCKETS)
+LLM_FIRST_TOKEN = Histogram('llm_first_token_seconds', '流式 LLM 请求的首 token 延迟',
+                            ['model'], buckets=LATENCY_BUCKETS)
+# kind: prompt / completion，以及 prompt 中命中 / 未命中服务端上下文缓存的 cache_hit / cache_miss
+LLM_TOKENS = Counter('llm_tokens_total', 'LLM 消耗的 token 数', ['model', 'kind'])
+DIFF_TOKENS = Counter('review_diff_tokens_total', 'diff 预处理后的 token 数', ['kind'])
+# kind: raw / compact，预处理前后的 diff 字符数
+DIFF_CHARS = Counter('review_diff_chars_total', 'diff 预处理前后的字符数', ['kind'])
+REVIEW_CACHE = Counter('review_cache_requests_total', 'Review 缓存查询次数', ['result'])
+# event: selected（首选）、hedged（发出对冲请求）、won（结果被采用）、failover（失败后切换）、error
+LLM_ROUTER_EVENTS = Counter('llm_router_events_total', 'LLM 路由在各后端上的事件数', ['backend', 'event'])
+# reason: disabled（未开启分档）、branch（目标分支）、large / medium / small（按 diff 大小）
+REVIEW_TIER = Counter('review_tier_total', '审查任务选择的模型档位', ['tier', 'reason'])
+REVIEW_SCORE = Histogram('review_score', '各模型档位的审查得分（不含调用失败没有得分的任务）', ['tier'],
+                         buckets=(20, 40, 50, 60, 70, 80, 90, 100))
+
+
+@contextmanager
+def track_stage(stage: str):
+    """记录一个流水线阶段的耗时，阶段抛出异常时同样记录"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage=stage).observe(time.perf_counter() - started_at)
+
+
+def observe_queue_wait(driver: str, enqueued_at: float):
+    if enqueued_at:
+        QUEUE_WAIT.labels(driver=driver).observe(max(0.0, time.time() - enqueued_at))
+
+
+def observe_llm_usage(model: str, prompt_tokens: int, completion_tokens: int, cache_hit_tokens: int = None,
+                      cache_miss_tokens: int = None):
+    LLM_TOKENS.labels(model=model, kind='prompt').inc(prompt_tokens or 0)
+    LLM_TOKENS.labels(model=model, kind='completion').inc(completion_tokens or 0)
+    # 服务端没有返回缓存命中情况（或按本地编码估算的用量）时不记录，避免拉低命中率
+    if cache_hit_tokens is not None:
+        LLM_TOKENS.labels(model=model, kind='cache_hit').inc(cache_hit_tokens)
+        LLM_TOKENS.labels(model=model, kind='cache_miss').inc(cache_miss_tokens or 0)
+
+
+def track_job(event: str):
+    """
+    装饰 worker 的任务函数，记录任务耗时；rq 模式下同时记录任务在 Redis 队列中的等待时间
+    （async 模式的等待时间由 worker 池记录）。
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if os.getenv('QUEUE_DRIVER', 'async') == 'rq':
+                from rq import get_current_job
+                job = get_current_job()
+                if job is not None and job.enqueued_at:
+                    QUEUE_WAIT.labels(driver='rq').observe(
+                        max(0.0, time.time() - job.enqueued_at.timestamp()))
+            started_at = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = function(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                JOB_DURATION.labels(event=event, outcome=outcome).observe(time.perf_counter() - started_at)
+
+        return wrapper
+
+    return decorator
+
+
+def start_metrics_server(port: int, addr: str = '0.0.0.0'):
+    """
+    在主进程中启动 Prometheus /metrics 端点，需在 worker 进程启动之前调用：
+    先清理上次运行残留的指标文件，再由 MultiProcessCollector 汇总所有进程的指标。
+    rq 模式下同一台机器上的 rq worker 需设置相同的 PROMETHEUS_MULTIPROC_DIR。
+    """
+    prometheus_client = _prometheus_client()
+    from prometheus_client import multiprocess
+
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for name in os.listdir(metrics_dir):
+        path = os.path.join(metrics_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    prometheus_client.start_http_server(port, addr=addr, registry=registry)
+    logger.info(f"Prometheus metrics endpoint listening on {addr}:{port}")
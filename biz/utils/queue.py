@@ -1,25 +1,313 @@
+import atexit
+import importlib
+import multiprocessing
 import os
-from multiprocessing import Process
+import queue
+import threading
+import time
+from datetime import timedelta
+from typing import List, Optional
 
-from redis import Redis
-from rq import Queue
-
-from biz.utils.log import logger
+from biz.report.delivery import flush_delivery, max_flush_seconds
+from biz.utils.coalesce import rollback_generation
+from biz.utils.jobStatus import STATUS_FAILED, get_job_status_store
+from biz.utils.log import logger, start_log_listener
+from biz.utils.metrics import observe_queue_wait
+from biz.utils.reviewHistory import get_review_history_store
 
 queue_driver = os.getenv('QUEUE_DRIVER', 'async')
 
-if queue_driver == 'rq':
-    queues = {}
+# rq 模式下每个 GitLab 实例（url_slug）一个队列，共用一个 Redis 连接池
+queues = {}
+
+# 队列满时的处理策略
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+
+class QueueFullError(Exception):
+    """任务队列已满（overflow 策略为 reject，或 block 超时）"""
+
+
+def _fail_job(kwargs: dict, message: str):
+    """任务没能进入队列时把对应的审查任务标记为失败，避免状态一直停在 queued"""
+    get_job_status_store().update(kwargs.get('review_job_id'), status=STATUS_FAILED, message=message)
+
+
+def _preload(modules: list):
+    # 预热：提前导入耗时的模块（openai、tiktoken 等），避免每个任务重复付出导入成本
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.error(f"Worker 预加载模块 {module} 失败: {e}")
+
+
+def _worker_loop(task_queue, in_flight, preload_modules: list):
+    # fork 出的 worker 已经继承了父进程中导入的模块，这里只在 spawn 方式启动时生效
+    _preload(preload_modules)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        function, args, kwargs, enqueued_at = task
+        observe_queue_wait('async', enqueued_at)
+        with in_flight.get_lock():
+            in_flight.value += 1
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Worker 执行任务 {getattr(function, '__name__', function)} 失败: {e}")
+        finally:
+            with in_flight.get_lock():
+                in_flight.value -= 1
+
+    # worker 进程退出时不执行 atexit，写出尚未落盘的审查历史，并等待积压的钉钉消息发送完成
+    get_review_history_store().flush()
+    flush_delivery()
+
+
+class WorkerPool:
+    """
+    常驻的多进程 worker 池：固定数量的 worker 从有界队列中取任务执行，
+    队列满时按 overflow_policy 处理（block / reject / drop_oldest）。
+    """
+
+    def __init__(self, size: int, max_size: int, overflow_policy: str = OVERFLOW_BLOCK,
+                 block_timeout: float = None, preload_modules: list = None):
+        if overflow_policy not in (OVERFLOW_BLOCK, OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unsupported overflow policy: {overflow_policy}")
+        self.size = size
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.preload_modules = preload_modules or []
+        self._queue = multiprocessing.Queue(maxsize=max_size)
+        self._in_flight = multiprocessing.Value('i', 0)
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def _spawn(self) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=_worker_loop,
+                                          args=(self._queue, self._in_flight, self.preload_modules),
+                                          daemon=True)
+        process.start()
+        return process
+
+    def start(self):
+        with self._lock:
+            # 模块在使用时才导入（服务启动和命令行工具不必等待），拉起 worker 之前在父进程中导入一次，
+            # fork 出的 worker 共享这部分内存，不必各自导入
+            if not self._processes:
+                _preload(self.preload_modules)
+                start_log_listener()
+            # 补齐已退出的 worker
+            self._processes = [p for p in self._processes if p.is_alive()]
+            while len(self._processes) < self.size:
+                self._processes.append(self._spawn())
+
+    def submit(self, function: callable, *args, **kwargs):
+        self.start()
+        task = (function, args, kwargs, time.time())
+        if self.overflow_policy == OVERFLOW_BLOCK:
+            try:
+                self._queue.put(task, timeout=self.block_timeout)
+            except queue.Full:
+                raise QueueFullError(f"Task queue is full (max_size={self.max_size})")
+        elif self.overflow_policy == OVERFLOW_REJECT:
+            try:
+                self._queue.put_nowait(task)
+            except queue.Full:
+                raise QueueFullError(f"Task queue is full (max_size={self.max_size})")
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(task)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self._queue.get_nowait()
+                        logger.warn(f"Task queue is full, drop oldest task: {getattr(dropped[0], '__name__', dropped[0])}")
+                        _fail_job(dropped[2], '任务队列已满，被新任务挤出')
+                    except queue.Empty:
+                        pass
+
+    def is_full(self, reserved: int = 0) -> bool:
+        """队列中的任务数加上 reserved（已受理、尚未提交的任务数）是否达到上限；平台不支持 qsize 时按未满处理"""
+        try:
+            depth = self._queue.qsize()
+        except NotImplementedError:
+            return False
+        return depth + reserved >= self.max_size
+
+    def stats(self) -> dict:
+        try:
+            depth = self._queue.qsize()
+        except NotImplementedError:
+            depth = -1
+        return {
+            'driver': 'async',
+            'depth': depth,
+            'in_flight': self._in_flight.value,
+            'workers': sum(1 for p in self._processes if p.is_alive()),
+            'max_size': self.max_size,
+            'overflow_policy': self.overflow_policy,
+        }
+
+    def shutdown(self, timeout: float = None):
+        """
+        通知 worker 退出，最多等待 timeout 秒后强制结束；
+        timeout 为空时按 worker 退出前等待钉钉消息发送的最长时间（见 flush_delivery）再多等 5 秒。
+        """
+        if timeout is None:
+            timeout = max_flush_seconds() + 5
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            for process in self._processes:
+                if process.is_alive():
+                    try:
+                        self._queue.put_nowait(None)
+                    except queue.Full:
+                        break
+            for process in self._processes:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+            self._processes = []
 
 
-def handle_queue(function: callable, data: any, token: str, url: str, url_slug: str):
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+# async 模式下等待静默期结束的任务，同一个 key 只保留最新的一个
+_pending_timers = {}
+_pending_timers_lock = threading.Lock()
+
+
+def get_worker_pool() -> WorkerPool:
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            block_timeout = os.getenv('QUEUE_BLOCK_TIMEOUT')
+            _worker_pool = WorkerPool(
+                size=int(os.getenv('QUEUE_WORKERS', os.cpu_count() or 2)),
+                max_size=int(os.getenv('QUEUE_MAX_SIZE', 100)),
+                overflow_policy=os.getenv('QUEUE_OVERFLOW_POLICY', OVERFLOW_BLOCK),
+                block_timeout=float(block_timeout) if block_timeout else None,
+                preload_modules=['openai', 'tiktoken', 'biz.queue.worker'],
+            )
+            atexit.register(_worker_pool.shutdown)
+        return _worker_pool
+
+
+def start_worker_pool():
+    """在服务启动时预先拉起 worker，避免第一个请求承担进程启动成本"""
+    if queue_driver != 'rq':
+        get_worker_pool().start()
+
+
+def queue_stats() -> dict:
     if queue_driver == 'rq':
-        if url_slug not in queues:
-            logger.info(f'REDIS_HOST: {os.getenv("REDIS_HOST", "127.0.0.1")}，REDIS_PORT: {os.getenv("REDIS_PORT", 6379)}')
-            queues[url_slug] = Queue(url_slug, connection=Redis(os.getenv('REDIS_HOST', '127.0.0.1'),
-                                                                              os.getenv('REDIS_PORT', 6379)))
+        return {
+            'driver': 'rq',
+            'depth': sum(q.count for q in queues.values()),
+            'in_flight': sum(q.started_job_registry.count for q in queues.values()),
+            'queues': list(queues.keys()),
+        }
+    stats = get_worker_pool().stats()
+    stats['pending'] = len(_pending_timers)
+    return stats
+
+
+def _submit_later(key: str, delay: float, function: callable, *args, **kwargs):
+    """
+    静默期结束后再提交任务；同一个 key 在静默期内有新任务时，旧任务直接取消。
+    overflow 策略为 reject 时在受理时就检查容量（队列中的任务加上静默期内的任务），满了直接抛出 QueueFullError；
+    静默期结束时仍然提交失败的，撤销本次事件的代数，并把对应的审查任务标记为失败。
+    """
+    pool = get_worker_pool()
+
+    def fire():
+        with _pending_timers_lock:
+            if _pending_timers.get(key) is timer:
+                del _pending_timers[key]
+        try:
+            pool.submit(function, *args, **kwargs)
+        except QueueFullError as e:
+            logger.warn(f"任务队列已满，丢弃任务 {key}: {e}")
+            # 调用方已拿到任务 ID，任务标记为失败；代数撤销后同一个 MR 执行中的旧任务照常完成
+            rollback_generation(key, kwargs.get('generation'))
+            _fail_job(kwargs, '任务队列已满')
+
+    timer = threading.Timer(delay, fire)
+    timer.daemon = True
+    with _pending_timers_lock:
+        if (pool.overflow_policy == OVERFLOW_REJECT and key not in _pending_timers
+                and pool.is_full(reserved=len(_pending_timers))):
+            raise QueueFullError(f"Task queue is full (max_size={pool.max_size}, pending={len(_pending_timers)})")
+        previous = _pending_timers.pop(key, None)
+        if previous:
+            previous.cancel()
+            logger.info(f"任务 {key} 在静默期内有新事件，取消排队中的旧任务")
+        _pending_timers[key] = timer
+    timer.start()
 
-        queues[url_slug].enqueue(function, data, token, url, url_slug)
+
+def get_rq_queue(url_slug: str):
+    """rq 和 redis 只在 rq 模式下用到，使用时才导入"""
+    if url_slug not in queues:
+        from rq import Queue
+
+        from biz.utils.redisUtil import get_redis
+        logger.info(f'REDIS_HOST: {os.getenv("REDIS_HOST", "127.0.0.1")}，REDIS_PORT: {os.getenv("REDIS_PORT", 6379)}')
+        queues[url_slug] = Queue(url_slug, connection=get_redis())
+    return queues[url_slug]
+
+
+def handle_queue(function: callable, data: any, token: str, url: str, url_slug: str,
+                 delay: float = 0, coalesce_key: str = None, **kwargs):
+    """
+    delay 大于 0 时任务在静默期之后才执行；配合 coalesce_key，静默期内同一个 key 的新任务会替换旧任务。
+    其余 kwargs 原样传给 function。
+    """
+    if queue_driver == 'rq':
+        # 通过 args / kwargs 显式传参：直接展开时 job_id、timeout 等参数会被 rq 当作自己的选项取走
+        args = (data, token, url, url_slug)
+        if delay > 0:
+            # 需要 worker 以 --with-scheduler 启动；被替换的旧任务在 worker 中按事件代数跳过
+            get_rq_queue(url_slug).enqueue_in(timedelta(seconds=delay), function, args=args, kwargs=kwargs)
+        else:
+            get_rq_queue(url_slug).enqueue(function, args=args, kwargs=kwargs)
+    elif delay > 0 and coalesce_key:
+        _submit_later(coalesce_key, delay, function, data, token, url, url_slug, **kwargs)
     else:
-        process = Process(target=function, args=(data, token, url, url_slug))
-        process.start()
+        get_worker_pool().submit(function, data, token, url, url_slug, **kwargs)
+
+
+def enqueue_many(function: callable, jobs: List[tuple]) -> List[Optional[str]]:
+    """
+    批量提交任务（不支持静默期），jobs 为 (data, token, url, url_slug, kwargs) 的列表。
+    rq 模式下同一个队列的任务在一个 pipeline 中入队（一次 Redis 往返）；async 模式下逐个提交到 worker 池。
+    返回与 jobs 一一对应的列表：成功为 None，队列已满时为错误信息。
+    """
+    if queue_driver != 'rq':
+        errors = []
+        for data, token, url, url_slug, kwargs in jobs:
+            try:
+                get_worker_pool().submit(function, data, token, url, url_slug, **kwargs)
+                errors.append(None)
+            except QueueFullError as e:
+                errors.append(str(e))
+        return errors
+
+    from rq import Queue
+
+    by_slug = {}
+    for data, token, url, url_slug, kwargs in jobs:
+        by_slug.setdefault(url_slug, []).append(
+            Queue.prepare_data(function, args=(data, token, url, url_slug), kwargs=kwargs))
+    for url_slug, job_datas in by_slug.items():
+        get_rq_queue(url_slug).enqueue_many(job_datas)
+    return [None] * len(jobs)
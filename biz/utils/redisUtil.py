@@ -0,0 +1,21 @@
+import os
+import threading
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_redis():
+    """
+    获取共享连接池的 Redis 客户端（rq 模式下的队列、限流和 MR 事件代数共用一个连接池）。
+    redis-py 的连接池在 fork 出的子进程中会自动丢弃父进程的连接，重新建立。
+    """
+    global _pool
+    from redis import ConnectionPool, Redis
+    with _pool_lock:
+        if _pool is None:
+            max_connections = os.getenv('REDIS_MAX_CONNECTIONS')
+            _pool = ConnectionPool(host=os.getenv('REDIS_HOST', '127.0.0.1'), port=int(os.getenv('REDIS_PORT', 6379)),
+                                   db=int(os.getenv('REDIS_DB', 0)), password=os.getenv('REDIS_PASSWORD') or None,
+                                   max_connections=int(max_connections) if max_connections else None)
+    return Redis(connection_pool=_pool)
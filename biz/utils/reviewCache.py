@@ -0,0 +1,110 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from biz.utils.log import logger
+from biz.utils.sqliteUtil import get_connection
+
+
+def _normalize(text: str) -> str:
+    # 统一换行并去掉行尾空白，避免无意义的差异导致缓存不命中
+    lines = (text or '').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def make_cache_key(diffs_text: str, commits_text: str, prompt_version: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for part in (_normalize(diffs_text), _normalize(commits_text), prompt_version, model or ''):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ReviewCache:
+    """
+    以内容哈希为键的 Review 结果缓存（SQLite 持久化），按 TTL 过期，
+    超过条目数或总大小上限时按最近访问时间淘汰（LRU）。
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = get_connection(self.path)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS review_cache (
+                        key TEXT PRIMARY KEY,
+                        review TEXT NOT NULL,
+                        score INTEGER NOT NULL,
+                        size INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        accessed_at REAL NOT NULL
+                    )""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_review_cache_accessed_at ON review_cache (accessed_at)")
+                self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT review, score, created_at FROM review_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if self.ttl and row[2] < now - self.ttl:
+                conn.execute("DELETE FROM review_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE review_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+        except Exception as e:
+            logger.error(f"读取 Review 缓存失败: {e}")
+            return None
+
+    def put(self, key: str, review: str, score: int):
+        try:
+            conn = self._conn()
+            now = time.time()
+            size = len(review.encode('utf-8'))
+            conn.execute("INSERT OR REPLACE INTO review_cache (key, review, score, size, created_at, accessed_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (key, review, score, size, now, now))
+            self._evict(conn, now)
+        except Exception as e:
+            logger.error(f"写入 Review 缓存失败: {e}")
+
+    def _evict(self, conn, now: float):
+        if self.ttl:
+            conn.execute("DELETE FROM review_cache WHERE created_at < ?", (now - self.ttl,))
+        count, total_size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM review_cache").fetchone()
+        while count > self.max_entries or total_size > self.max_bytes:
+            # 每次淘汰最久未访问的 10% 条目
+            batch = max(1, count // 10)
+            conn.execute("DELETE FROM review_cache WHERE key IN "
+                         "(SELECT key FROM review_cache ORDER BY accessed_at LIMIT ?)", (batch,))
+            count, total_size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM review_cache").fetchone()
+
+
+_review_cache = None
+
+
+def get_review_cache() -> Optional[ReviewCache]:
+    """REVIEW_CACHE_ENABLED=0 时返回 None"""
+    global _review_cache
+    if os.getenv('REVIEW_CACHE_ENABLED', '1') != '1':
+        return None
+    if _review_cache is None:
+        _review_cache = ReviewCache(
+            path=os.getenv('REVIEW_CACHE_PATH', 'data/review_cache.db'),
+            ttl=int(os.getenv('REVIEW_CACHE_TTL', 7 * 24 * 3600)),
+            max_entries=int(os.getenv('REVIEW_CACHE_MAX_ENTRIES', 5000)),
+            max_bytes=int(os.getenv('REVIEW_CACHE_MAX_BYTES', 100 * 1024 * 1024)),
+        )
+    return _review_cache
@@ -0,0 +1,247 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from biz.utils.log import logger
+from biz.utils.sqliteUtil import get_connection
+
+# project_name 为项目路径（group/project），project_id 为 GitLab 的项目 ID
+COLUMNS = ('kind', 'url_slug', 'project_name', 'project_id', 'author', 'source_branch', 'target_branch', 'url',
+           'score', 'commit_count', 'prompt_tokens', 'completion_tokens', 'duration_seconds', 'tier', 'model',
+           'diff_tokens', 'file_count', 'review_result', 'reviewed_at')
+
+# 聚合查询支持的分组方式
+GROUP_BY = {
+    'author': 'author',
+    'project': 'project_name',
+    'branch': 'target_branch',
+    'tier': 'tier',
+    'model': 'model',
+    'day': "strftime('%Y-%m-%d', reviewed_at, 'unixepoch', 'localtime')",
+    'week': "strftime('%Y-W%W', reviewed_at, 'unixepoch', 'localtime')",
+}
+
+
+def parse_time(value) -> Optional[float]:
+    """支持时间戳、'2024-01-01'、'2024-01-01 12:00:00' 以及相对时间 '7d' / '12h'"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    if value[-1:] in ('d', 'h') and value[:-1].isdigit():
+        delta = timedelta(days=int(value[:-1])) if value[-1] == 'd' else timedelta(hours=int(value[:-1]))
+        return (datetime.now() - delta).timestamp()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"无法解析时间: {value}")
+
+
+class ReviewHistoryStore:
+    """
+    审查历史（结果、得分、token 用量、耗时），按项目、作者、分支和时间建索引，供 MCP 工具查询。
+    写入先放入内存队列，由后台线程按批次在一个事务中写入，不占用审查任务的时间；
+    rq 默认的 worker 每个任务一个进程且不执行 atexit，此时直接同步写入（RQ_WORKER_MODE=simple 的 worker 除外）。
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, synchronous: bool = False):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = get_connection(self.path)
+        if not self._initialized:
+            with self._init_lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS review_history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        url_slug TEXT,
+                        project_name TEXT,
+                        project_id TEXT,
+                        author TEXT,
+                        source_branch TEXT,
+                        target_branch TEXT,
+                        url TEXT,
+                        score INTEGER,
+                        commit_count INTEGER,
+                        prompt_tokens INTEGER,
+                        completion_tokens INTEGER,
+                        duration_seconds REAL,
+                        tier TEXT,
+                        model TEXT,
+                        diff_tokens INTEGER,
+                        file_count INTEGER,
+                        review_result TEXT,
+                        reviewed_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_review_history_project ON review_history (project_name, reviewed_at);
+                    CREATE INDEX IF NOT EXISTS idx_review_history_project_id
+                        ON review_history (project_id, reviewed_at);
+                    CREATE INDEX IF NOT EXISTS idx_review_history_author ON review_history (author, reviewed_at);
+                    CREATE INDEX IF NOT EXISTS idx_review_history_branch ON review_history (target_branch, reviewed_at);
+                    CREATE INDEX IF NOT EXISTS idx_review_history_tier ON review_history (tier, reviewed_at);
+                    CREATE INDEX IF NOT EXISTS idx_review_history_time ON review_history (reviewed_at);
+                """)
+                self._initialized = True
+        return conn
+
+    def add(self, **record):
+        if record.get('project_id') is not None:
+            record['project_id'] = str(record['project_id'])
+        row = tuple(record.get(column) for column in COLUMNS[:-1]) + (record.get('reviewed_at') or time.time(),)
+        if self.synchronous:
+            self._write([row])
+            return
+        self._ensure_started()
+        self._queue.put(row)
+
+    def _ensure_started(self):
+        # fork 出的子进程中不存在父进程的后台线程，需要重新启动
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='review-history-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(rows)
+            for _ in rows:
+                self._queue.task_done()
+
+    def _write(self, rows: list):
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(f"INSERT INTO review_history ({', '.join(COLUMNS)}) "
+                                 f"VALUES ({', '.join('?' for _ in COLUMNS)})", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logger.error(f"写入审查历史失败，丢弃 {len(rows)} 条: {e}")
+
+    def flush(self, timeout: float = 10) -> bool:
+        """等待队列中的记录写入完成，超时返回 False"""
+        if self.synchronous or self._thread is None or self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    @staticmethod
+    def _where(project_name=None, author=None, branch=None, kind=None, tier=None, since=None, until=None) -> tuple:
+        """project_name 可以是项目路径（group/project）或项目 ID"""
+        clauses, params = [], []
+        if project_name:
+            clauses.append("(project_name = ? OR project_id = ?)")
+            params.extend([str(project_name), str(project_name)])
+        for column, value in (('author', author), ('target_branch', branch), ('kind', kind), ('tier', tier)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        since, until = parse_time(since), parse_time(until)
+        if since is not None:
+            clauses.append("reviewed_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("reviewed_at < ?")
+            params.append(until)
+        return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def query(self, page: int = 1, page_size: int = 20, include_result: bool = False, **filters) -> dict:
+        """按时间倒序分页查询审查记录"""
+        page, page_size = max(1, int(page)), min(max(1, int(page_size)), 200)
+        where, params = self._where(**filters)
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM review_history {where}", params).fetchone()[0]
+        columns = ['id'] + [column for column in COLUMNS if include_result or column != 'review_result']
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM review_history {where} "
+                            f"ORDER BY reviewed_at DESC LIMIT ? OFFSET ?",
+                            params + [page_size, (page - 1) * page_size]).fetchall()
+        return {
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'items': [dict(zip(columns, row)) for row in rows],
+        }
+
+    def aggregate(self, group_by: str = 'author', page: int = 1, page_size: int = 20, **filters) -> dict:
+        """
+        按作者/项目/分支/模型档位/模型/天/周分组统计审查次数、平均分、token 用量、平均 diff 大小和平均耗时
+        （得分为 0 表示调用失败，不计入平均分；失败率用于评估档位阈值）
+        """
+        if group_by not in GROUP_BY:
+            raise ValueError(f"group_by 只支持: {', '.join(GROUP_BY)}")
+        page, page_size = max(1, int(page)), min(max(1, int(page_size)), 200)
+        key = GROUP_BY[group_by]
+        # 按时间分组时按时间倒序，其余按审查次数倒序
+        order = "grp DESC" if group_by in ('day', 'week') else "COUNT(*) DESC, grp"
+        where, params = self._where(**filters)
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(DISTINCT {key}) FROM review_history {where}", params).fetchone()[0]
+        rows = conn.execute(f"""
+            SELECT {key} AS grp, COUNT(*), ROUND(AVG(NULLIF(score, 0)), 1), MIN(NULLIF(score, 0)), MAX(score),
+                   SUM(COALESCE(prompt_tokens, 0)), SUM(COALESCE(completion_tokens, 0)),
+                   ROUND(AVG(diff_tokens)), ROUND(AVG(score = 0), 3), ROUND(AVG(duration_seconds), 2),
+                   MAX(reviewed_at)
+            FROM review_history {where}
+            GROUP BY grp ORDER BY {order} LIMIT ? OFFSET ?""",
+                            params + [page_size, (page - 1) * page_size]).fetchall()
+        fields = (group_by, 'reviews', 'avg_score', 'min_score', 'max_score', 'prompt_tokens', 'completion_tokens',
+                  'avg_diff_tokens', 'failure_rate', 'avg_duration_seconds', 'last_reviewed_at')
+        return {
+            'group_by': group_by,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'items': [dict(zip(fields, row)) for row in rows],
+        }
+
+
+_review_history_store = None
+
+
+def get_review_history_store() -> ReviewHistoryStore:
+    global _review_history_store
+    if _review_history_store is None:
+        _review_history_store = ReviewHistoryStore(
+            path=os.getenv('REVIEW_HISTORY_PATH', 'data/review_history.db'),
+            batch_size=int(os.getenv('REVIEW_HISTORY_BATCH_SIZE', 50)),
+            flush_interval=float(os.getenv('REVIEW_HISTORY_FLUSH_INTERVAL', 1)),
+            synchronous=os.getenv('QUEUE_DRIVER', 'async') == 'rq' and os.getenv('RQ_WORKER_MODE', 'fork') == 'fork',
+        )
+        atexit.register(_review_history_store.flush)
+    return _review_history_store
@@ -0,0 +1,82 @@
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from biz.utils.log import logger
+from biz.utils.sqliteUtil import get_connection
+
+
+def summarize_review(review_text: str, score: int, max_chars: int) -> str:
+    """
+    把上一次的 Review 结果压缩成摘要：只保留“评分明细”之前的问题和建议部分，
+    超长时截断，并附上上次的得分。
+    """
+    text = review_text or ''
+    match = re.search(r"^#+\s*评分明细", text, flags=re.MULTILINE)
+    if match:
+        text = text[:match.start()]
+    text = text.strip()
+    if len(text) > max_chars:
+        text = text[:max_chars].rstrip() + '\n...(已截断)'
+    return f"{text}\n\n上次评分: {score}分"
+
+
+class ReviewStateStore:
+    """记录每个 MR (url_slug, project_id, iid) 最后一次审查到的 head SHA 和结论摘要"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = get_connection(self.path)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS mr_review_state (
+                        url_slug TEXT NOT NULL,
+                        project_id TEXT NOT NULL,
+                        iid TEXT NOT NULL,
+                        head_sha TEXT NOT NULL,
+                        summary TEXT NOT NULL,
+                        score INTEGER NOT NULL,
+                        updated_at REAL NOT NULL,
+                        PRIMARY KEY (url_slug, project_id, iid)
+                    )""")
+                self._initialized = True
+        return conn
+
+    def get(self, url_slug: str, project_id, iid) -> Optional[dict]:
+        try:
+            row = self._conn().execute(
+                "SELECT head_sha, summary, score, updated_at FROM mr_review_state "
+                "WHERE url_slug = ? AND project_id = ? AND iid = ?",
+                (url_slug, str(project_id), str(iid))).fetchone()
+        except Exception as e:
+            logger.error(f"读取 MR 审查状态失败: {e}")
+            return None
+        if row is None:
+            return None
+        return {'head_sha': row[0], 'summary': row[1], 'score': row[2], 'updated_at': row[3]}
+
+    def save(self, url_slug: str, project_id, iid, head_sha: str, summary: str, score: int):
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO mr_review_state "
+                "(url_slug, project_id, iid, head_sha, summary, score, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url_slug, str(project_id), str(iid), head_sha, summary, score, time.time()))
+        except Exception as e:
+            logger.error(f"保存 MR 审查状态失败: {e}")
+
+
+_review_state_store = None
+
+
+def get_review_state_store() -> ReviewStateStore:
+    global _review_state_store
+    if _review_state_store is None:
+        _review_state_store = ReviewStateStore(os.getenv('REVIEW_STATE_PATH', 'data/review_state.db'))
+    return _review_state_store
@@ -0,0 +1,94 @@
+import fnmatch
+import os
+from typing import Optional
+
+# 提示词变体：full 为完整的审查要求，light 要求只列出关键问题，输出更短
+PROMPT_FULL = 'full'
+PROMPT_LIGHT = 'light'
+
+
+class ReviewTier:
+    """
+    一个模型档位：model 为空时使用 LLM 后端配置的模型，max_input_tokens 为单次请求的 diff token 上限（超过时拆块），
+    max_output_tokens 为空时不限制输出长度。
+    """
+
+    def __init__(self, name: str, model: Optional[str], max_input_tokens: int, max_output_tokens: Optional[int],
+                 prompt: str):
+        self.name = name
+        self.model = model or None
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens or None
+        self.prompt = prompt
+
+
+class TierDecision:
+    """一次选档的结果和依据，写入审查历史，用于按数据调整阈值"""
+
+    def __init__(self, tier: ReviewTier, reason: str, diff_tokens: int, file_count: int):
+        self.tier = tier
+        self.reason = reason
+        self.diff_tokens = diff_tokens
+        self.file_count = file_count
+
+
+class TieringPolicy:
+    """
+    按 diff 的 token 数、文件数和目标分支选择模型档位：
+    小改动（token 数和文件数都不超过 light 阈值）使用便宜快速的 light 档位，
+    大改动（token 数或文件数达到 strong 阈值）以及目标分支命中 strong_branches 的 MR 使用 strong 档位，
+    其余以及未开启分档时使用 standard 档位（与不分档时的行为相同）。
+    """
+
+    def __init__(self, enabled: bool, light: ReviewTier, standard: ReviewTier, strong: ReviewTier,
+                 light_max_tokens: int, light_max_files: int, strong_min_tokens: int, strong_min_files: int,
+                 strong_branches: list):
+        self.enabled = enabled
+        self.light = light
+        self.standard = standard
+        self.strong = strong
+        self.light_max_tokens = light_max_tokens
+        self.light_max_files = light_max_files
+        self.strong_min_tokens = strong_min_tokens
+        self.strong_min_files = strong_min_files
+        self.strong_branches = strong_branches
+
+    def choose(self, diff_tokens: int, file_count: int, target_branch: str = None) -> TierDecision:
+        if not self.enabled:
+            return TierDecision(self.standard, 'disabled', diff_tokens, file_count)
+        if target_branch and any(fnmatch.fnmatch(target_branch, pattern) for pattern in self.strong_branches):
+            return TierDecision(self.strong, 'branch', diff_tokens, file_count)
+        if diff_tokens >= self.strong_min_tokens or file_count >= self.strong_min_files:
+            return TierDecision(self.strong, 'large', diff_tokens, file_count)
+        if diff_tokens <= self.light_max_tokens and file_count <= self.light_max_files:
+            return TierDecision(self.light, 'small', diff_tokens, file_count)
+        return TierDecision(self.standard, 'medium', diff_tokens, file_count)
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.getenv(name, '').strip()
+    return int(value) if value else None
+
+
+_tiering_policy = None
+
+
+def get_tiering_policy() -> TieringPolicy:
+    global _tiering_policy
+    if _tiering_policy is None:
+        review_max_tokens = int(os.getenv('REVIEW_MAX_TOKENS', 10000))
+        _tiering_policy = TieringPolicy(
+            enabled=os.getenv('REVIEW_TIERING_ENABLED', '0') == '1',
+            light=ReviewTier('light', os.getenv('REVIEW_TIER_LIGHT_MODEL'), review_max_tokens,
+                             _optional_int('REVIEW_TIER_LIGHT_MAX_OUTPUT_TOKENS'), PROMPT_LIGHT),
+            standard=ReviewTier('standard', None, review_max_tokens, None, PROMPT_FULL),
+            strong=ReviewTier('strong', os.getenv('REVIEW_TIER_STRONG_MODEL'),
+                              int(os.getenv('REVIEW_TIER_STRONG_MAX_TOKENS', review_max_tokens)),
+                              _optional_int('REVIEW_TIER_STRONG_MAX_OUTPUT_TOKENS'), PROMPT_FULL),
+            light_max_tokens=int(os.getenv('REVIEW_TIER_LIGHT_MAX_DIFF_TOKENS', 1000)),
+            light_max_files=int(os.getenv('REVIEW_TIER_LIGHT_MAX_FILES', 3)),
+            strong_min_tokens=int(os.getenv('REVIEW_TIER_STRONG_MIN_DIFF_TOKENS', 20000)),
+            strong_min_files=int(os.getenv('REVIEW_TIER_STRONG_MIN_FILES', 50)),
+            strong_branches=[p.strip() for p in os.getenv('REVIEW_TIER_STRONG_BRANCHES', '').split(',') if p.strip()],
+        )
+    return _tiering_policy
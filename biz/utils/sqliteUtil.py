@@ -0,0 +1,27 @@
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def get_connection(path: str) -> sqlite3.Connection:
+    """
+    获取当前线程对指定 SQLite 文件的连接（WAL 模式，autocommit）。
+    连接按线程缓存；fork 出的子进程会重新建立连接，不复用父进程的句柄。
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'pid', None) != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+
+    conn = connections.get(path)
+    if conn is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        connections[path] = conn
+    return conn
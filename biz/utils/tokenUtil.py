@@ -1,26 +1,45 @@
-import tiktoken
+import functools
+import os
+from typing import List, Tuple
 
+DEFAULT_ENCODING = "cl100k_base"
 
-def count_tokens(text: str) -> int:
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING):
     """
     cl100k_base 是一种 tokenizer（分词器），用于将文本转换为模型可处理的 token 序列。Token 是文本处理中的基本单位，可以是字符、子词或词语，模型通过分析 token 之间的关系理解语义。
+    每个进程只加载一次编码器（BPE 文件的加载和解析开销较大），tiktoken 在第一次使用时才导入。
     """
-    encoding = tiktoken.get_encoding("cl100k_base")  # 适用于 OpenAI GPT 系列
-    return len(encoding.encode(text))
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)  # 适用于 OpenAI GPT 系列
+
+
+def _encode(text: str, encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    # 代码中可能出现 <|endoftext|> 之类的特殊 token 文本，按普通文本处理
+    return get_encoding(encoding_name).encode(text, disallowed_special=())
 
 
-def truncate_text_by_tokens(text: str, max_tokens: int, encoding_name: str = "cl100k_base") -> str:
-    # 获取编码器
-    encoding = tiktoken.get_encoding(encoding_name)
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    return len(_encode(text, encoding_name))
 
-    # 将文本编码为 tokens
-    tokens = encoding.encode(text)
 
-    # 如果 tokens 数量超过最大限制，则截断
+def count_and_truncate(text: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> Tuple[int, str]:
+    """只编码一次，同时返回原文的 token 数和截断到 max_tokens 后的文本"""
+    tokens = _encode(text, encoding_name)
     if len(tokens) > max_tokens:
-        truncated_tokens = tokens[:max_tokens]
-        truncated_text = encoding.decode(truncated_tokens)
-        return truncated_text
+        return len(tokens), get_encoding(encoding_name).decode(tokens[:max_tokens])
+    return len(tokens), text
+
+
+def truncate_text_by_tokens(text: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> str:
+    return count_and_truncate(text, max_tokens, encoding_name)[1]
 
-    return text
 
+def count_tokens_batch(texts: List[str], encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    """批量计算 token 数，tiktoken 内部使用多线程并行编码"""
+    if not texts:
+        return []
+    num_threads = int(os.getenv("TOKENIZER_THREADS", 8))
+    encoded = get_encoding(encoding_name).encode_batch(texts, num_threads=num_threads, disallowed_special=())
+    return [len(tokens) for tokens in encoded]
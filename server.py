@@ -1,13 +1,20 @@
+import asyncio
 import os
 import json
+import time
 import logging
 from typing import Optional, Dict, Any, List
 from dataclasses import dataclass
 from contextlib import asynccontextmanager
 from collections.abc import AsyncIterator
-from urllib.parse import quote
 import requests
+from biz.gitlab.gitlabClient import get_gitlab_client
 from biz.service import service
+from biz.service.sweep import format_progress, format_summary_table, sweep_open_merge_requests
+from biz.utils.jobStatus import FINISHED_STATUSES, get_job_status_store, STATUS_QUEUED
+from biz.utils.metrics import start_metrics_server
+from biz.utils.queue import queue_stats, start_worker_pool
+from biz.utils.reviewHistory import get_review_history_store
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP, Context
 
@@ -33,18 +40,13 @@ def make_gitlab_api_request(ctx: Context, endpoint: str, method: str = "GET",
         logger.error("GitLab token not set in context")
         raise ValueError("GitLab token not set. Please set GITLAB_TOKEN in your environment.")
 
-    url = f"{gitlab_ctx.host}/api/{gitlab_ctx.api_version}/{endpoint}"
-    headers = {
-        'Accept': 'application/json',
-        'User-Agent': 'GitLabMCPCodeReview/1.0',
-        'Private-Token': gitlab_ctx.token
-    }
+    client = get_gitlab_client(gitlab_ctx.host, gitlab_ctx.token)
 
     try:
         if method.upper() == "GET":
-            response = requests.get(url, headers=headers, verify=True)
+            response = client.get(endpoint, verify=True)
         elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=data, verify=True)
+            response = client.post(endpoint, json=data, verify=True)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
 
@@ -91,6 +93,8 @@ async def gitlab_lifespan(server: FastMCP) -> AsyncIterator[GitLabContext]:
 
 
 port = int(os.environ.get('PORT', 8001))
+# waitReviewJob 轮询任务状态的间隔（秒）
+JOB_POLL_INTERVAL = float(os.environ.get('REVIEW_JOB_POLL_INTERVAL', 1))
 mcp = FastMCP(
     "GitLab MCP for Code Review",
     description="MCP server for reviewing GitLab code changes",
@@ -101,13 +105,112 @@ mcp = FastMCP(
 
 @mcp.tool()
 def analysisMergeRequest(ctx: Context, project_id: str, iid: str) -> Dict[str, Any]:
-    mr_endpoint = f"projects/{quote(project_id, safe='')}/merge_requests/{iid}"
-    mergeInfo = make_gitlab_api_request(ctx, mr_endpoint)
+    """
+    提交 MR 审查任务并立即返回 job_id，不等待 LLM 审查完成。
+    用 reviewJobStatus 查询进度、reviewJobResult 获取结果，或用 waitReviewJob 等待并接收进度通知。
+    """
+    # MR 元数据由 worker 与 changes、commits 并发获取，这里不再串行请求一次
+    mergeInfo = {'project_id': project_id, 'iid': iid}
+    payload, status = service.handle_gitlab(mergeInfo)
+    if status != 200:
+        raise ValueError(payload.get('message') or payload.get('error'))
+    return {'job_id': payload['job_id'], 'status': STATUS_QUEUED}
 
-    if not mergeInfo:
-        raise ValueError(f"Merge request {iid} not found in project {project_id}")
 
-    service.handle_gitlab(mergeInfo);
+def _get_job(job_id: str, include_result: bool = False) -> Dict[str, Any]:
+    job = get_job_status_store().get(job_id, include_result=include_result)
+    if job is None:
+        raise ValueError(f"Review job {job_id} not found")
+    return job
+
+
+@mcp.tool()
+def reviewJobStatus(ctx: Context, job_id: str) -> Dict[str, Any]:
+    """
+    查询审查任务的状态和当前阶段（queued、gitlab_fetch、preprocess、llm、post_note、done）。
+    status 为 done、skipped、superseded、failed 时任务已结束。
+    """
+    return _get_job(job_id)
+
+
+@mcp.tool()
+def reviewJobResult(ctx: Context, job_id: str) -> Dict[str, Any]:
+    """获取审查任务的结果（得分和完整的审查意见），任务未结束时只返回状态"""
+    return _get_job(job_id, include_result=True)
+
+
+@mcp.tool()
+async def waitReviewJob(ctx: Context, job_id: str, timeout: float = 60) -> Dict[str, Any]:
+    """
+    等待审查任务结束，期间每进入一个新阶段发送一次 MCP 进度通知。
+    超过 timeout 秒仍未结束时返回当前状态，可再次调用继续等待。
+    """
+    deadline = time.monotonic() + min(float(timeout), 600)
+    reported = None
+    while True:
+        job = await asyncio.to_thread(_get_job, job_id, True)
+        if (job['stage'], job['status']) != reported:
+            reported = (job['stage'], job['status'])
+            await ctx.report_progress(job['progress'], job['total'])
+        if job['status'] in FINISHED_STATUSES or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+@mcp.tool()
+async def sweepOpenMergeRequests(ctx: Context, project_id: str = None, group_id: str = None, concurrency: int = 4,
+                                 force: bool = False, dry_run: bool = False, timeout: float = 3600) -> Dict[str, Any]:
+    """
+    审查项目或群组（包含子群组）中所有打开状态的 MR，同时执行的任务数不超过 concurrency。
+    默认跳过当前 head 已审查过的 MR；force 为 true 时全部重新完整审查（例如修改 prompt 后重新评分）；
+    dry_run 为 true 时只列出需要审查的 MR。每个 MR 有结论时发送进度通知，最后返回汇总表。
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_progress(event: dict):
+        asyncio.run_coroutine_threadsafe(ctx.report_progress(event['done'], event['total']), loop)
+        asyncio.run_coroutine_threadsafe(ctx.info(format_progress(event)), loop)
+
+    result = await asyncio.to_thread(sweep_open_merge_requests, project_id=project_id, group_id=group_id,
+                                     concurrency=concurrency, force=force, dry_run=dry_run, timeout=timeout,
+                                     on_progress=on_progress)
+    result['table'] = format_summary_table(result)
+    return result
+
+
+@mcp.tool()
+def queueStatus(ctx: Context) -> Dict[str, Any]:
+    """查看代码审查任务队列的当前深度和正在执行的任务数"""
+    return queue_stats()
+
+
+@mcp.tool()
+def reviewHistory(ctx: Context, project_name: str = None, author: str = None, branch: str = None,
+                  kind: str = None, tier: str = None, since: str = None, until: str = None, page: int = 1,
+                  page_size: int = 20, include_result: bool = False) -> Dict[str, Any]:
+    """
+    分页查询审查历史，按审查时间倒序。
+    project_name 为项目路径（group/project）或项目 ID；kind 为 merge_request 或 push；tier 为模型档位 light / standard / strong；
+    since/until 支持 '2024-01-01'、'2024-01-01 12:00:00' 或相对时间 '7d'、'12h'；
+    include_result 为 true 时返回完整的审查结果。
+    """
+    return get_review_history_store().query(page=page, page_size=page_size, include_result=include_result,
+                                            project_name=project_name, author=author, branch=branch, kind=kind,
+                                            tier=tier, since=since, until=until)
+
+
+@mcp.tool()
+def reviewStats(ctx: Context, group_by: str = 'author', project_name: str = None, author: str = None,
+                branch: str = None, kind: str = None, tier: str = None, since: str = None, until: str = None,
+                page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+    """
+    按 author / project / branch / tier / model / day / week 分组统计审查次数、平均分、最低分、最高分、token 用量、
+    平均 diff token 数、失败率和平均耗时，过滤条件与 reviewHistory 相同，按审查次数倒序分页。
+    按 tier 分组可以对比各模型档位的得分和成本，用于调整分档阈值。
+    """
+    return get_review_history_store().aggregate(group_by=group_by, page=page, page_size=page_size,
+                                                project_name=project_name, author=author, branch=branch,
+                                                kind=kind, tier=tier, since=since, until=until)
 
 
 
@@ -115,6 +218,11 @@ if __name__ == "__main__":
     try:
         logger.info(f"Starting MCP Server on port {port}...")
         logger.info("Starting GitLab Review MCP server")
+        metrics_port = int(os.environ.get('METRICS_PORT', 8002))
+        if metrics_port:
+            # 需在 worker 进程启动之前清理旧的指标文件
+            start_metrics_server(metrics_port)
+        start_worker_pool()
         # Initialize and run the server
         mcp.run(transport='sse')
     except Exception as e:
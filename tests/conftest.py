@@ -0,0 +1,82 @@
+"""
+测试环境：数据库、日志、指标和限流文件都写到临时目录（需在导入 biz 模块之前设置）；
+tiktoken 第一次使用时需要下载 BPE 文件，单元测试中换成按空白切分的编码器，token 数等于单词数。
+"""
+import os
+import re
+import tempfile
+
+import pytest
+
+_work_dir = tempfile.mkdtemp(prefix='code-review-test-')
+os.environ.update({
+    'QUEUE_DRIVER': 'async',
+    'LOG_FILE': os.path.join(_work_dir, 'log', 'app.log'),
+    'LOG_ASYNC': '0',
+    'PROMETHEUS_MULTIPROC_DIR': os.path.join(_work_dir, 'metrics'),
+    'RATE_LIMIT_DIR': os.path.join(_work_dir, 'rate_limit'),
+    'REVIEW_STATE_PATH': os.path.join(_work_dir, 'review_state.db'),
+    'REVIEW_HISTORY_PATH': os.path.join(_work_dir, 'review_history.db'),
+    'REVIEW_JOB_PATH': os.path.join(_work_dir, 'review_job.db'),
+    'REVIEW_CACHE_PATH': os.path.join(_work_dir, 'review_cache.db'),
+    'REVIEW_CACHE_ENABLED': '0',
+    'DEEPSEEK_API_KEY': 'test',
+    'DEEPSEEK_API_MODEL': 'test-model',
+    'LLM_RPM': '0',
+    'LLM_TPM': '0',
+})
+
+
+class WordEncoding:
+    """按空白切分的编码器，encode 返回单词在词表中的序号"""
+
+    _pattern = re.compile(r'\s*\S+')
+
+    def __init__(self):
+        self.vocab = {}
+        self.words = []
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        tokens = []
+        for word in self._pattern.findall(text):
+            if word not in self.vocab:
+                self.vocab[word] = len(self.words)
+                self.words.append(word)
+            tokens.append(self.vocab[word])
+        return tokens
+
+    def encode_batch(self, texts: list, num_threads: int = 1, disallowed_special=()) -> list:
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens: list) -> str:
+        return ''.join(self.words[token] for token in tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_tokenizer(monkeypatch):
+    from biz.utils import tokenUtil
+    encoding = WordEncoding()
+    monkeypatch.setattr(tokenUtil, 'get_encoding', lambda encoding_name=tokenUtil.DEFAULT_ENCODING: encoding)
+    return encoding
+
+
+@pytest.fixture
+def fake_services(monkeypatch):
+    """启动模拟的 GitLab（含钉钉机器人）和 LLM 服务，环境变量指向它们"""
+    from bench.fakes import FakeGitLab, FakeOpenAI
+    from biz.llm import router
+
+    gitlab = FakeGitLab()
+    llm = FakeOpenAI(first_token_latency=0, tokens_per_second=100000)
+    gitlab.start()
+    llm.start()
+    monkeypatch.setenv('GITLAB_URL', gitlab.url)
+    monkeypatch.setenv('GITLAB_ACCESS_TOKEN', 'test-token')
+    monkeypatch.setenv('DEEPSEEK_API_BASE_URL', llm.url)
+    monkeypatch.setenv('DINGTALK_WEBHOOK_URL', f"{gitlab.url}/robot/send")
+    monkeypatch.setenv('DINGTALK_RATE_PER_MINUTE', '0')
+    # LLM 客户端在第一次使用时按环境变量创建
+    monkeypatch.setattr(router, '_client', None)
+    yield gitlab, llm
+    gitlab.stop()
+    llm.stop()
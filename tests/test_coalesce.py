@@ -0,0 +1,58 @@
+import pytest
+
+from biz.utils import coalesce
+from biz.utils.coalesce import RedisGenerationStore, SqliteGenerationStore, coalesce_key, is_superseded
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def store(request, tmp_path, monkeypatch):
+    if request.param == 'sqlite':
+        store = SqliteGenerationStore(str(tmp_path / 'state.db'))
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        store = RedisGenerationStore(fakeredis.FakeRedis())
+    monkeypatch.setattr(coalesce, '_generation_store', store)
+    return store
+
+
+def test_bump_increments_per_key(store):
+    key = coalesce_key('gitlab', 1, 2)
+    assert store.current(key) == 0
+    assert [store.bump(key), store.bump(key)] == [1, 2]
+    assert store.current(key) == 2
+    assert store.current(coalesce_key('gitlab', 1, 3)) == 0
+
+
+def test_older_generation_is_superseded(store):
+    key = coalesce_key('gitlab', 1, 2)
+    first = store.bump(key)
+    assert not is_superseded(key, first)
+    second = store.bump(key)
+    assert is_superseded(key, first)
+    assert not is_superseded(key, second)
+
+
+def test_missing_key_or_generation_is_never_superseded(store):
+    assert not is_superseded(None, 1)
+    assert not is_superseded(coalesce_key('gitlab', 1, 2), None)
+
+
+def test_store_errors_do_not_drop_the_review(monkeypatch):
+    class BrokenStore:
+        def current(self, key):
+            raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(coalesce, '_generation_store', BrokenStore())
+    assert not is_superseded(coalesce_key('gitlab', 1, 2), 1)
+
+
+def test_rollback_only_undoes_the_latest_bump(store):
+    key = coalesce_key('gitlab', 1, 2)
+    first = store.bump(key)
+    second = store.bump(key)
+    store.rollback(key, second)
+    assert store.current(key) == first
+    # 之后又有新事件时不撤销
+    store.bump(key)
+    store.rollback(key, first)
+    assert store.current(key) == second
@@ -0,0 +1,119 @@
+import pytest
+
+from biz.utils import codeReview
+from biz.utils.codeReview import CodeReviewer
+from biz.utils.diffPreprocess import preprocess_changes
+from biz.utils.reviewTier import PROMPT_FULL, ReviewTier, TieringPolicy
+
+
+def make_change(path: str, words: int) -> dict:
+    body = "".join(f"+word{n}\n" for n in range(words))
+    return {'new_path': path, 'diff': f"@@ -0,0 +1,{words} @@\n{body}"}
+
+
+class FakeClient:
+    """按顺序由 models 中的模型给出结果，每次都返回 80 分"""
+
+    def __init__(self, models=('test-model',)):
+        self.models = list(models)
+        self.requests = []
+
+    def candidate_models(self, model=None):
+        return [model] if model else self.models
+
+    def route(self, messages, model=None, usage=None, max_tokens=None, estimated_tokens=0, priority=None):
+        self.requests.append(messages)
+        return "总分:80分", model or self.models[(len(self.requests) - 1) % len(self.models)]
+
+
+@pytest.fixture
+def small_tier(monkeypatch):
+    """单次请求的 diff 上限为 50 个 token"""
+    tier = ReviewTier('standard', None, 50, None, PROMPT_FULL)
+    policy = TieringPolicy(False, tier, tier, tier, 0, 0, 0, 0, [])
+    monkeypatch.setattr(codeReview, 'get_tiering_policy', lambda: policy)
+    return tier
+
+
+@pytest.fixture
+def reviewer(small_tier, monkeypatch):
+    """每次调用 LLM 都返回 80 分"""
+    reviewer = CodeReviewer()
+    reviewer.reviewed = []
+
+    def review_code(diffs_text, commits_text="", previous_summary="", diff_tokens=None):
+        reviewer.reviewed.append((diffs_text, diff_tokens))
+        return "### 问题\n无\n\n总分:80分"
+
+    monkeypatch.setattr(reviewer, 'review_code', review_code)
+    return reviewer
+
+
+def test_reviews_every_chunk_by_default(reviewer, monkeypatch):
+    monkeypatch.delenv('REVIEW_MAX_CHUNKS', raising=False)
+    changes = [make_change(f"src/file{n}.py", 30) for n in range(12)]
+
+    result = reviewer.review_changes(changes, "feat: change")
+
+    assert len(reviewer.reviewed) == 12
+    assert "未审查的文件" not in result
+    assert CodeReviewer.parse_review_score(result) == 80
+
+
+def test_lists_files_beyond_max_chunks(reviewer, monkeypatch):
+    monkeypatch.setenv('REVIEW_MAX_CHUNKS', '2')
+    changes = [make_change(f"src/file{n}.py", 30) for n in range(4)]
+
+    result = reviewer.review_changes(changes, "feat: change")
+
+    assert len(reviewer.reviewed) == 2
+    unreviewed = result.split("## 未审查的文件")[1]
+    assert "src/file2.py" in unreviewed and "src/file3.py" in unreviewed
+    assert "src/file0.py" not in unreviewed
+    assert CodeReviewer.parse_review_score(result) == 80
+
+
+def test_merge_weights_scores_by_tokens(reviewer):
+    chunks = [[make_change("a.py", 30)], [make_change("b.py", 10)]]
+    merged = reviewer.merge_chunk_reviews(chunks, ["总分:90分", "审查失败: timeout"])
+    # 失败的分块没有得分，不参与加权
+    assert CodeReviewer.parse_review_score(merged) == 90
+    assert merged.count("总分") == 2  # 最终总分的标题和得分行，各分块的“总分”已改名
+
+
+def test_diff_is_encoded_once_per_review(small_tier, word_tokenizer, monkeypatch):
+    encoded = []
+    encode = word_tokenizer.encode
+    monkeypatch.setattr(word_tokenizer, 'encode',
+                        lambda text, disallowed_special=(): encoded.append(text) or encode(text))
+    changes, stats = preprocess_changes([make_change(f"src/file{n}.py", 30) for n in range(4)])
+    reviewer = CodeReviewer()
+    reviewer.client = FakeClient()
+
+    result = reviewer.review_changes(changes, "feat: change", token_counts=stats['token_counts'])
+
+    assert len(reviewer.client.requests) == 4
+    assert CodeReviewer.parse_review_score(result) == 80
+    # 预处理时编码一次，之后的选档、拆块、限流估算和合并加权都不再编码 diff
+    for n in range(4):
+        assert sum(f"src/file{n}.py" in text for text in encoded) == 1
+
+
+def test_served_model_is_recorded_and_keys_the_cache(small_tier, tmp_path, monkeypatch):
+    from biz.utils import reviewCache
+    monkeypatch.setenv('REVIEW_CACHE_ENABLED', '1')
+    monkeypatch.setenv('REVIEW_CACHE_PATH', str(tmp_path / 'cache.db'))
+    monkeypatch.setattr(reviewCache, '_review_cache', None)
+    changes = [make_change("src/app.py", 10)]
+
+    first = CodeReviewer()
+    first.client = FakeClient(models=['backup-model', 'primary-model'])
+    first.review_changes(changes, "feat: change")
+    assert first.model == 'backup-model'
+
+    # 首选后端换了模型，仍然命中备用模型给出的缓存结果
+    second = CodeReviewer()
+    second.client = FakeClient(models=['primary-model', 'backup-model'])
+    second.review_changes(changes, "feat: change")
+    assert second.client.requests == []
+    assert second.model == 'backup-model'
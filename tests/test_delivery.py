@@ -0,0 +1,155 @@
+import multiprocessing
+import queue
+from collections import deque
+
+import pytest
+
+from biz.report import delivery
+from biz.report.delivery import DingTalkDelivery, PendingMessage
+from biz.report.dingtalk import DingTalkNotifier
+
+WEBHOOK_URL = 'http://dingtalk.invalid/robot/send'
+
+
+class FakeBackend:
+    """按顺序返回预设的等待时间，用完后不再限流"""
+
+    def __init__(self, waits: list):
+        self.waits = list(waits)
+
+    def try_acquire(self, *args):
+        return self.waits.pop(0) if self.waits else 0
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """记录发出的消息；列表中放入异常或 (ok, throttled) 时按顺序作为 post 的结果"""
+    messages, results = [], []
+
+    def post(post_url, message):
+        messages.append(message)
+        result = results.pop(0) if results else (True, False)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(DingTalkNotifier, 'post', staticmethod(post))
+    return messages, results
+
+
+def make_delivery(count: int, rate_per_minute: float = 0, max_retries: int = 3) -> DingTalkDelivery:
+    """不启动后台线程，直接在 pending 中放入 count 条消息"""
+    target = DingTalkDelivery(rate_per_minute=rate_per_minute, digest_threshold=3, max_retries=max_retries)
+    target._pending[WEBHOOK_URL] = deque(
+        PendingMessage(WEBHOOK_URL, {'text': n}, 'title', 'group/app', f"MR {n}", score=80 + n,
+                       url=f"http://gitlab.invalid/group/app/-/merge_requests/{n}")
+        for n in range(count))
+    target._outstanding = count
+    return target
+
+
+def deliver(target: DingTalkDelivery, times: int):
+    for _ in range(times):
+        # 跳过退避等待
+        target._retry_at.clear()
+        target._deliver(WEBHOOK_URL)
+
+
+def test_connection_errors_count_as_attempts(sent):
+    _, results = sent
+    results.extend(ConnectionError('refused') for _ in range(10))
+    target = make_delivery(1, max_retries=2)
+
+    deliver(target, 3)
+
+    assert not target._pending[WEBHOOK_URL]
+    assert target.flush(timeout=0.1)
+
+
+def test_message_is_sent_after_transient_error(sent):
+    messages, results = sent
+    results.append(ValueError('not json'))
+    target = make_delivery(1)
+
+    deliver(target, 2)
+
+    assert messages == [{'text': 0}, {'text': 0}]
+    assert target.flush(timeout=0.1)
+
+
+def test_backlog_is_sent_one_by_one_without_throttling(sent):
+    messages, _ = sent
+    target = make_delivery(4)
+
+    deliver(target, 4)
+
+    assert messages == [{'text': n} for n in range(4)]
+
+
+def test_digest_only_after_rate_limit(sent, monkeypatch):
+    messages, _ = sent
+    target = make_delivery(4, rate_per_minute=20)
+    backend = FakeBackend([1])
+    monkeypatch.setattr(target, '_backend', lambda webhook_url: backend)
+
+    deliver(target, 2)
+
+    assert len(messages) == 1
+    text = messages[0]['markdown']['text']
+    assert "4 条审查报告" in text
+    assert "MR 2，得分: 82，[查看详情](http://gitlab.invalid/group/app/-/merge_requests/2)" in text
+    assert target.flush(timeout=0.1)
+    assert WEBHOOK_URL not in target._throttled
+
+
+
+@pytest.fixture
+def short_backoff(monkeypatch):
+    """限流退避 0.2 秒，退避结束后最多再等 0.5 秒发送"""
+    monkeypatch.setattr(delivery, 'MAX_BACKOFF', 0.2)
+    monkeypatch.setattr(delivery, 'SEND_GRACE', 0.5)
+
+
+def test_flush_waits_for_throttled_retry(sent, short_backoff):
+    messages, results = sent
+    results.append((False, True))
+    target = DingTalkDelivery(rate_per_minute=0, digest_threshold=3, max_retries=3)
+
+    target.submit(WEBHOOK_URL, {'text': 0})
+
+    assert target.flush(timeout=0.05)
+    assert messages == [{'text': 0}, {'text': 0}]
+
+
+def test_flush_reports_undelivered_messages(sent, short_backoff, monkeypatch):
+    _, results = sent
+    results.extend((False, True) for _ in range(100))
+    errors = []
+    monkeypatch.setattr(delivery.logger, 'error', lambda message, *args: errors.append(message))
+    target = DingTalkDelivery(rate_per_minute=0, digest_threshold=3, max_retries=100)
+
+    target.submit(WEBHOOK_URL, {'text': 0})
+    target.submit(WEBHOOK_URL, {'text': 1})
+
+    assert not target.flush(timeout=0.05)
+    assert "2 条消息未发出" in errors[-1]
+    # 后台线程不再重试，以免影响之后的测试
+    target._pending[WEBHOOK_URL].clear()
+
+
+def test_worker_exit_flushes_delivery(sent, monkeypatch):
+    from biz.utils.queue import _worker_loop
+
+    messages, _ = sent
+    monkeypatch.setenv('DINGTALK_RATE_PER_MINUTE', '0')
+    monkeypatch.setattr(delivery, '_delivery', None)
+
+    def report():
+        delivery.get_delivery().submit(WEBHOOK_URL, {'text': 'report'})
+
+    tasks = queue.Queue()
+    tasks.put((report, (), {}, 0))
+    tasks.put(None)
+    _worker_loop(tasks, multiprocessing.Value('i', 0), [])
+
+    assert messages == [{'text': 'report'}]
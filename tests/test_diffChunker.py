@@ -0,0 +1,29 @@
+from biz.utils.diffChunker import split_changes
+from biz.utils.diffPreprocess import render_change
+from biz.utils.tokenUtil import count_tokens
+
+
+def make_hunk(start: int, words: int) -> str:
+    return f"@@ -{start},0 +{start},{words} @@\n" + "".join(f"+w{start}_{n}\n" for n in range(words))
+
+
+def test_files_are_packed_into_chunks_with_token_totals():
+    changes = [{'new_path': f"f{n}.py", 'diff': make_hunk(1, 10)} for n in range(5)]
+    chunks, chunk_tokens = split_changes(changes, max_tokens=40)
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert chunk_tokens == [sum(count_tokens(render_change(change)) for change in chunk) for chunk in chunks]
+
+
+def test_oversized_file_is_split_on_hunk_boundaries():
+    change = {'new_path': 'big.py', 'diff': make_hunk(1, 20) + make_hunk(100, 20) + make_hunk(200, 20)}
+    chunks, chunk_tokens = split_changes([change], max_tokens=40)
+    assert len(chunks) == 3
+    assert [piece['diff'].count('@@ -') for chunk in chunks for piece in chunk] == [1, 1, 1]
+    assert all(tokens <= 40 for tokens in chunk_tokens)
+
+
+def test_precomputed_token_counts_are_used(word_tokenizer, monkeypatch):
+    changes = [{'new_path': f"f{n}.py", 'diff': make_hunk(1, 10)} for n in range(3)]
+    monkeypatch.setattr(word_tokenizer, 'encode', lambda *args, **kwargs: 1 / 0)
+    chunks, chunk_tokens = split_changes(changes, max_tokens=25, token_counts=[12, 12, 12])
+    assert chunk_tokens == [24, 12]
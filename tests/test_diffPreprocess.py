@@ -0,0 +1,53 @@
+from biz.utils.diffPreprocess import compact_diff, preprocess_changes
+
+
+def test_new_file_hunk_keeps_original_header():
+    diff = "@@ -0,0 +1,3 @@\n+a = 1\n+b = 2\n+c = 3"
+    compacted, dropped = compact_diff(diff, context_lines=2)
+    assert compacted.splitlines()[0] == "@@ -0,0 +1,3 @@"
+    assert dropped == 0
+
+
+def test_deletion_only_hunk_keeps_original_header():
+    diff = "@@ -4,2 +3,0 @@ def main():\n-x = 1\n-y = 2"
+    compacted, _ = compact_diff(diff, context_lines=2)
+    assert compacted.splitlines()[0] == "@@ -4,2 +3,0 @@ def main():"
+
+
+def test_split_hunk_recomputes_starts():
+    context = [f" line{n}" for n in range(1, 11)]
+    lines = ["-old2", "+new2"] + context + ["-old13"]
+    diff = "@@ -2,12 +2,11 @@ class A:\n" + "\n".join(lines)
+    compacted, _ = compact_diff(diff, context_lines=1)
+    headers = [line for line in compacted.splitlines() if line.startswith('@@')]
+    # 第一个片段从 hunk 第一行开始，沿用原来的起始行号；第二个片段从第 11 行的上下文开始
+    assert headers[0] == "@@ -2,2 +2,2 @@ class A:"
+    assert headers[1] == "@@ -12,2 +12,1 @@"
+
+
+def test_sub_hunk_with_only_deletions_points_at_previous_line():
+    context = [f" line{n}" for n in range(1, 11)]
+    diff = "@@ -1,12 +1,10 @@\n" + "\n".join(context + ["-gone11", "-gone12"])
+    compacted, _ = compact_diff(diff, context_lines=0)
+    # 删除第 11、12 行，新文件中位于第 10 行之后
+    assert compacted.splitlines()[0] == "@@ -11,2 +10,0 @@"
+
+
+def test_whitespace_only_hunk_is_dropped():
+    diff = "@@ -1,1 +1,1 @@\n-x=1\n+x = 1"
+    compacted, dropped = compact_diff(diff, context_lines=2)
+    assert compacted == "" and dropped == 1
+
+
+def test_preprocess_counts_only_compacted_diff(word_tokenizer):
+    changes = [
+        {'new_path': 'package-lock.json', 'diff': "@@ -1 +1 @@\n-a\n+b"},
+        {'new_path': 'app.py', 'new_file': True, 'diff': "@@ -0,0 +1,2 @@\n+import os\n+print(os.name)"},
+    ]
+    result, stats = preprocess_changes(changes)
+    assert [change['new_path'] for change in result] == ['app.py']
+    assert stats['skipped'] == {'package-lock.json': 'pattern'}
+    assert stats['raw_chars'] > stats['compact_chars']
+    assert stats['compact_tokens'] > 0
+    # 没有对整个变更列表的 repr 编码
+    assert not any('new_path' in word for word in word_tokenizer.words)
@@ -0,0 +1,36 @@
+from biz.gitlab.gitlabHandler import MergeRequestHandler
+
+SINCE_SHA = 'b' * 40
+
+
+def make_handler(gitlab) -> MergeRequestHandler:
+    return MergeRequestHandler({'project_id': '401', 'iid': 1}, 'test-token', gitlab.url)
+
+
+def test_incremental_diffs_respect_the_byte_ceiling(fake_services, monkeypatch):
+    gitlab, _ = fake_services
+    gitlab.add_project('401', files=5, lines=20)
+    file_bytes = len(gitlab.projects['401']['changes'][0]['diff'])
+    monkeypatch.setenv('REVIEW_MAX_DIFF_BYTES', str(file_bytes * 2))
+
+    snapshot = make_handler(gitlab).fetch_merge_request_snapshot(since_sha=SINCE_SHA)
+
+    assert snapshot.base_sha == SINCE_SHA
+    assert [change['new_path'] for change in snapshot.changes] == ['src/module_0.py', 'src/module_1.py']
+    assert snapshot.truncated
+
+
+def test_collapsed_incremental_diff_is_rebuilt_from_since_sha(fake_services, monkeypatch):
+    gitlab, _ = fake_services
+    gitlab.add_project('401', files=1, lines=5)
+    change = gitlab.projects['401']['changes'][0]
+    change.update({'diff': '', 'collapsed': True, 'new_file': False})
+    handler = make_handler(gitlab)
+    files = {SINCE_SHA: "a = 1\n", gitlab.projects['401']['commits'][-1]['id']: "a = 2\n"}
+    monkeypatch.setattr(handler, '_get_raw_file', lambda path, ref, limit: files[ref])
+
+    snapshot = handler.fetch_merge_request_snapshot(since_sha=SINCE_SHA)
+
+    [rebuilt] = snapshot.changes
+    assert rebuilt['diff'].splitlines()[1:] == ['-a = 1', '+a = 2']
+    assert not snapshot.truncated
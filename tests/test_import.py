@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+import pytest
+
+from bench import import_time
+
+
+def test_worker_import_has_no_side_effects():
+    with pytest.raises(SystemExit) as exit_info:
+        import_time.main(['--module', 'biz.queue.worker', '--runs', '1', '--budget-ms', '60000'])
+    assert exit_info.value.code == 0
+
+
+def test_log_listener_starts_on_first_record(tmp_path):
+    script = (
+        "import sys, threading\n"
+        "from biz.utils.log import logger, queue_handler\n"
+        "import biz.utils.metrics\n"
+        "assert threading.active_count() == 1, threading.enumerate()\n"
+        "assert 'prometheus_client' not in sys.modules\n"
+        "assert not queue_handler.started\n"
+        "logger.info('hello')\n"
+        "assert queue_handler.started\n"
+    )
+    env = {'PYTHONPATH': import_time.ROOT_DIR, 'LOG_ASYNC': '1', 'LOG_FILE': str(tmp_path / 'app.log'),
+           'PATH': ''}
+    result = subprocess.run([sys.executable, '-c', script], env=env, cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / 'app.log').read_text(encoding='utf-8').endswith('hello\n')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['app.log']
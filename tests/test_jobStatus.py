@@ -0,0 +1,70 @@
+from biz.utils import jobStatus
+from biz.utils.jobStatus import (STATUS_DONE, STATUS_QUEUED, STATUS_RUNNING, STATUS_SUPERSEDED, STAGES,
+                                 JobStatusStore)
+
+
+def make_store(tmp_path, ttl=3600) -> JobStatusStore:
+    return JobStatusStore(str(tmp_path / 'jobs.db'), ttl=ttl)
+
+
+def test_job_moves_through_stages(tmp_path):
+    store = make_store(tmp_path)
+    job_id = store.create('gitlab:1:2')
+    job = store.get(job_id)
+    assert (job['status'], job['stage'], job['progress']) == (STATUS_QUEUED, 'queued', 0)
+
+    store.update(job_id, stage='llm')
+    job = store.get(job_id)
+    assert (job['status'], job['progress'], job['total']) == (STATUS_RUNNING, STAGES.index('llm'), len(STAGES) - 1)
+
+    store.update(job_id, stage='done', status=STATUS_DONE, score=85, url='http://mr', review_result='总分:85分')
+    job = store.get(job_id, include_result=True)
+    assert (job['status'], job['score'], job['url']) == (STATUS_DONE, 85, 'http://mr')
+    assert job['review_result'] == '总分:85分'
+    assert job['progress'] == job['total']
+    assert 'review_result' not in store.get(job_id)
+
+
+def test_new_job_supersedes_queued_job_of_same_mr(tmp_path):
+    store = make_store(tmp_path)
+    old = store.create('gitlab:1:2')
+    running = store.create('gitlab:1:3')
+    store.update(running, stage='llm')
+    new = store.create('gitlab:1:2')
+
+    assert store.get(old)['status'] == STATUS_SUPERSEDED and new in store.get(old)['message']
+    assert store.get(running)['status'] == STATUS_RUNNING
+    assert store.get(new)['status'] == STATUS_QUEUED
+
+
+def test_discard_restores_jobs_it_superseded(tmp_path):
+    store = make_store(tmp_path)
+    old = store.create('gitlab:1:2')
+    rejected = store.create('gitlab:1:2')
+
+    store.discard(rejected)
+
+    assert store.get(rejected) is None
+    assert store.get(old)['status'] == STATUS_QUEUED and store.get(old)['message'] is None
+
+
+def test_update_without_job_id_is_ignored(tmp_path):
+    store = make_store(tmp_path)
+    store.update(None, status=STATUS_DONE)
+    assert store.get('missing') is None
+
+
+def test_expired_jobs_are_removed(tmp_path, monkeypatch):
+    class FakeClock:
+        now = 1000.0
+
+        def time(self) -> float:
+            return self.now
+
+    clock = FakeClock()
+    monkeypatch.setattr(jobStatus, 'time', clock)
+    store = make_store(tmp_path, ttl=60)
+    old = store.create()
+    clock.now += 61
+    store.create()
+    assert store.get(old) is None
@@ -0,0 +1,188 @@
+import threading
+import time
+
+import pytest
+
+from biz.gitlab.gitlabHandler import slugify_url
+from biz.queue.worker import handle_merge_request_event
+from biz.report.delivery import get_delivery
+from biz.service import service
+from biz.utils import queue as task_queue
+from biz.utils.coalesce import coalesce_key, get_generation_store
+from biz.utils.jobStatus import STATUS_DONE, STATUS_FAILED, STATUS_QUEUED, get_job_status_store
+from biz.utils.reviewHistory import get_review_history_store
+
+
+@pytest.fixture
+def rq_queue(monkeypatch):
+    """rq 模式，Redis 换成 fakeredis"""
+    fakeredis = pytest.importorskip('fakeredis')
+    from biz.utils import redisUtil
+
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(task_queue, 'queue_driver', 'rq')
+    monkeypatch.setattr(task_queue, 'queues', {})
+    monkeypatch.setattr(redisUtil, 'get_redis', lambda: connection)
+    return connection
+
+
+def run_rq_jobs(connection):
+    from rq import SimpleWorker
+    SimpleWorker(list(task_queue.queues.values()), connection=connection).work(burst=True)
+
+
+def test_rq_job_reports_status_to_job_store(fake_services, rq_queue):
+    gitlab, _ = fake_services
+    gitlab.add_project('101', files=2, lines=5)
+
+    response, status = service.handle_gitlab({'project_id': '101', 'iid': 1}, debounce_seconds=0)
+    assert status == 200
+    run_rq_jobs(rq_queue)
+
+    job = get_job_status_store().get(response['job_id'])
+    assert job['status'] == STATUS_DONE
+    assert ('merge_request', '101', 1) in gitlab.completed
+
+    history = get_review_history_store()
+    history.flush()
+    [record] = history.query(project_name='bench/101')['items']
+    assert record['project_id'] == '101'
+    assert (record['source_branch'], record['target_branch']) == ('feature/bench', 'develop')
+
+
+def test_rq_batch_jobs_report_status(fake_services, rq_queue):
+    gitlab, _ = fake_services
+    gitlab.add_project('102', files=1, lines=5)
+    gitlab.add_project('103', files=1, lines=5)
+
+    results = service.handle_gitlab_many([{'project_id': '102', 'iid': 1}, {'project_id': '103', 'iid': 1}])
+    run_rq_jobs(rq_queue)
+
+    store = get_job_status_store()
+    assert [store.get(response['job_id'])['status'] for response, _ in results] == [STATUS_DONE, STATUS_DONE]
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+@pytest.fixture
+def full_pool(monkeypatch):
+    """没有 worker 消费、容量为 1 的 worker 池，返回一个按策略创建并占满队列的函数"""
+    monkeypatch.setenv('GITLAB_URL', 'http://gitlab.invalid')
+    monkeypatch.setenv('GITLAB_ACCESS_TOKEN', 'test-token')
+    monkeypatch.setattr(task_queue, '_pending_timers', {})
+
+    def create(policy: str, block_timeout: float = None, fill: bool = True) -> task_queue.WorkerPool:
+        pool = task_queue.WorkerPool(size=0, max_size=1, overflow_policy=policy, block_timeout=block_timeout)
+        monkeypatch.setattr(task_queue, '_worker_pool', pool)
+        if fill:
+            pool.submit(noop)
+        return pool
+
+    return create
+
+
+def wait_for_status(job_id: str, status: str, timeout: float = 2, field: str = 'status') -> dict:
+    deadline = time.monotonic() + timeout
+    job = get_job_status_store().get(job_id)
+    while job[field] != status and time.monotonic() < deadline:
+        time.sleep(0.01)
+        job = get_job_status_store().get(job_id)
+    return job
+
+
+def test_debounced_submit_is_rejected_when_queue_is_full(full_pool):
+    full_pool(task_queue.OVERFLOW_REJECT)
+
+    response, status = service.handle_gitlab({'project_id': '1', 'iid': 1}, debounce_seconds=5)
+
+    assert status == 429
+    assert not task_queue._pending_timers
+
+
+def test_debounced_submits_reserve_queue_slots(full_pool):
+    full_pool(task_queue.OVERFLOW_REJECT, fill=False)
+
+    first, first_status = service.handle_gitlab({'project_id': '1', 'iid': 1}, debounce_seconds=5)
+    # 同一个 MR 的新事件替换静默期内的旧任务，不额外占用位置
+    second, second_status = service.handle_gitlab({'project_id': '1', 'iid': 1}, debounce_seconds=5)
+    third, third_status = service.handle_gitlab({'project_id': '1', 'iid': 2}, debounce_seconds=5)
+
+    assert (first_status, second_status, third_status) == (200, 200, 429)
+    for timer in task_queue._pending_timers.values():
+        timer.cancel()
+
+
+def test_debounced_job_fails_when_queue_is_still_full(full_pool):
+    full_pool(task_queue.OVERFLOW_BLOCK, block_timeout=0.01)
+
+    response, status = service.handle_gitlab({'project_id': '1', 'iid': 1}, debounce_seconds=0.01)
+
+    assert status == 200
+    job = wait_for_status(response['job_id'], STATUS_FAILED)
+    assert job['status'] == STATUS_FAILED and job['message'] == '任务队列已满'
+
+
+def test_dropped_task_marks_job_failed(full_pool):
+    pool = full_pool(task_queue.OVERFLOW_DROP_OLDEST, fill=False)
+    store = get_job_status_store()
+    dropped, kept = store.create(), store.create()
+
+    pool.submit(noop, review_job_id=dropped)
+    pool.submit(noop, review_job_id=kept)
+
+    assert store.get(dropped)['status'] == STATUS_FAILED
+    assert store.get(kept)['status'] == STATUS_QUEUED
+
+
+def test_debounce_keeps_only_the_latest_task(full_pool):
+    pool = full_pool(task_queue.OVERFLOW_BLOCK, fill=False)
+
+    for generation in (1, 2, 3):
+        task_queue.handle_queue(noop, {'iid': 1}, 'token', 'url', 'slug', delay=0.05, coalesce_key='slug:1:1',
+                                generation=generation)
+
+    function, args, kwargs, _ = pool._queue.get(timeout=2)
+    assert kwargs == {'generation': 3}
+    assert pool._queue.empty() and not task_queue._pending_timers
+
+
+def test_rejected_resubmit_does_not_supersede_the_running_job(fake_services, full_pool, monkeypatch):
+    gitlab, llm = fake_services
+    gitlab.add_project('201', files=1, lines=5)
+    # 执行中的任务在 LLM 阶段停留一段时间，期间同一个 MR 的新事件因队列已满被拒绝
+    llm.first_token_latency = 0.3
+    full_pool(task_queue.OVERFLOW_REJECT)
+    monkeypatch.setenv('GITLAB_URL', gitlab.url)
+    url_slug = slugify_url(gitlab.url)
+    mr_key = coalesce_key(url_slug, '201', 1)
+    store = get_job_status_store()
+    generation, job_id = get_generation_store().bump(mr_key), store.create(mr_key)
+    running = threading.Thread(target=handle_merge_request_event,
+                               args=({'project_id': '201', 'iid': 1}, 'test-token', gitlab.url, url_slug),
+                               kwargs={'generation': generation, 'review_job_id': job_id})
+    running.start()
+    assert wait_for_status(job_id, 'llm', field='stage')['stage'] == 'llm'
+
+    response, status = service.handle_gitlab({'project_id': '201', 'iid': 1}, debounce_seconds=0)
+    running.join(timeout=10)
+    get_delivery().flush(5)
+
+    assert status == 429
+    assert get_generation_store().current(mr_key) == generation
+    assert store.get(job_id)['status'] == STATUS_DONE
+    assert ('merge_request', '201', 1) in gitlab.completed
+
+
+def test_rejected_batch_submit_discards_its_job(full_pool):
+    full_pool(task_queue.OVERFLOW_REJECT)
+    mr_key = coalesce_key(slugify_url('http://gitlab.invalid'), '301', 1)
+    store = get_job_status_store()
+    generation, queued = get_generation_store().bump(mr_key), store.create(mr_key)
+
+    [(response, status)] = service.handle_gitlab_many([{'project_id': '301', 'iid': 1}])
+
+    assert status == 429
+    assert get_generation_store().current(mr_key) == generation
+    assert store.get(queued)['status'] == STATUS_QUEUED
@@ -0,0 +1,67 @@
+import pytest
+
+from biz.llm.rateLimiter import (FileRateLimiter, LLMRateLimitError, PRIORITY_HIGH, PRIORITY_NORMAL,
+                                 RateLimiter, RedisRateLimiter, _refill_and_consume, priority_for_branch)
+
+
+def test_bucket_consumes_until_empty_then_waits():
+    state, wait = _refill_and_consume({}, 0, rpm=2, tpm=0, requests=1, tokens=0, reserve=0)
+    assert wait == 0 and state['r'] == 1
+    state, wait = _refill_and_consume(state, 0, rpm=2, tpm=0, requests=1, tokens=0, reserve=0)
+    assert wait == 0 and state['r'] == 0
+    state, wait = _refill_and_consume(state, 0, rpm=2, tpm=0, requests=1, tokens=0, reserve=0)
+    # 每分钟补充 2 个请求，缺 1 个需要等 30 秒，没有扣减
+    assert wait == pytest.approx(30) and state['r'] == 0
+
+
+def test_bucket_refills_over_time():
+    state = {'r': 0, 't': 0, 'ts': 0}
+    state, wait = _refill_and_consume(state, 30, rpm=60, tpm=6000, requests=1, tokens=2000, reserve=0)
+    assert wait == 0
+    assert state['r'] == pytest.approx(29) and state['t'] == pytest.approx(1000)
+
+
+def test_token_bucket_limits_large_requests():
+    state, wait = _refill_and_consume({}, 0, rpm=0, tpm=1000, requests=1, tokens=800, reserve=0)
+    assert wait == 0
+    _, wait = _refill_and_consume(state, 0, rpm=0, tpm=1000, requests=1, tokens=800, reserve=0)
+    assert wait == pytest.approx(36)
+
+
+def test_normal_priority_leaves_reserve_for_high_priority():
+    state = {'r': 2, 't': 0, 'ts': 0}
+    # 预留 20%（10 个请求中的 2 个），普通优先级不能用
+    _, wait = _refill_and_consume(state, 0, rpm=10, tpm=0, requests=1, tokens=0, reserve=0.2)
+    assert wait > 0
+    _, wait = _refill_and_consume(state, 0, rpm=10, tpm=0, requests=1, tokens=0, reserve=0)
+    assert wait == 0
+
+
+def test_file_limiter_shares_state_between_instances(tmp_path):
+    path = str(tmp_path / 'limit' / 'llm.json')
+    assert FileRateLimiter(path).try_acquire(1, 0, 1, 0, 0) == 0
+    assert FileRateLimiter(path).try_acquire(1, 0, 1, 0, 0) > 0
+
+
+def test_redis_limiter_matches_python_bucket():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    limiter = RedisRateLimiter(fakeredis.FakeRedis(), key='rate_limit:test')
+    waits = [limiter.try_acquire(0, 1000, 1, 400, 0) for _ in range(3)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(12, abs=0.5)
+
+
+def test_acquire_times_out(tmp_path):
+    limiter = RateLimiter(FileRateLimiter(str(tmp_path / 'llm.json')), rpm=1, tpm=0, reserve=0, timeout=0.1)
+    limiter.acquire(0, PRIORITY_HIGH)
+    assert not limiter.try_acquire(0, PRIORITY_HIGH)
+    with pytest.raises(LLMRateLimitError):
+        limiter.acquire(0, PRIORITY_HIGH)
+
+
+def test_priority_for_branch(monkeypatch):
+    monkeypatch.setenv('LLM_PRIORITY_BRANCHES', 'main,release*')
+    assert priority_for_branch('release/1.2') == PRIORITY_HIGH
+    assert priority_for_branch('feature/x') == PRIORITY_NORMAL
+    assert priority_for_branch(None) == PRIORITY_NORMAL
@@ -0,0 +1,69 @@
+import pytest
+
+from biz.utils import reviewCache
+from biz.utils.reviewCache import ReviewCache, make_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(reviewCache, 'time', clock)
+    return clock
+
+
+def make_cache(tmp_path, ttl=3600, max_entries=100, max_bytes=10 ** 6) -> ReviewCache:
+    return ReviewCache(str(tmp_path / 'cache.db'), ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
+
+
+def test_key_ignores_line_endings_and_trailing_whitespace():
+    assert make_cache_key("+a = 1  \r\n+b = 2\n", "feat", "3", "m") == make_cache_key("+a = 1\n+b = 2", "feat", "3", "m")
+
+
+def test_key_depends_on_every_part():
+    base = make_cache_key("+a", "feat", "3", "model-a")
+    assert base != make_cache_key("+b", "feat", "3", "model-a")
+    assert base != make_cache_key("+a", "fix", "3", "model-a")
+    assert base != make_cache_key("+a", "feat", "4", "model-a")
+    assert base != make_cache_key("+a", "feat", "3", "model-b")
+
+
+def test_put_and_get(tmp_path, clock):
+    cache = make_cache(tmp_path)
+    cache.put('k', '总分:80分', 80)
+    assert cache.get('k') == ('总分:80分', 80)
+    assert cache.get('missing') is None
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = make_cache(tmp_path, ttl=60)
+    cache.put('k', 'review', 80)
+    clock.now += 61
+    assert cache.get('k') is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = make_cache(tmp_path, max_entries=3)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 'review', 80)
+        clock.now += 1
+    cache.get('a')
+    clock.now += 1
+    cache.put('d', 'review', 80)
+    assert [key for key in 'abcd' if cache.get(key)] == ['a', 'c', 'd']
+
+
+def test_total_size_is_bounded(tmp_path, clock):
+    cache = make_cache(tmp_path, max_bytes=25)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 'x' * 10, 80)
+        clock.now += 1
+    assert cache.get('a') is None
+    assert cache.get('b') and cache.get('c')
@@ -0,0 +1,69 @@
+import pytest
+
+from biz.entity.codeReviewEntity import MergeEntity, PushEntity
+from biz.event import eventManager
+from biz.queue.worker import _merge_request_project_path
+from biz.utils.reviewHistory import ReviewHistoryStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ReviewHistoryStore(str(tmp_path / 'history.db'), batch_size=10, flush_interval=0, synchronous=True)
+    monkeypatch.setattr(eventManager, 'get_review_history_store', lambda: store)
+    return store
+
+
+def merge_entity(**kwargs) -> MergeEntity:
+    fields = dict(project_name='Fix login', author='alice', source_branch='feature/login', target_branch='develop',
+                  updated_at=None, commits=[{'message': 'fix'}], score=80,
+                  url='http://gitlab/group/app/-/merge_requests/1', review_result='ok', url_slug='gitlab',
+                  project_id=7, project_path='group/app')
+    fields.update(kwargs)
+    return MergeEntity(**fields)
+
+
+def push_entity(**kwargs) -> PushEntity:
+    fields = dict(project_name='app', author='bob', branch='hotfix/1', updated_at=None, commits=[{'message': 'fix'}],
+                  score=70, review_result='ok', url_slug='gitlab', project_id=8, project_path='group/lib')
+    fields.update(kwargs)
+    return PushEntity(**fields)
+
+
+def test_merge_request_history_uses_project_path_and_id(store):
+    eventManager.record_merge_request_history(merge_entity())
+
+    [record] = store.query(project_name='group/app')['items']
+    assert record['project_name'] == 'group/app' and record['project_id'] == '7'
+    assert (record['source_branch'], record['target_branch']) == ('feature/login', 'develop')
+    assert store.query(project_name='7')['total'] == 1
+    assert store.query(project_name='Fix login')['total'] == 0
+
+
+def test_push_history_records_pushed_branch(store):
+    eventManager.record_push_history(push_entity())
+
+    [record] = store.query(branch='hotfix/1')['items']
+    assert (record['kind'], record['project_name'], record['project_id']) == ('push', 'group/lib', '8')
+    assert record['source_branch'] == 'hotfix/1'
+
+
+def test_filters_and_group_by_project(store):
+    eventManager.record_merge_request_history(merge_entity(score=90))
+    eventManager.record_merge_request_history(merge_entity(score=70, author='carol', target_branch='main'))
+    eventManager.record_push_history(push_entity())
+
+    assert store.query(project_name='group/app', author='carol')['total'] == 1
+    assert store.query(project_name='group/app', branch='develop')['total'] == 1
+    assert store.query(kind='push')['items'][0]['project_name'] == 'group/lib'
+    stats = {item['project']: item for item in store.aggregate(group_by='project')['items']}
+    assert stats['group/app']['reviews'] == 2 and stats['group/app']['avg_score'] == 80
+    assert stats['group/lib']['reviews'] == 1
+
+
+@pytest.mark.parametrize('merge_request, expected', [
+    ({'references': {'full': 'group/sub/app!12'}, 'web_url': 'http://gitlab/x/-/merge_requests/12'}, 'group/sub/app'),
+    ({'web_url': 'http://gitlab.example.com/group/app/-/merge_requests/3'}, 'group/app'),
+    ({}, None),
+])
+def test_merge_request_project_path(merge_request, expected):
+    assert _merge_request_project_path(merge_request) == expected
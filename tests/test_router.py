@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from biz.llm.base import LLMError
+from biz.llm.router import Backend, RouterClient
+
+
+class FakeLLM:
+    """不走流式；delay 秒后返回 reply，reply 为异常时抛出"""
+
+    stream = False
+
+    def __init__(self, model: str, reply, delay: float = 0):
+        self.default_model = model
+        self.reply = reply
+        self.delay = delay
+        self.models = []
+
+    def completions(self, messages, model=None, usage=None, max_tokens=None):
+        self.models.append(model)
+        threading.Event().wait(self.delay)
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return self.reply
+
+
+class FakeLimiter:
+    def __init__(self, available: bool = True):
+        self.available = available
+        self.acquired = []
+
+    def acquire(self, tokens, priority=1):
+        self.acquired.append(tokens)
+
+    def try_acquire(self, tokens, priority=1) -> bool:
+        if self.available:
+            self.acquired.append(tokens)
+        return self.available
+
+
+def make_router(clients: list, limiter: FakeLimiter, hedge_enabled: bool = False,
+                max_workers: int = 4) -> RouterClient:
+    backends = [Backend(client.default_model, client, 0.2, 10) for client in clients]
+    return RouterClient(backends, hedge_enabled=hedge_enabled, hedge_percentile=0.95, hedge_min_samples=100,
+                        hedge_default_delay=0.05, max_error_rate=0.9, cooldown=30, max_workers=max_workers,
+                        rate_limiter=limiter)
+
+
+def test_failover_acquires_quota_and_reports_serving_model():
+    limiter = FakeLimiter()
+    router = make_router([FakeLLM('model-a', LLMError('boom')), FakeLLM('model-b', 'ok')], limiter)
+
+    content, model = router.route([{'role': 'user', 'content': 'hi'}], estimated_tokens=100)
+
+    assert (content, model) == ('ok', 'model-b')
+    assert limiter.acquired == [100, 100]
+
+
+def test_hedge_acquires_quota():
+    limiter = FakeLimiter()
+    router = make_router([FakeLLM('model-a', 'slow', delay=1), FakeLLM('model-b', 'fast')], limiter,
+                         hedge_enabled=True)
+
+    content, model = router.route([{'role': 'user', 'content': 'hi'}], estimated_tokens=100)
+
+    assert (content, model) == ('fast', 'model-b')
+    assert limiter.acquired == [100, 100]
+
+
+def test_hedge_is_skipped_without_quota():
+    limiter = FakeLimiter(available=False)
+    router = make_router([FakeLLM('model-a', 'slow', delay=0.2), FakeLLM('model-b', 'fast')], limiter,
+                         hedge_enabled=True)
+
+    content, model = router.route([{'role': 'user', 'content': 'hi'}], estimated_tokens=100)
+
+    assert (content, model) == ('slow', 'model-a')
+    assert limiter.acquired == [100]
+
+
+def test_no_hedge_while_executor_is_saturated():
+    limiter = FakeLimiter()
+    slow, fast = FakeLLM('model-a', 'slow', delay=0.2), FakeLLM('model-b', 'fast')
+    router = make_router([slow, fast], limiter, hedge_enabled=True, max_workers=1)
+    results = []
+
+    # 两个请求共用一个线程，第二个请求的首选要排队等第一个结束
+    threads = [threading.Thread(target=lambda: results.append(router.route([{'role': 'user', 'content': 'hi'}],
+                                                                           estimated_tokens=100)))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results == [('slow', 'model-a')] * 2
+    assert fast.models == [] and limiter.acquired == [100, 100]
+    # 排队等待的时间不计入后端的首 token 延迟
+    assert max(router.backends[0].samples) < 0.35
+
+
+def test_tier_model_is_used_by_every_backend():
+    clients = [FakeLLM('model-a', LLMError('boom')), FakeLLM('model-b', 'ok')]
+    router = make_router(clients, FakeLimiter())
+
+    assert router.route([{'role': 'user', 'content': 'hi'}], model='large')[1] == 'large'
+    assert router.candidate_models('large') == ['large']
+    assert [client.models for client in clients] == [['large'], ['large']]
+
+
+def test_all_backends_failing_raises():
+    router = make_router([FakeLLM('model-a', LLMError('a')), FakeLLM('model-b', LLMError('b'))], FakeLimiter())
+    with pytest.raises(LLMError):
+        router.completions([{'role': 'user', 'content': 'hi'}])